@@ -1,10 +1,14 @@
+import collections
+import functools
 import random
-import sys, threading, os, base64
+import sys, os, base64
 from module.Login import LoginWindow
 from module.Listener import Listener
-from module.ChatArea import ChatArea
+from module.ChatArea import ChatArea, ChatState
+from module.ChatStore import ChatStore, store_path
 from module.Sidebar import Sidebar
 from module.Room import CreateRoom
+from module.Transfer import IncomingTransfer, valid_header, valid_transfer_id
 from PySide6.QtCore import Qt, QSize, Signal, QObject
 from PySide6.QtGui import QColor, QIcon
 from PySide6.QtWidgets import (QApplication, QWidget, QHBoxLayout, QVBoxLayout,
@@ -21,6 +25,14 @@ BUBBLE_SELF_COLOR = '#E5F5FF'  # 自己发送的气泡背景色
 BUBBLE_OTHER_COLOR = '#F2F2F2'  # 别人发送的气泡背景色
 # 接收文件保存地址
 SAVE_DIR = "downloads"
+# 本地聊天记录数据库目录
+CACHE_DIR = "cache"
+# 发送图片前压缩：最长边和 JPEG 质量
+IMAGE_MAX_SIZE = 1920
+IMAGE_QUALITY = 85
+# 同时保留的聊天窗口数，其余的只保留消息模型
+MAX_CHAT_PANES = 8
+DEFAULT_AVATAR = 'asset/w1.png'
 
 
 class MainWindow(QWidget):
@@ -45,9 +57,14 @@ class MainWindow(QWidget):
         self.stacked_widget = QStackedWidget()
         self.h_layout.addWidget(self.stacked_widget)
 
-        # 聊天窗口缓存字典
-        self.user_chat_windows = {}
-        self.room_chat_windows = {}
+        # 聊天数据：名字 -> ChatState，打开聊天或收到消息时才创建
+        self.user_chats = {}
+        self.room_chats = {}
+        # 已经创建的聊天窗口，(名字, 是否房间) -> ChatArea，按最近使用排序，超过 MAX_CHAT_PANES 时销毁最久未用的
+        self.chat_panes = collections.OrderedDict()
+        self.user_avatars = {}  # 在线用户的头像，创建聊天时使用
+        # 本地聊天记录，登录后打开
+        self.store = None
 
         # 产生自己的头像
         avatar_list = os.listdir('asset/')
@@ -63,60 +80,142 @@ class MainWindow(QWidget):
             return log_window.textEdit.text()
 
     def switch_chat(self, name, isroom):
-        # 聊天窗口还没创建过
-        self.add_chatarea(name)
-        if isroom:
-            target_widget = self.room_chat_windows[name]
-        else:
-            target_widget = self.user_chat_windows[name]
-
-        # 切换显示
+        # 聊天窗口按需创建，本地记录只读最近一页，更早的在向上滚动时再读
+        target_widget = self.open_pane(self.chat_state(name, isroom))
+        target_widget.load_history()
         self.stacked_widget.setCurrentWidget(target_widget)
 
-    def add_chatarea(self, name, other_avatar='asset/w1.png'):
-        if name not in self.user_chat_windows:
-            chat_area = ChatArea(name, other_avatar, self.avatar)
-            self.stacked_widget.addWidget(chat_area)
-            self.user_chat_windows[name] = chat_area
-            chat_area.sent.connect(self.send_msg)
-
-    def add_room_chatarea(self, name, other_avatar='asset/w1.png'):
-        if name not in self.room_chat_windows:
-            chat_area = ChatArea(name, other_avatar, self.avatar, isroom=True)
-            self.stacked_widget.addWidget(chat_area)
-            self.room_chat_windows[name] = chat_area
-            chat_area.sent.connect(self.send_msg)
+    def chat_state(self, name, isroom):
+        chats = self.room_chats if isroom else self.user_chats
+        state = chats.get(name)
+        if state is None:
+            state = ChatState(name, isroom, self.user_avatars.get(name, DEFAULT_AVATAR))
+            chats[name] = state
+            if self.store is not None:
+                self.attach_history(state)
+        return state
+
+    def open_pane(self, state):
+        key = (state.chat_name, state.isroom)
+        chat_area = self.chat_panes.get(key)
+        if chat_area is not None:
+            self.chat_panes.move_to_end(key)
+            return chat_area
+        chat_area = ChatArea(state, self.avatar)
+        self.stacked_widget.addWidget(chat_area)
+        chat_area.sent.connect(self.send_msg)
+        chat_area.messageAdded.connect(functools.partial(self.record, state.chat_name, state.isroom))
+        self.chat_panes[key] = chat_area
+        # 销毁最久没用过的窗口，草稿和滚动位置留在 ChatState 里
+        current = self.stacked_widget.currentWidget()
+        for old_key, old in list(self.chat_panes.items()):
+            if len(self.chat_panes) <= MAX_CHAT_PANES:
+                break
+            if old is not current and old is not chat_area:
+                self.close_pane(old_key)
+        return chat_area
+
+    def close_pane(self, key):
+        chat_area = self.chat_panes.pop(key, None)
+        if chat_area is not None:
+            chat_area.save_state()
+            self.stacked_widget.removeWidget(chat_area)
+            # 模型留在 ChatState 里，先和视图断开
+            chat_area.message_list.setModel(None)
+            chat_area.deleteLater()
+
+    def add_message(self, name, isroom, content, sender_name='', is_me=True, msg_type='text', image_id=None):
+        """显示一条消息；聊天窗口没有创建时只加进 ChatState 的模型，打开时再显示"""
+        chat_area = self.chat_panes.get((name, isroom))
+        if chat_area is not None:
+            chat_area.add_message(content, sender_name, is_me, msg_type, image_id)
+            return
+        state = self.chat_state(name, isroom)
+        row = state.model.append_message(content, sender_name, is_me, msg_type, image_id)
+        state.scroll = None  # 和打开的窗口一样，有新消息时回到底部
+        self.record(name, isroom, state.model.messages[row])
+
+    def attach_history(self, state):
+        # 之后记录的消息都会加进这个聊天的模型，之前的从本地记录翻页读取
+        state.history = functools.partial(self.history_page, state.chat_name, state.isroom)
+        state.history_cursor = self.store.next_id
+
+    def open_store(self, path):
+        """登录后打开本地聊天记录"""
+        self.store = ChatStore(path)
+        for state in [*self.user_chats.values(), *self.room_chats.values()]:
+            self.attach_history(state)
+
+    def close_store(self):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+    def record(self, name, isroom, message):
+        if self.store is not None:
+            self.store.add(name, isroom, message)
+
+    def history_page(self, name, isroom, before):
+        return self.store.page(name, isroom, before).result()
 
     def send_msg(self, text, chat_name, chat_type, is_private):
         self.sent.emit(text, chat_name, chat_type, is_private)
 
+    def apply_events(self, events):
+        """接收线程合并好的一批界面更新，按到达顺序处理"""
+        for kind, items in events:
+            if kind == 'message':
+                for message, isroom in items:
+                    self.display_msg(message, isroom)
+            elif kind == 'login':
+                self.update_users(items, True)
+            elif kind == 'logout':
+                self.update_users(items, False)
+            elif kind == 'room':
+                for room_name in items:
+                    self.update_rooms(room_name)
+            elif kind == 'room_removed':
+                for room_name in items:
+                    self.remove_room(room_name)
+
     def display_msg(self, message, isroom):
-        if isroom:
-            if message['to_id'] in self.room_chat_windows.keys():
-                chat_area = self.room_chat_windows[message['to_id']]
-                msg_type = message['type']
-                chat_area.add_message(message['content'], message['from_id'], is_me=False, msg_type=msg_type)
+        name = message['to_id'] if isroom else message['from_id']
+        msg_type = message['type']
+        if msg_type == 'image_original':
+            # 图片原图接收完成，挂到之前显示的缩略图上
+            if self.store is not None:
+                self.store.set_path(message['image_id'], message['path'])
+            state = (self.room_chats if isroom else self.user_chats).get(name)
+            if state is not None:
+                state.model.set_original(message['image_id'], message['path'])
         else:
-            if message['from_id'] in self.user_chat_windows.keys():
-                chat_area = self.user_chat_windows[message['from_id']]
-                msg_type = message['type']
-                chat_area.add_message(message['content'], message['from_id'], is_me=False, msg_type=msg_type)
+            self.add_message(name, isroom, message['content'], message['from_id'], is_me=False, msg_type=msg_type,
+                             image_id=message.get('image_id'))
 
-    def update_users(self, user, islog):
+    def update_users(self, users, islog):
+        # 一次更新多个用户时只重绘一次侧边栏；聊天窗口等到打开或收到消息时才创建
+        self.sidebar.setUpdatesEnabled(False)
         if islog:
             avatar_list = os.listdir('asset/')
-            avatar = 'asset/' + random.choice(avatar_list)
-            self.add_chatarea(user, avatar)
-            self.sidebar.add_user(user, avatar)
-        else:
-            if user in self.user_chat_windows.keys():
-                self.stacked_widget.removeWidget(self.user_chat_windows[user])
-                self.user_chat_windows.pop(user)
-            self.sidebar.remove_user(user)
+        for user in users:
+            if islog:
+                avatar = 'asset/' + random.choice(avatar_list)
+                self.user_avatars[user] = avatar
+                self.sidebar.add_user(user, avatar)
+            else:
+                self.user_avatars.pop(user, None)
+                self.user_chats.pop(user, None)
+                self.close_pane((user, False))
+                self.sidebar.remove_user(user)
+        self.sidebar.setUpdatesEnabled(True)
 
     def update_rooms(self, room_name):
         self.sidebar.add_room(room_name)
-        self.add_room_chatarea(room_name)
+
+    def remove_room(self, room_name):
+        self.room_chats.pop(room_name, None)
+        self.close_pane((room_name, True))
+        self.sidebar.remove_room(room_name)
 
     def create_room_box(self, user, room):
         create_room_box = CreateRoom(room, user, self)
@@ -127,12 +226,17 @@ class MainWindow(QWidget):
         self.closed.emit()
 
 
+def add_event(events, kind, item):
+    """界面更新按种类合并，相邻的同类更新放进同一个列表，不同种类之间保持顺序"""
+    if events and events[-1][0] == kind:
+        events[-1][1].append(item)
+    else:
+        events.append((kind, [item]))
+
+
 class Client(QObject):
-    # 用于接收消息的信号，参数类型为 dict
-    msg_received = Signal(dict, bool)
-    # 用于用户登录/登出的信号，参数类型为 str(用户名), bool(是否登录)
-    user_status_changed = Signal(str, bool)
-    room_status_changed = Signal(str)
+    # 接收线程每读到一批消息发射一次，参数是 [(种类, [条目, ...]), ...]，见 MainWindow.apply_events
+    received = Signal(list)
 
     def __init__(self, ip, port):
         super().__init__()
@@ -140,12 +244,13 @@ class Client(QObject):
         self.port = port
         self.name = ''
 
-        self.receiving_files = {}  # 接收文件的文件句柄
+        self.receiving_files = {}  # 正在接收的文件 transfer_id -> IncomingTransfer
         self.online_users: set = set()  # 存储在线用户，主要防止重名
         self.online_rooms: set = set()  # 存储在线群聊，主要防止重名
+        self.presence_version = None  # 在线用户列表对应的服务器版本
+        self.snapshot_users = None  # 重新同步时正在收集的分页快照
 
-        self.Listener = Listener(self.ip, self.port, self.name)
-        self.tread_receive = threading.Thread(target=self.Listener.receive_msg, args=(self.handle_receive,))
+        self.Listener = Listener(self.ip, self.port, self.name, IMAGE_MAX_SIZE, IMAGE_QUALITY)
 
         # 设置 QFluentWidgets 的主题
         setTheme(Theme.LIGHT)
@@ -158,108 +263,166 @@ class Client(QObject):
 
         self.Listener.file_finished.connect(self.finished_send_file)
 
-        # 当 msg_received 发射时，主线程会自动执行 self.Window.display_msg
-        self.msg_received.connect(self.Window.display_msg)
-        # 当 user_status_changed 发射时，主线程会自动执行 self.Window.update_users
-        self.user_status_changed.connect(self.Window.update_users)
-        # 当 user_status_changed 发射时，主线程会自动执行 self.Window.update_room
-        self.room_status_changed.connect(self.Window.update_rooms)
+        # 当 received 发射时，主线程会自动执行 self.Window.apply_events
+        self.received.connect(self.Window.apply_events)
 
 
     def run(self):
-        self.tread_receive.start()
+        self.Listener.start_receiving(self.handle_receive)
         self.Window.show()
         name = self.Window.log_in(self.online_users)
         if name:
             self.name = name
+            self.Window.open_store(store_path(CACHE_DIR, f"{self.ip}:{self.port}", name))
             self.Listener.send_login(name)
         else:
             self.Window.close()
 
 
-    def handle_receive(self, msg):
-        if msg['type'] in ['text', 'image', 'file_header', 'file_chunk', 'file_finish']:
-            self.receive_msg(msg)
+    def handle_receive(self, messages):
+        """在接收线程里处理一批消息：文件分片直接写盘，界面更新合并后只发射一次信号"""
+        events = []
+        for msg in messages:
+            if msg['type'] in ['text', 'image', 'file_header', 'file_chunk', 'file_finish']:
+                self.receive_msg(msg, events)
 
-        elif msg['type'] == 'user_list':
-            # 遍历列表，批量添加用户
-            for user in msg['from_id']:
-                self.user_status_changed.emit(user, True)
-                self.online_users.add(user)
+            elif msg['type'] == 'user_list':
+                self.receive_user_list(msg, events)
 
-        elif msg['type'] == 'login':
-            self.user_status_changed.emit(msg['from_id'], True)
-            self.online_users.add(msg['from_id'])
+            elif msg['type'] == 'presence':
+                # 在线状态增量，版本不比已有的新就是重复的
+                if self.presence_version is None or msg['version'] > self.presence_version:
+                    self.presence_version = msg['version']
+                    self.user_online(msg['online'], True, events)
+                    self.user_online(msg['offline'], False, events)
 
-        elif msg['type'] == 'logout':
-            self.user_status_changed.emit(msg['from_id'], False)
-            self.online_users.remove(msg['from_id'])
+            elif msg['type'] == 'login':
+                self.user_online([msg['from_id']], True, events)
 
-        elif msg['type'] == 'join_room':
-            self.room_status_changed.emit(msg['content'])
+            elif msg['type'] == 'logout':
+                self.user_online([msg['from_id']], False, events)
+
+            elif msg['type'] == 'join_room':
+                self.online_rooms.add(msg['content'])
+                add_event(events, 'room', msg['content'])
+
+            elif msg['type'] == 'delete_room':
+                # 房间被创建者删除
+                self.online_rooms.discard(msg['content'])
+                add_event(events, 'room_removed', msg['content'])
+
+        if events:
+            self.received.emit(events)
+
+    def user_online(self, users, online, events):
+        for user in users:
+            if user == self.name or (user in self.online_users) == online:
+                continue
+            if online:
+                self.online_users.add(user)
+            else:
+                self.online_users.discard(user)
+            add_event(events, 'login' if online else 'logout', user)
+
+    def receive_user_list(self, msg, events):
+        """在线用户快照，可能分成多页；reset 表示要整体替换当前列表"""
+        if 'version' in msg:
+            self.presence_version = msg['version']
+        if not msg.get('reset'):
+            self.user_online(msg['from_id'], True, events)
+            return
+        if msg.get('page', 0) == 0:
+            self.snapshot_users = set()
+        self.snapshot_users.update(msg['from_id'])
+        if msg.get('page', 0) == msg.get('pages', 1) - 1:
+            self.user_online(self.online_users - self.snapshot_users, False, events)
+            self.user_online(self.snapshot_users, True, events)
+            self.snapshot_users = None
 
     def send_msg(self, content, chat_name, chat_type, is_private):
         self.Listener.send_msg(content, chat_type, chat_name, not is_private)
 
-    def receive_msg(self, msg: dict):
+    def receive_msg(self, msg: dict, events):
         msg_type = msg.get('type')
         from_id = msg.get('from_id')
         filename = msg.get('filename')
         isroom = not msg.get('private')
 
-        file_key = filename
-        # 防止同名文件冲突
-        # if os.path.exists(f'downloads/{filename}'):
-        #     i = 1
-        #     while 1:
-        #         if not os.path.exists(f'downloads/{filename}'):
-        #             file_key = f"{filename}({i})"
-        #             break
+        # 新版按 transfer_id 区分传输，旧版客户端没有 id，按发送方和文件名区分
+        transfer_id = valid_transfer_id(msg)
+        file_key = transfer_id or (from_id, filename)
+        # 只有私聊传输才回复进度，房间里的接收者太多
+        reply_status = not isroom and transfer_id is not None
 
         # 收到文件头：准备接收
         if msg_type == 'file_header':
-            print(f"开始接收文件: {filename}, 大小: {msg['filesize']}")
+            print(f"开始接收文件: {filename}, 大小: {msg.get('filesize')}")
 
             if not os.path.exists(SAVE_DIR):
                 os.makedirs(SAVE_DIR)
-            save_path = os.path.join(SAVE_DIR, filename)
 
             try:
-                f = open(save_path, 'wb')
-                self.receiving_files[file_key] = f
-
-                # 显示文件接收气泡
-                msg['type'] = 'file'
-                msg['content'] = f'正在接收文件：{file_key}'
-                self.msg_received.emit(msg, isroom)
+                transfer = self.receiving_files.get(file_key)
+                if transfer is None:
+                    if not valid_header(msg):
+                        print(f"文件头无效，拒绝接收: {filename}")
+                        return
+                    # 之前中断过的传输会从 PARTIAL_DIR 里恢复进度
+                    transfer = IncomingTransfer(SAVE_DIR, msg)
+                    self.receiving_files[file_key] = transfer
+
+                    # 显示文件接收气泡，图片原图已经先显示了缩略图，不再提示
+                    if 'image_id' not in msg:
+                        msg['type'] = 'file'
+                        msg['content'] = f'正在接收文件：{os.path.basename(transfer.path)}'
+                        add_event(events, 'message', (msg, isroom))
+
+                if reply_status:
+                    self.send_file_status(from_id, transfer)
 
             except Exception as e:
                 print(f"文件创建失败: {e}")
 
         # 接收写入文件分片
         elif msg_type == 'file_chunk':
-            if file_key in self.receiving_files:
-                f = self.receiving_files[file_key]
-                # 解码 Base64 并写入
+            transfer = self.receiving_files.get(file_key)
+            if transfer is not None:
+                # 二进制帧直接写入，旧格式需要先解码 Base64
                 try:
-                    chunk_data = base64.b64decode(msg['content'])
-                    f.write(chunk_data)
+                    data = msg['data'] if 'data' in msg else base64.b64decode(msg['content'])
+                    transfer.write(msg, data)
+                    if reply_status and transfer.should_ack():
+                        self.send_file_status(from_id, transfer)
                 except Exception as e:
                     print(f"写入分片失败: {e}")
 
         # 收到文件结束
         elif msg_type == 'file_finish':
-            if file_key in self.receiving_files:
-                f = self.receiving_files[file_key]
-                f.close()
+            transfer = self.receiving_files.get(file_key)
+            if transfer is not None:
+                if reply_status:
+                    self.send_file_status(from_id, transfer, final=True)
+                    if not transfer.complete:
+                        # 还缺分片，等发送方补发后会再发一次结束包
+                        return
                 del self.receiving_files[file_key]
-                msg['type'] = 'file'
-                msg['content'] = f'文件接收完成：{file_key}'
-                self.msg_received.emit(msg, isroom)
-                print(f"文件接收完成: {filename}")
+                transfer.close()
+                if 'image_id' in msg:
+                    msg['type'] = 'image_original'
+                    msg['path'] = transfer.path
+                else:
+                    msg['type'] = 'file'
+                    state = '文件接收完成' if transfer.complete else '文件接收不完整'
+                    msg['content'] = f'{state}：{os.path.basename(transfer.path)}'
+                add_event(events, 'message', (msg, isroom))
+                print(f"文件接收完成: {transfer.path}")
 
         elif msg_type in ['text', 'image']:
-            self.msg_received.emit(msg, isroom)
+            add_event(events, 'message', (msg, isroom))
+
+    def send_file_status(self, to_id, transfer, final=False):
+        """把接收进度告诉发送方"""
+        self.Listener.send_msg('', 'file_status', to_id, True, extra=transfer.status(final))
 
     def create_room(self):
         room_info = self.Window.create_room_box(self.online_users, self.online_rooms)
@@ -268,14 +431,16 @@ class Client(QObject):
             self.Listener.send_msg(room_info['name'], 'create_room', room_info['users'])
 
     def finished_send_file(self, filename, to_id, is_private):
-        if is_private:
-            self.Window.user_chat_windows[to_id].add_message(f"发送完成: {filename}", is_me=True, msg_type='file')
-        else:
-            self.Window.room_chat_windows[to_id].add_message(f"发送完成: {filename}", is_me=True, msg_type='file')
+        self.Window.add_message(to_id, not is_private, f"发送完成: {filename}", is_me=True, msg_type='file')
 
     def close(self):
         self.Listener.send_msg("", "logout", "All")
         self.Listener.close()
+        self.Window.close_store()
+        # 没收完的文件保存进度，下次对方重新发送时接着传
+        for transfer in self.receiving_files.values():
+            transfer.close()
+        self.receiving_files.clear()
 
 
 if __name__ == "__main__":
@@ -1,26 +1,50 @@
-import base64
 import os
 
-from PySide6.QtCore import Qt, QSize, Signal
-from PySide6.QtWidgets import QWidget, QHBoxLayout, QVBoxLayout, QListWidget, QListWidgetItem, QFrame, \
-    QAbstractItemView, QFileDialog
-from qfluentwidgets import TextEdit, PrimaryPushButton, StrongBodyLabel, TransparentToolButton, FluentIcon
-from module.MessageBubble import MessageBubble
+from PySide6.QtCore import Qt, Signal, QUrl
+from PySide6.QtGui import QDesktopServices
+from PySide6.QtWidgets import QWidget, QHBoxLayout, QVBoxLayout, QListView, QFrame, \
+    QAbstractItemView, QFileDialog, QApplication
+from qfluentwidgets import TextEdit, PrimaryPushButton, StrongBodyLabel, TransparentToolButton, FluentIcon, \
+    RoundMenu, Action
+from module.MessageBubble import MessageBubbleDelegate
+from module.MessageModel import MessageModel, ChatMessage
+
+
+class ChatState:
+    """
+    一个聊天的数据：消息模型、草稿、滚动位置和本地记录的翻页状态。
+    ChatArea 只在打开过的聊天上创建，不活跃时可以销毁，之后用同一个 ChatState 重建
+    """
+
+    def __init__(self, chat_name, isroom, other_avatar, parent=None):
+        self.chat_name = chat_name
+        self.isroom = isroom
+        self.other_avatar = other_avatar
+        self.model = MessageModel(parent)
+        self.draft = ''  # 输入框里没发出去的文字
+        self.scroll = None  # 离底部的距离，None 表示停在底部
+        # 本地聊天记录：history(before) 返回 (ChatMessage 的参数列表, 更早一页的游标)，见 MainWindow.history_page
+        self.history = None
+        self.history_cursor = None  # 下一次向上翻页从这个 id 往前读，None 表示没有更早的了
+        self.history_loaded = False  # 第一次打开这个聊天时才读取最近一页
 
 
 class ChatArea(QWidget):
     """
-    右侧聊天区域：包含消息列表和输入框
+    右侧聊天区域：包含消息列表和输入框，数据都在 ChatState 里
     """
     sent = Signal(str, str, str, bool)  # content, to_id, type, is_private
+    messageAdded = Signal(object)  # 新显示的一条 ChatMessage，MainWindow 据此写入本地记录
 
-    def __init__(self, chat_name, other_avatar, self_avatar, isroom=False, parent=None):
+    def __init__(self, state, self_avatar, parent=None):
         super().__init__(parent)
-        self.chat_name = chat_name
+        self.state = state
+        self.chat_name = state.chat_name
         self.chat_type = ''
-        self.other_avatar = other_avatar
+        self.other_avatar = state.other_avatar
         self.self_avatar = self_avatar
-        self.isroom = isroom
+        self.isroom = state.isroom
+        self.keep_bottom_offset = state.scroll  # 插入更早的消息或重建后保持和底部的距离，视图不跳动
 
         self.layout = QVBoxLayout(self)
         self.layout.setContentsMargins(0, 0, 0, 0)
@@ -32,34 +56,40 @@ class ChatArea(QWidget):
         self.header.setStyleSheet("background-color: white; border-bottom: 2px solid #E5E5E5;")
         header_layout = QHBoxLayout(self.header)
         header_layout.setContentsMargins(20, 0, 20, 0)
-        self.title_label = StrongBodyLabel(chat_name)
+        self.title_label = StrongBodyLabel(self.chat_name)
         header_layout.addWidget(self.title_label)
         header_layout.addStretch(1)
 
         self.layout.addWidget(self.header)
 
-        # 消息列表区域
-        self.message_list = QListWidget()
-        self.message_list.setFrameShape(QListWidget.NoFrame)
-        self.message_list.setStyleSheet("QListWidget { background-color: #F9F9F9; border: none; }")
-        self.message_list.setVerticalScrollMode(QListWidget.ScrollPerPixel)
+        # 消息列表区域：模型 + 委托绘制，只有可见的消息会被绘制
+        self.message_model = state.model
+        self.message_list = QListView()
+        self.message_list.setModel(self.message_model)
+        self.message_list.setItemDelegate(MessageBubbleDelegate(self.other_avatar, self_avatar, self.isroom,
+                                                                self.message_list))
+        self.message_list.setFrameShape(QFrame.Shape.NoFrame)
+        self.message_list.setVerticalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
+        self.message_list.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
         self.message_list.setSelectionMode(QAbstractItemView.SelectionMode.NoSelection)
+        self.message_list.setResizeMode(QListView.ResizeMode.Adjust)  # 宽度变化时重新计算气泡换行
+        self.message_list.setUniformItemSizes(False)
+        self.message_list.setLayoutMode(QListView.LayoutMode.Batched)
+        self.message_list.setBatchSize(200)
+        self.message_list.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
+        self.message_list.customContextMenuRequested.connect(self.show_context_menu)
+        self.message_list.doubleClicked.connect(self.open_original)
+        # 分批布局时滚动范围会陆续变大，停在底部时跟随到底
+        self.stick_bottom = state.scroll is None
+        scroll_bar = self.message_list.verticalScrollBar()
+        scroll_bar.valueChanged.connect(self.on_scrolled)
+        scroll_bar.rangeChanged.connect(self.on_range_changed)
         self.message_list.setStyleSheet("""
-                    QListWidget {
+                    QListView {
                         background-color: #F9F9F9; 
                         border: none;
                         outline: none;
                     }
-                    QListWidget::item {
-                        background-color: transparent;
-                        border: none; 
-                        padding: 0px;
-                    }
-                    QListWidget::item:hover, 
-                    QListWidget::item:selected {
-                        background-color: transparent;
-                        border: none;
-                    }
                 """)
         self.layout.addWidget(self.message_list)
 
@@ -89,6 +119,7 @@ class ChatArea(QWidget):
         self.text_edit = TextEdit()
         self.text_edit.setPlaceholderText("请输入消息...")
         self.text_edit.setStyleSheet("QTextEdit { border: none; background: transparent; }")
+        self.text_edit.setPlainText(state.draft)
         input_layout.addWidget(self.text_edit)
 
         # 发送按钮区
@@ -102,15 +133,73 @@ class ChatArea(QWidget):
 
         self.layout.addWidget(self.input_container)
 
-    def add_message(self, content, sender_name='', is_me=True, msg_type='text'):
-        item = QListWidgetItem()
-        widget = MessageBubble(content, self.self_avatar if is_me else self.other_avatar,
-                               sender_name, is_me, self.isroom, msg_type)
-
-        item.setSizeHint(QSize(0, widget.sizeHint().height() + 4))
-        self.message_list.addItem(item)
-        self.message_list.setItemWidget(item, widget)
+    def add_message(self, content, sender_name='', is_me=True, msg_type='text', image_id=None, path=None):
+        row = self.message_model.append_message(content, sender_name, is_me, msg_type, image_id, path)
+        self.stick_bottom = True
+        self.keep_bottom_offset = None
         self.message_list.scrollToBottom()
+        self.messageAdded.emit(self.message_model.messages[row])
+
+    def load_history(self):
+        """打开这个聊天时调用，只读最近一页"""
+        state = self.state
+        if state.history_loaded or state.history is None:
+            return
+        state.history_loaded = True
+        self.load_older()
+
+    def load_older(self):
+        state = self.state
+        if state.history_cursor is None:
+            return
+        rows, state.history_cursor = state.history(state.history_cursor)
+        if not rows:
+            return
+        scroll_bar = self.message_list.verticalScrollBar()
+        if not self.stick_bottom:
+            self.keep_bottom_offset = scroll_bar.maximum() - scroll_bar.value()
+        self.message_model.prepend_messages([ChatMessage(*row) for row in rows])
+
+    def save_state(self):
+        """销毁前记下草稿和滚动位置"""
+        scroll_bar = self.message_list.verticalScrollBar()
+        self.state.draft = self.text_edit.toPlainText()
+        self.state.scroll = None if self.stick_bottom else scroll_bar.maximum() - scroll_bar.value()
+
+    def open_original(self, index):
+        """双击图片用系统程序打开原图"""
+        message = index.data(MessageModel.MessageRole)
+        if message is not None and message.msg_type == 'image' and message.path:
+            QDesktopServices.openUrl(QUrl.fromLocalFile(os.path.abspath(message.path)))
+
+    def on_scrolled(self, value):
+        maximum = self.message_list.verticalScrollBar().maximum()
+        self.stick_bottom = value >= maximum
+        if self.keep_bottom_offset is not None and value != maximum - self.keep_bottom_offset:
+            # 用户自己滚动了
+            self.keep_bottom_offset = None
+        if value == 0 and maximum > 0 and self.state.history_loaded and self.keep_bottom_offset is None:
+            self.load_older()
+
+    def on_range_changed(self, _, maximum):
+        scroll_bar = self.message_list.verticalScrollBar()
+        if self.stick_bottom:
+            scroll_bar.setValue(maximum)
+        elif self.keep_bottom_offset is not None:
+            scroll_bar.setValue(maximum - self.keep_bottom_offset)
+
+    def show_context_menu(self, pos):
+        """
+        文本消息右键复制
+        """
+        index = self.message_list.indexAt(pos)
+        message = index.data(MessageModel.MessageRole) if index.isValid() else None
+        if message is None or message.msg_type != 'text':
+            return
+        menu = RoundMenu(parent=self)
+        menu.addAction(Action(FluentIcon.COPY, "复制",
+                              triggered=lambda: QApplication.clipboard().setText(message.content)))
+        menu.exec(self.message_list.viewport().mapToGlobal(pos))
 
     def send_message(self):
         """
@@ -127,16 +216,11 @@ class ChatArea(QWidget):
             self, "选择图片", "", "Images (*.png *.jpg *.jpeg *.bmp)"
         )
         if file_path:
-            # 读取文件并转 Base64
-            with open(file_path, 'rb') as f:
-                img_data = f.read()
-                base64_str = base64.b64encode(img_data).decode('utf-8')
-
-            # 显示图片
-            self.add_message(base64_str, is_me=True, msg_type='image')
+            # 本地直接显示原图，压缩、缩略图和发送由 Listener 在线程里完成
+            self.add_message('', is_me=True, msg_type='image', path=file_path)
 
             # 发送信号MainWindow -> Client -> Listener
-            self.sent.emit(base64_str, self.chat_name, 'image', self.isroom)
+            self.sent.emit(file_path, self.chat_name, 'image', self.isroom)
 
     def select_file(self):
         """选择并发送文件"""
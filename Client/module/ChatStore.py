@@ -0,0 +1,180 @@
+"""
+客户端本地聊天记录缓存，保存在 SQLite 数据库里，重启后还能看到以前的消息。
+
+每个登录账号一个数据库文件，开启 WAL。界面线程只把消息放进队列，由一个后台线程批量写入，
+一批在同一个事务里提交；读请求也进同一个队列，所以一定能读到之前已经放进队列的消息。
+消息 id 在入队时就分配好，ChatArea 用它作为翻页的游标。
+
+messages_fts 是 FTS5 全文索引（trigram 分词，中文也能按子串搜索），图片消息的缩略图不进索引。
+SQLite 没有编译 FTS5 或者搜索词不足三个字时退回 LIKE 扫描。
+"""
+import concurrent.futures
+import hashlib
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+PAGE_SIZE = 50  # 切换聊天和向上翻页时每次读取的条数
+MAX_BATCH = 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    chat TEXT NOT NULL,
+    isroom INTEGER NOT NULL,
+    sender TEXT,
+    is_me INTEGER,
+    msg_type TEXT,
+    content TEXT,
+    image_id TEXT,
+    path TEXT,
+    ts REAL
+);
+CREATE INDEX IF NOT EXISTS messages_chat ON messages (chat, isroom, id);
+CREATE INDEX IF NOT EXISTS messages_image ON messages (image_id) WHERE image_id IS NOT NULL;
+"""
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (
+    content, content='messages', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages WHEN new.msg_type != 'image' BEGIN
+    INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+END;
+"""
+COLUMNS = 'content, sender, is_me, msg_type, image_id, path'  # 顺序和 ChatMessage 的参数一致
+
+
+def store_path(root, server, user):
+    """同一台服务器上的同一个用户名共用一个数据库"""
+    name = hashlib.sha1(f"{server}\x00{user}".encode('utf-8')).hexdigest()
+    return os.path.join(root, f"{name}.db")
+
+
+class ChatStore:
+    """
+    add 和 set_path 只入队，可以在界面线程里直接调用；page 和 search 返回 Future。
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # 建好表后连接只在写线程里使用
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        try:
+            self.db.executescript(FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False
+        self.next_id = self.db.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM messages').fetchone()[0]
+
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._run, name='chat-store', daemon=True)
+        self.thread.start()
+
+    def add(self, chat, isroom, message) -> int:
+        """记录一条 ChatMessage，返回分配的 id"""
+        msg_id = self.next_id
+        self.next_id += 1
+        row = (msg_id, chat, int(isroom), message.sender_name, int(message.is_me), message.msg_type,
+               message.content, message.image_id, message.path, time.time())
+        self.queue.put(('add', row, None))
+        return msg_id
+
+    def set_path(self, image_id, path):
+        """图片原图接收完成，记下本地路径"""
+        self.queue.put(('path', (path, image_id), None))
+
+    def page(self, chat, isroom, before, limit=PAGE_SIZE) -> concurrent.futures.Future:
+        """
+        读取 id 小于 before 的最近 limit 条消息，按时间顺序排列。
+        结果是 (rows, cursor)，row 的字段见 COLUMNS；cursor 为这一页第一条的 id，
+        传给下一次的 before 继续向前翻，已经没有更早的消息时为 None
+        """
+        future = concurrent.futures.Future()
+        self.queue.put(('page', (chat, int(isroom), before, limit), future))
+        return future
+
+    def search(self, text, limit=PAGE_SIZE) -> concurrent.futures.Future:
+        """在所有聊天里搜索文字，结果是最新的 limit 条 (id, chat, isroom, sender, content, ts)"""
+        future = concurrent.futures.Future()
+        self.queue.put(('search', (text, limit), future))
+        return future
+
+    def close(self):
+        future = concurrent.futures.Future()
+        self.queue.put(('close', None, future))
+        future.result()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            rows = []
+            for op, arg, future in batch:
+                if op == 'add':
+                    rows.append(arg)
+                    continue
+                # 更新和读取要看到前面的消息，先把攒下的一起提交
+                self._write(rows)
+                rows = []
+                if op == 'path':
+                    self._execute('UPDATE messages SET path = ? WHERE image_id = ?', arg)
+                elif op == 'close':
+                    self.db.close()
+                    future.set_result(None)
+                    return
+                else:
+                    try:
+                        future.set_result(self._page(*arg) if op == 'page' else self._search(*arg))
+                    except Exception as e:
+                        future.set_exception(e)
+            self._write(rows)
+
+    def _write(self, rows):
+        if rows:
+            self._execute('INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows, many=True)
+
+    def _execute(self, sql, params, many=False):
+        try:
+            with self.db:
+                if many:
+                    self.db.executemany(sql, params)
+                else:
+                    self.db.execute(sql, params)
+        except sqlite3.Error as e:
+            print(f"Chat store write error: {e}")
+
+    def _page(self, chat, isroom, before, limit):
+        cursor = self.db.execute(
+            f'SELECT id, {COLUMNS} FROM messages WHERE chat = ? AND isroom = ? AND id < ? ORDER BY id DESC LIMIT ?',
+            (chat, isroom, before, limit))
+        result = cursor.fetchall()
+        result.reverse()
+        rows = [row[1:] for row in result]
+        return rows, (result[0][0] if len(result) == limit else None)
+
+    def _search(self, text, limit):
+        if self.fts and len(text) >= 3:
+            phrase = '"' + text.replace('"', '""') + '"'
+            cursor = self.db.execute(
+                'SELECT m.id, m.chat, m.isroom, m.sender, m.content, m.ts FROM messages_fts f '
+                'JOIN messages m ON m.id = f.rowid WHERE messages_fts MATCH ? ORDER BY m.id DESC LIMIT ?',
+                (phrase, limit))
+        else:
+            pattern = '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            cursor = self.db.execute(
+                "SELECT id, chat, isroom, sender, content, ts FROM messages "
+                "WHERE msg_type != 'image' AND content LIKE ? ESCAPE '\\' ORDER BY id DESC LIMIT ?",
+                (pattern, limit))
+        return cursor.fetchall()
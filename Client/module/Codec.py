@@ -0,0 +1,294 @@
+"""
+消息编解码，客户端与服务端共用，登录时协商。
+
+JSON 是兼容格式，所有版本都认识。packed 是紧凑的二进制格式：
+    帧内 id 表 | 值
+    id 表：varint 个数，varint 字节数，用 \0 连接的 UTF-8。from_id、to_id 等字段里的用户名和房间名只写一次，
+           值里用序号引用，解码时 sys.intern，同一个名字在进程里只有一份字符串
+    值：一个字节的标签后跟内容，整数用 zigzag varint，字符串和字节串都是长度前缀，
+        用户名列表是 varint 个数 + 序号宽度 + 定长序号，解码时一次 struct.unpack
+    字典的键和 type 的取值都是一个字节的枚举，不认识的键和类型原样写字符串
+
+id 表只在一帧之内有效，不做连接级别的状态，所以服务端收到的 packed 帧仍然可以原样转发给所有协商了 packed 的接收者。
+帧头 flags 里的 FLAG_PACKED 标记 meta 和 body 用的是哪种格式，解码时按帧判断，同一条连接上两种格式可以混用。
+packed 表示不了的消息（超过 62 位的整数、嵌套太深）由 Framing 把这一帧改用 JSON 编码。
+"""
+import json
+import struct
+import sys
+
+FLAG_PACKED = 0x02
+
+# 值的标签
+T_NONE, T_FALSE, T_TRUE, T_INT, T_FLOAT, T_STR, T_BYTES, T_LIST, T_DICT, T_ID, T_TYPE, T_IDS = range(12)
+
+# 键和消息类型的枚举，只能在末尾追加，0 表示后面跟着原样的字符串
+KEYS = (None, 'type', 'private', 'from_id', 'to_id', 'content', 'filename', 'filesize', 'transfer_id', 'offset',
+        'crc', 'image_id', 'chunk_size', 'have', 'final', 'done', 'frame', 'binary_file', 'compress', 'codec',
+        'codecs', 'presence', 'interest', 'version', 'online', 'offline', 'page', 'pages', 'reset', 'cursor',
+        'before', 'limit', 'ts', 'data', 'path', 'user', 'members', 'lanes', 'query', 'chat')
+TYPES = (None, 'text', 'image', 'file_header', 'file_chunk', 'file_finish', 'file_status', 'login', 'logout',
+         'login_ack', 'user_list', 'presence', 'presence_interest', 'create_room', 'join_room', 'leave_room',
+         'delete_room', 'history', 'ping', 'pong', 'search')
+KEY_CODES = {key: code for code, key in enumerate(KEYS) if key}
+TYPE_CODES = {name: code for code, name in enumerate(TYPES) if name}
+# 这些字段的字符串（或字符串列表）是用户名、房间名，放进 id 表
+ID_KEYS = frozenset(('from_id', 'to_id', 'online', 'offline', 'user', 'members', 'interest'))
+
+_DOUBLE = struct.Struct('!d')
+_INDEX_FORMATS = {1: 'B', 2: 'H', 4: 'I'}  # id 列表里每个序号的字节数
+MAX_DEPTH = 32
+
+
+class CodecError(ValueError):
+    """消息体无法解码"""
+
+
+class JsonCodec:
+    name = 'json'
+    flag = 0
+
+    @staticmethod
+    def encode(obj) -> bytes:
+        return json.dumps(obj).encode('utf-8')
+
+    @staticmethod
+    def decode(data):
+        try:
+            return json.loads(data)
+        except ValueError as e:
+            raise CodecError(f"bad json: {e}")
+
+
+def _varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(data, pos):
+    """返回 (值, 新位置)；单字节的情况由调用方内联处理，这里处理多字节"""
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+        if shift > 63:
+            raise CodecError("varint too long")
+
+
+def _read_string(data, pos):
+    size = data[pos]
+    pos += 1
+    if size >= 0x80:
+        size, pos = _read_varint(data, pos - 1)
+    end = pos + size
+    if end > len(data):
+        raise CodecError("truncated field")
+    try:
+        return str(data[pos:end], 'utf-8'), end
+    except UnicodeDecodeError as e:
+        raise CodecError(f"bad utf-8: {e}")
+
+
+class PackedCodec:
+    name = 'packed'
+    flag = FLAG_PACKED
+
+    def encode(self, obj) -> bytes:
+        ids = {}
+        out = bytearray()
+        self._value(out, obj, ids, False, 0)
+        head = bytearray()
+        _varint(head, len(ids))
+        if ids:
+            table = '\0'.join(ids).encode('utf-8')
+            _varint(head, len(table))
+            head += table
+        return bytes(head + out)
+
+    def _value(self, out, value, ids, is_id, depth):
+        if depth > MAX_DEPTH:
+            raise ValueError("message nested too deeply")
+        if value is None:
+            out.append(T_NONE)
+        elif value is True:
+            out.append(T_TRUE)
+        elif value is False:
+            out.append(T_FALSE)
+        elif isinstance(value, str):
+            if is_id and '\0' not in value:
+                index = ids.get(value)
+                if index is None:
+                    index = ids[value] = len(ids)
+                out.append(T_ID)
+                _varint(out, index)
+            else:
+                raw = value.encode('utf-8')
+                out.append(T_STR)
+                _varint(out, len(raw))
+                out += raw
+        elif isinstance(value, int):
+            if not -1 << 62 <= value < 1 << 62:
+                raise ValueError("integer out of range")
+            out.append(T_INT)
+            _varint(out, value * 2 if value >= 0 else -value * 2 - 1)
+        elif isinstance(value, dict):
+            out.append(T_DICT)
+            _varint(out, len(value))
+            for key, item in value.items():
+                code = KEY_CODES.get(key)
+                if code:
+                    out.append(code)
+                else:
+                    raw = str(key).encode('utf-8')
+                    out.append(0)
+                    _varint(out, len(raw))
+                    out += raw
+                if key == 'type' and item in TYPE_CODES:
+                    out.append(T_TYPE)
+                    out.append(TYPE_CODES[item])
+                else:
+                    self._value(out, item, ids, key in ID_KEYS, depth + 1)
+        elif isinstance(value, (list, tuple)):
+            if is_id and all(type(item) is str and '\0' not in item for item in value):
+                # 用户名列表（在线列表、房间成员）只写序号
+                indexes = []
+                for item in value:
+                    index = ids.get(item)
+                    if index is None:
+                        index = ids[item] = len(ids)
+                    indexes.append(index)
+                width = 1 if len(ids) <= 0x100 else 2 if len(ids) <= 0x10000 else 4
+                out.append(T_IDS)
+                _varint(out, len(indexes))
+                out.append(width)
+                out += struct.pack(f'!{len(indexes)}{_INDEX_FORMATS[width]}', *indexes)
+                return
+            out.append(T_LIST)
+            _varint(out, len(value))
+            for item in value:
+                self._value(out, item, ids, is_id, depth + 1)
+        elif isinstance(value, float):
+            out.append(T_FLOAT)
+            out += _DOUBLE.pack(value)
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            out.append(T_BYTES)
+            _varint(out, len(value))
+            out += value
+        else:
+            raise TypeError(f"cannot pack {type(value).__name__}")
+
+    def decode(self, data):
+        data = bytes(data)
+        try:
+            count, pos = _read_varint(data, 0)
+            ids = []
+            if count:
+                table, pos = _read_string(data, pos)
+                ids = list(map(sys.intern, table.split('\0')))
+                if len(ids) != count:
+                    raise CodecError("bad id table")
+            value, pos = self._read(data, pos, ids, 0)
+        except IndexError:
+            raise CodecError("truncated message")
+        if pos != len(data):
+            raise CodecError("trailing bytes")
+        return value
+
+    def _read(self, data, pos, ids, depth):
+        if depth > MAX_DEPTH:
+            raise CodecError("message nested too deeply")
+        tag = data[pos]
+        pos += 1
+        if tag == T_STR:
+            return _read_string(data, pos)
+        if tag == T_ID or tag == T_INT:
+            n = data[pos]
+            pos += 1
+            if n >= 0x80:
+                n, pos = _read_varint(data, pos - 1)
+            if tag == T_INT:
+                return (n >> 1 if not n & 1 else -(n >> 1) - 1), pos
+            if n >= len(ids):
+                raise CodecError("bad id reference")
+            return ids[n], pos
+        if tag == T_IDS:
+            count, pos = _read_varint(data, pos)
+            width = data[pos]
+            fmt = _INDEX_FORMATS.get(width)
+            end = pos + 1 + count * width
+            if fmt is None or end > len(data):
+                raise CodecError("bad id list")
+            try:
+                result = [ids[index] for index in struct.unpack_from(f'!{count}{fmt}', data, pos + 1)]
+            except IndexError:
+                raise CodecError("bad id reference")
+            return result, end
+        if tag == T_DICT:
+            count, pos = _read_varint(data, pos)
+            result = {}
+            for _ in range(count):
+                code = data[pos]
+                pos += 1
+                if code == 0:
+                    key, pos = _read_string(data, pos)
+                elif code < len(KEYS):
+                    key = KEYS[code]
+                else:
+                    raise CodecError(f"unknown key {code}")
+                result[key], pos = self._read(data, pos, ids, depth + 1)
+            return result, pos
+        if tag == T_TYPE:
+            code = data[pos]
+            if not 0 < code < len(TYPES):
+                raise CodecError(f"unknown type {code}")
+            return TYPES[code], pos + 1
+        if tag == T_NONE:
+            return None, pos
+        if tag == T_TRUE:
+            return True, pos
+        if tag == T_FALSE:
+            return False, pos
+        if tag == T_LIST:
+            count, pos = _read_varint(data, pos)
+            if count > len(data) - pos:
+                raise CodecError("list longer than frame")
+            result = []
+            for _ in range(count):
+                item, pos = self._read(data, pos, ids, depth + 1)
+                result.append(item)
+            return result, pos
+        if tag == T_FLOAT:
+            if pos + 8 > len(data):
+                raise CodecError("truncated field")
+            return _DOUBLE.unpack_from(data, pos)[0], pos + 8
+        if tag == T_BYTES:
+            size, pos = _read_varint(data, pos)
+            if pos + size > len(data):
+                raise CodecError("truncated field")
+            return data[pos:pos + size], pos + size
+        raise CodecError(f"unknown tag {tag}")
+
+
+JSON = JsonCodec()
+PACKED = PackedCodec()
+CODECS = {JSON.name: JSON, PACKED.name: PACKED}
+PREFERRED = (PACKED.name, JSON.name)  # 本端支持的格式，按优先顺序
+
+
+def codec_of(flags):
+    return PACKED if flags & FLAG_PACKED else JSON
+
+
+def negotiate(offered):
+    """对方在登录时列出的格式里选一个本端也支持的，优先 packed；没有列出时用 JSON"""
+    offered = offered or ()
+    for name in PREFERRED:
+        if name in offered:
+            return CODECS[name]
+    return JSON
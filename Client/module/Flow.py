@@ -0,0 +1,128 @@
+"""
+流量控制，客户端与服务端共用。
+
+消息按类型分成三类，各自有独立的令牌桶：
+    control  登录、心跳、进度回复、房间操作等，量小但不能被大流量挡住
+    text     用户发的文字和图片缩略图
+    bulk     文件传输
+每类同时限制每秒消息数和每秒字节数。服务端在 login_ack 里告诉客户端自己的限额，
+客户端按略低于限额的速度发送；超出时服务端暂停读这个连接，并发 flow 消息告诉客户端还要等多久。
+
+发送时另按优先级分成四条通道 control > text > image > bulk，两端的发送队列总是先发高优先级通道。
+image 和 bulk 通道的大帧切成 FRAGMENT_SIZE 的分片（见 Framing.KIND_FRAGMENT），每发完一片就回头检查高优先级通道，
+所以上传大文件时文字消息最多多等一个分片。
+"""
+import socket
+import threading
+import time
+
+CONTROL = 'control'
+TEXT = 'text'
+BULK = 'bulk'
+TRAFFIC_CLASSES = (CONTROL, TEXT, BULK)
+
+_CLASS_OF = {
+    'text': TEXT,
+    'image': TEXT,
+    'file_header': BULK,
+    'file_chunk': BULK,
+    'file_finish': BULK,
+}
+
+PACE_MARGIN = 0.95  # 客户端按服务端限额的这个比例发送，避免刚好踩线被暂停
+
+# 发送通道，数字小的优先
+LANE_CONTROL, LANE_TEXT, LANE_IMAGE, LANE_BULK = range(4)
+LANES = (LANE_CONTROL, LANE_TEXT, LANE_IMAGE, LANE_BULK)
+_LANE_OF = {
+    'text': LANE_TEXT,
+    'image': LANE_IMAGE,
+    'file_header': LANE_BULK,
+    'file_chunk': LANE_BULK,
+    'file_finish': LANE_BULK,
+}
+FRAGMENT_SIZE = 32 * 1024  # image、bulk 通道的大帧按这个大小分片
+# 内核发送缓冲区里未发出的数据超过这个量时 socket 不再可写，排在后面的高优先级帧不会被大量已写入的分片挡住
+NOTSENT_LOWAT = 64 * 1024
+_TCP_NOTSENT_LOWAT = getattr(socket, 'TCP_NOTSENT_LOWAT', None)
+
+
+def traffic_class(msg_type):
+    return _CLASS_OF.get(msg_type, CONTROL)
+
+
+def lane_of(msg_type, hint=LANE_CONTROL):
+    """
+    消息走哪条通道。图片原图的文件帧由发送方在帧头标成 image 通道（hint），
+    只允许从 bulk 提到 image，不能借此插到文字消息前面
+    """
+    lane = _LANE_OF.get(msg_type, LANE_CONTROL)
+    if lane == LANE_BULK and hint == LANE_IMAGE:
+        return LANE_IMAGE
+    return lane
+
+
+def limit_unsent(sock):
+    """设置 TCP_NOTSENT_LOWAT，平台不支持时什么也不做"""
+    if _TCP_NOTSENT_LOWAT is None:
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, _TCP_NOTSENT_LOWAT, NOTSENT_LOWAT)
+    except OSError:
+        pass
+
+
+class TokenBucket:
+    """
+    令牌桶。请求总是被记账，令牌不够时桶变成负数（欠账），返回需要等待的秒数，
+    所以超过 burst 的大帧也能通过，只是要等得更久。
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def take(self, amount, now) -> float:
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class Pacer:
+    """
+    客户端的发送节流，多个发送线程共用。
+    configure 设置速率（来自 login_ack），hold 处理服务端的 flow 消息；速率为空时不限速。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._messages = None
+        self._bytes = None
+        self._until = 0.0  # 服务端要求暂停到这个时间
+
+    def configure(self, messages_per_sec, bytes_per_sec):
+        now = time.monotonic()
+        with self._lock:
+            self._messages = TokenBucket(messages_per_sec * PACE_MARGIN, messages_per_sec, now) \
+                if messages_per_sec else None
+            self._bytes = TokenBucket(bytes_per_sec * PACE_MARGIN, bytes_per_sec, now) if bytes_per_sec else None
+
+    def hold(self, seconds):
+        with self._lock:
+            self._until = max(self._until, time.monotonic() + seconds)
+
+    def wait(self, nbytes):
+        """发送一条 nbytes 的消息前调用，需要时睡眠"""
+        with self._lock:
+            now = time.monotonic()
+            delay = self._until - now
+            if self._messages is not None:
+                delay = max(delay, self._messages.take(1, now))
+            if self._bytes is not None:
+                delay = max(delay, self._bytes.take(nbytes, now))
+        if delay > 0:
+            time.sleep(delay)
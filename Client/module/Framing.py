@@ -0,0 +1,416 @@
+"""
+长度前缀的二进制帧格式，客户端与服务端共用。
+
+帧结构（大端）：
+    magic(1) | version(1) | kind(1) | flags(1) | meta_len(2) | body_len(4) | meta | body
+
+meta 为可选的路由头，body 为消息体；两者都是 JSON 时解析结果会合并成一条消息。
+KIND_BINARY 帧的 body 是原始字节（文件分片），meta 仍是 JSON 路由头。
+flags 带 FLAG_ZLIB 时 body 是压缩过的（meta 不压缩，服务端转发仍然只看 meta），登录时协商后才会使用；
+路由头本身很大时（例如 user_list）不单独放 meta，整条消息进 body 一起压缩。
+flags 带 FLAG_PACKED 时 meta 和 body 用紧凑的二进制编码而不是 JSON，见 Codec，同样需要登录时协商。
+flags 的 LANE_MASK 两位是发送方给的通道（见 Flow），接收方不关心，服务端据此把图片原图的分片排进 image 通道。
+KIND_FRAGMENT 帧的 body 是另一个完整帧的一段字节，同一通道的分片按顺序拼起来就是原来的帧，
+除最后一片外都带 FLAG_MORE；只发给登录时声明支持 lanes 的一端。
+旧版客户端直接发送裸 JSON 流，FrameDecoder 会根据首字节自动区分两种格式，
+因此同一条连接上新旧格式可以混用，登录协商完成前后都不会丢数据。
+"""
+import base64
+import json
+import struct
+import zlib
+
+from .Codec import CodecError, JSON, codec_of
+
+MAGIC = 0xC7
+VERSION = 1
+HEADER = struct.Struct('!BBBBHI')
+
+KIND_JSON = 0
+KIND_BINARY = 1  # body 为原始字节，服务端原样转发
+KIND_FRAGMENT = 2  # body 是一个大帧的一段，接收方拼好后再解析
+
+FLAG_ZLIB = 0x01  # body 用 raw deflate 加预置字典压缩
+FLAG_MORE = 0x04  # 分片帧：同一通道后面还有分片
+LANE_SHIFT = 4
+LANE_MASK = 0x30
+COMPRESS_MIN = 256  # body 小于这个字节数时不压缩，压缩头和 CPU 开销不划算
+COMPRESS_LEVEL = 6
+# 内容本身已经是压缩数据（JPEG/PNG 的 base64、文件分片）的消息类型不压缩
+INCOMPRESSIBLE_TYPES = ('image', 'file_chunk')
+# 预置字典：消息体里常见的键和值，越常见的越靠后
+ZDICT = (b'"chunk_size": 524288, "binary_file": true, "frame": 1, "cursor": null, "done": false, "final": false, '
+         b'"have": [[0, ], "transfer_id": "", "image_id": "", "offset": , "crc": , "filesize": , "filename": "", '
+         b'"join_room", "create_room", "user_list", "history", "login", "logout", "file_header", "file_finish", '
+         b'{"type": "image", "private": true, "from_id": "", "to_id": "", "content": ""}, '
+         b'{"type": "text", "private": false, "from_id": "", "to_id": "", "content": ""}, '
+         b'"content": "\u')
+
+# 服务端转发只需要这几个字段，编码时放进 meta，转发时不必解析整个消息体
+ROUTE_KEYS = ('type', 'private', 'from_id', 'to_id')
+
+MAX_FRAME = 64 * 1024 * 1024  # 单帧上限，防止恶意长度耗尽内存
+RECV_SIZE = 64 * 1024  # 接收缓冲区每次至少留出的空间
+
+_WHITESPACE = b' \t\r\n'
+_PARTIAL = object()  # FrameDecoder._next：收到的是分片，原帧还没收全
+
+
+class FrameError(ValueError):
+    """帧格式错误，连接应当被关闭"""
+
+
+def encode_frame(body: bytes, meta: bytes = b'', kind=KIND_JSON, flags=0) -> bytes:
+    return HEADER.pack(MAGIC, VERSION, kind, flags, len(meta), len(body)) + meta + body
+
+
+def deflate(body) -> bytes:
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=ZDICT)
+    return compressor.compress(body) + compressor.flush()
+
+
+def inflate(body) -> bytes:
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=ZDICT)
+    try:
+        data = decompressor.decompress(body, MAX_FRAME)
+    except zlib.error as e:
+        raise FrameError(f"bad compressed body: {e}")
+    if decompressor.unconsumed_tail:
+        raise FrameError("compressed body too large")
+    return data
+
+
+def compress_body(body, msg_type):
+    """需要压缩且压缩后确实变小时返回 (压缩后的 body, FLAG_ZLIB)，否则原样返回"""
+    if len(body) < COMPRESS_MIN or msg_type in INCOMPRESSIBLE_TYPES:
+        return body, 0
+    compressed = deflate(body)
+    if len(compressed) >= len(body) * 0.9:
+        return body, 0
+    return compressed, FLAG_ZLIB
+
+
+def encode_message(msg: dict, compress=False, codec=JSON, lane=0) -> bytes:
+    """把消息编码成帧，路由字段单独放在 meta 里；compress 为 True 时按需压缩 body"""
+    try:
+        return _encode_message(msg, compress, codec, lane)
+    except (ValueError, TypeError):
+        if codec is JSON:
+            raise
+        # packed 表示不了的值（超过 62 位的整数、嵌套太深）这一帧改用 JSON，帧头的 flags 标明了编码
+        return _encode_message(msg, compress, JSON, lane)
+
+
+def _encode_message(msg, compress, codec, lane):
+    meta = {key: msg[key] for key in ROUTE_KEYS if key in msg}
+    body = {key: value for key, value in msg.items() if key not in meta}
+    meta_bytes = codec.encode(meta)
+    if len(meta_bytes) > 0xFFFF:
+        # 例如成员很多的 create_room，路由头放不下就整体放进 body
+        meta, meta_bytes, body = {}, b'', msg
+    body_bytes = codec.encode(body) if body else b''
+    flags = 0
+    if compress and len(meta_bytes) >= COMPRESS_MIN:
+        # meta 不压缩；路由头很大（例如 user_list 的整页用户名）时整条消息放进 body 一起压缩，
+        # 没有 meta 的帧解析 route 时会退化为完整消息
+        whole, flags = compress_body(codec.encode(msg), msg.get('type'))
+        if flags:
+            return encode_frame(whole, b'', flags=flags | codec.flag | lane << LANE_SHIFT)
+    if compress:
+        body_bytes, flags = compress_body(body_bytes, msg.get('type'))
+    return encode_frame(body_bytes, meta_bytes, flags=flags | codec.flag | lane << LANE_SHIFT)
+
+
+def encode_legacy(msg: dict) -> bytes:
+    """旧版裸 JSON 流格式"""
+    return json.dumps(msg).encode('utf-8')
+
+
+def binary_header(meta: dict, body_len, codec=JSON, lane=0) -> bytes:
+    """二进制帧的帧头加 meta，body 由调用方随后直接写入 socket"""
+    try:
+        meta_bytes = codec.encode(meta)
+    except (ValueError, TypeError):
+        if codec is JSON:
+            raise
+        codec = JSON
+        meta_bytes = codec.encode(meta)
+    flags = codec.flag | lane << LANE_SHIFT
+    return HEADER.pack(MAGIC, VERSION, KIND_BINARY, flags, len(meta_bytes), body_len) + meta_bytes
+
+
+def fragment_header(lane, length, more) -> bytes:
+    """分片帧的帧头，随后是 length 字节的原帧数据"""
+    return HEADER.pack(MAGIC, VERSION, KIND_FRAGMENT, lane << LANE_SHIFT | (FLAG_MORE if more else 0), 0, length)
+
+
+def send_file_frame(sock, meta: dict, file, offset, count, codec=JSON):
+    """
+    把文件的一段作为二进制帧发送。
+    阻塞 socket 上 socket.sendfile 会走 os.sendfile，数据不经过用户态；不支持时自动退回 send。
+    """
+    sock.sendall(binary_header(meta, count, codec))
+    sent = sock.sendfile(file, offset, count)
+    if sent != count:
+        raise OSError(f"sendfile sent {sent} of {count} bytes")
+
+
+def decode_frame(raw: bytes):
+    """解析一段恰好是一个完整帧的字节"""
+    _, version, kind, flags, meta_len, body_len = HEADER.unpack_from(raw)
+    if version > VERSION:
+        raise FrameError(f"unsupported frame version {version}")
+    view = memoryview(raw)
+    meta = view[HEADER.size:HEADER.size + meta_len]
+    body = view[HEADER.size + meta_len:HEADER.size + meta_len + body_len]
+    return Frame(kind, flags, bytes(meta), body, raw)
+
+
+class Frame:
+    """一个完整的帧，消息内容在第一次访问时才解析"""
+    __slots__ = ('kind', 'flags', 'meta', 'body', 'raw', '_message', '_route', '_encoded', '_plain')
+
+    def __init__(self, kind, flags, meta, body, raw, message=None):
+        self.kind = kind
+        self.flags = flags
+        self.meta = meta
+        self.body = body
+        self.raw = raw
+        self._message = message
+        self._route = None
+        self._encoded = {}
+        self._plain = None  # 解压后的 body
+
+    def _decode(self, data):
+        try:
+            return codec_of(self.flags).decode(data)
+        except CodecError as e:
+            raise FrameError(str(e))
+
+    @classmethod
+    def from_message(cls, msg: dict):
+        """服务端自己产生的消息，编码一次后按帧转发"""
+        frame = decode_frame(encode_message(msg))
+        frame._message = msg
+        return frame
+
+    @property
+    def legacy(self):
+        return self.raw is None
+
+    @property
+    def route(self) -> dict:
+        """只解析路由字段；没有 meta 的帧（包括旧格式）退化为完整消息"""
+        if self._route is None:
+            self._route = self._decode(self.meta) if self.meta else self.message
+        return self._route
+
+    @property
+    def message(self) -> dict:
+        """完整消息；二进制帧的 body 放在 'data' 字段里"""
+        if self._message is None:
+            msg = self._decode(self.meta) if self.meta else {}
+            if self.kind == KIND_BINARY:
+                msg['data'] = self.body
+            elif self.body:
+                msg.update(self._decode(self.plain_body))
+            self._message = msg
+        return self._message
+
+    @property
+    def codec(self):
+        return codec_of(self.flags)
+
+    @property
+    def lane(self):
+        """发送方在帧头里给的通道"""
+        return (self.flags & LANE_MASK) >> LANE_SHIFT
+
+    @property
+    def compressed(self):
+        return bool(self.flags & FLAG_ZLIB)
+
+    @property
+    def plain_body(self) -> bytes:
+        if self._plain is None:
+            self._plain = inflate(self.body) if self.compressed else bytes(self.body)
+        return self._plain
+
+    def json_message(self) -> dict:
+        """可以 JSON 序列化的消息，二进制 body 转成旧版的 base64 content"""
+        if self.kind != KIND_BINARY:
+            return self.message
+        msg = self._decode(self.meta)
+        msg['content'] = base64.b64encode(self.body).decode('utf-8')
+        return msg
+
+    def encoded(self, framed, binary=True, compress=False, codec=JSON) -> bytes:
+        """
+        转发用的字节。收到的是帧且对方也能解析这种帧、编码格式也相同时直接复用原始字节，
+        否则每种格式只编码一次（包括压缩），所有接收者共享同一份缓冲区。
+        compress 表示对方协商过压缩：已压缩的帧原样转发，未压缩的按需压缩；
+        对方不支持压缩时已压缩的帧解压一次后转发。
+        """
+        if framed and self.raw is not None and (binary or self.kind != KIND_BINARY) and self.codec is codec:
+            if self.compressed:
+                if compress:
+                    return self.raw
+            elif not compress or self.kind == KIND_BINARY:
+                return self.raw
+        key = (compress, codec.name, binary or self.kind != KIND_BINARY) if framed else False
+        data = self._encoded.get(key)
+        if data is None:
+            data = self._encode(framed, binary, compress, codec)
+            self._encoded[key] = data
+        return data
+
+    def _encode(self, framed, binary, compress, codec):
+        if not framed:
+            return encode_legacy(self.json_message())
+        if self.kind == KIND_BINARY and binary and self.raw is not None:
+            # 只换 meta 的编码，文件数据不动
+            return binary_header(self.route, len(self.body), codec, self.lane) + bytes(self.body)
+        if self.raw is None or self.kind == KIND_BINARY or self.codec is not codec:
+            return encode_message(self.json_message(), compress, codec)
+        # 收到的 JSON 帧只换 body 的压缩方式，meta 不动
+        body, flags = self.plain_body, 0
+        if compress:
+            body, flags = compress_body(body, self.route.get('type'))
+            if not flags and not self.compressed:
+                return self.raw  # 不值得压缩
+        return encode_frame(body, self.meta, self.kind, (self.flags & ~FLAG_ZLIB) | flags)
+
+
+class FrameDecoder:
+    """
+    增量解码器，接口与 asyncio.BufferedProtocol 一致：
+    get_buffer 返回预分配缓冲区的空闲部分供 recv_into 直接写入，buffer_updated 提交并返回已完整的帧。
+    帧头到达后缓冲区会一次扩到整帧大小，每个帧只在完整到达后解析一次。
+    """
+
+    def __init__(self, size=RECV_SIZE):
+        self._buf = bytearray(size)
+        self._start = 0
+        self._end = 0
+        self._need = 0  # 当前未完整的帧还需要的总长度
+        self._json = json.JSONDecoder()
+        self._fragments = {}  # 通道 -> 已收到的分片拼成的 bytearray
+
+    @property
+    def capacity(self):
+        """当前接收缓冲区的大小"""
+        return len(self._buf)
+
+    def get_buffer(self, sizehint=RECV_SIZE) -> memoryview:
+        self._reserve(max(sizehint, self._need - (self._end - self._start)))
+        return memoryview(self._buf)[self._end:]
+
+    def buffer_updated(self, nbytes) -> list:
+        self._end += nbytes
+        frames = []
+        while True:
+            frame = self._next()
+            if frame is None:
+                break
+            if frame is not _PARTIAL:
+                frames.append(frame)
+        if self._start == self._end:
+            self._start = self._end = 0
+        return frames
+
+    def feed(self, data) -> list:
+        """直接喂入已收到的数据"""
+        self._reserve(len(data))
+        self._buf[self._end:self._end + len(data)] = data
+        return self.buffer_updated(len(data))
+
+    def recv_from(self, sock) -> list:
+        """从阻塞 socket 读一次；对端关闭时返回 None"""
+        with self.get_buffer() as view:
+            nbytes = sock.recv_into(view)
+        if not nbytes:
+            return None
+        return self.buffer_updated(nbytes)
+
+    def _reserve(self, size):
+        pending = self._end - self._start
+        if self._end + size <= len(self._buf):
+            return
+        if pending + size <= len(self._buf):
+            # 把未处理的数据挪到开头
+            self._buf[:pending] = self._buf[self._start:self._end]
+        else:
+            # 不在原缓冲区上 resize，避免调用方仍持有 memoryview 时出错
+            buf = bytearray(pending + size)
+            buf[:pending] = self._buf[self._start:self._end]
+            self._buf = buf
+        self._start = 0
+        self._end = pending
+
+    def _next(self):
+        buf = self._buf
+        # 跳过帧之间的空白（旧格式常见）
+        while self._start < self._end and buf[self._start] in _WHITESPACE:
+            self._start += 1
+        start = self._start
+        available = self._end - start
+        if not available:
+            return None
+
+        if buf[start] != MAGIC:
+            return self._next_legacy()
+
+        if available < HEADER.size:
+            return None
+        _, version, kind, flags, meta_len, body_len = HEADER.unpack_from(buf, start)
+        if version > VERSION:
+            raise FrameError(f"unsupported frame version {version}")
+        total = HEADER.size + meta_len + body_len
+        if total > MAX_FRAME:
+            raise FrameError(f"frame too large: {total}")
+        if available < total:
+            self._need = total
+            return None
+
+        self._need = 0
+        self._start += total
+        if kind == KIND_FRAGMENT:
+            return self._fragment(flags, memoryview(buf)[start + HEADER.size + meta_len:start + total])
+        return decode_frame(bytes(buf[start:start + total]))
+
+    def _fragment(self, flags, data):
+        """拼接一个分片；原帧还没收全时返回 _PARTIAL"""
+        lane = (flags & LANE_MASK) >> LANE_SHIFT
+        parts = self._fragments.get(lane)
+        if parts is None:
+            parts = self._fragments[lane] = bytearray()
+        parts += data
+        if len(parts) > MAX_FRAME:
+            raise FrameError("fragmented frame too large")
+        if flags & FLAG_MORE:
+            return _PARTIAL
+        del self._fragments[lane]
+        if len(parts) < HEADER.size:
+            raise FrameError("truncated fragmented frame")
+        magic, _, kind, _, meta_len, body_len = HEADER.unpack_from(parts)
+        if magic != MAGIC or kind == KIND_FRAGMENT or HEADER.size + meta_len + body_len != len(parts):
+            raise FrameError("bad fragmented frame")
+        return decode_frame(bytes(parts))
+
+    def _next_legacy(self):
+        data = bytes(self._buf[self._start:self._end])
+        try:
+            text = data.decode('utf-8')
+        except UnicodeDecodeError as e:
+            # 末尾是被截断的多字节字符，或后面紧跟着二进制帧，只解析前面完整的部分
+            text = data[:e.start].decode('utf-8')
+
+        try:
+            obj, idx = self._json.raw_decode(text)
+        except json.JSONDecodeError:
+            if len(data) > MAX_FRAME:
+                raise FrameError("legacy message too large")
+            return None
+
+        self._start += len(text[:idx].encode('utf-8'))
+        return Frame(KIND_JSON, 0, b'', b'', None, obj)
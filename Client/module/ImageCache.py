@@ -0,0 +1,175 @@
+"""
+图片解码和缓存。
+
+聊天图片的 base64 解码、解码和缩放都放到线程池里用 QImage 完成，结果通过信号回到 GUI 线程；
+缩放好的 QPixmap 和头像放在一个按字节数限制大小的 LRU 缓存里，键为内容哈希（头像为路径）和目标尺寸。
+发送图片前的压缩和缩略图也在这里，由发送线程调用。
+"""
+import base64
+import collections
+import hashlib
+import os
+
+from PySide6.QtCore import Qt, QObject, QRunnable, QThreadPool, QBuffer, QByteArray, QSize, Signal
+from PySide6.QtGui import QImage, QImageReader, QPixmap, QPainter, QPainterPath
+
+CACHE_BYTES = 64 * 1024 * 1024  # 缓存的像素数据上限
+SEND_MAX_SIZE = 1920  # 发送前把图片最长边压到这个尺寸以内
+SEND_QUALITY = 85  # 重新压缩的质量 (0-100)
+THUMB_SIZE = 300  # 先行发送的缩略图最长边，与聊天气泡里的显示尺寸一致
+THUMB_QUALITY = 70
+
+
+class PixmapCache:
+    """按字节数限制大小的 LRU 缓存，只在 GUI 线程使用"""
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.items = collections.OrderedDict()  # key -> QPixmap，按最近使用排序
+        self.bytes = 0
+
+    @staticmethod
+    def cost(pixmap: QPixmap):
+        return pixmap.width() * pixmap.height() * max(pixmap.depth(), 8) // 8
+
+    def get(self, key):
+        pixmap = self.items.get(key)
+        if pixmap is not None:
+            self.items.move_to_end(key)
+        return pixmap
+
+    def put(self, key, pixmap: QPixmap):
+        old = self.items.pop(key, None)
+        if old is not None:
+            self.bytes -= self.cost(old)
+        self.items[key] = pixmap
+        self.bytes += self.cost(pixmap)
+        while self.bytes > self.max_bytes and len(self.items) > 1:
+            _, evicted = self.items.popitem(last=False)
+            self.bytes -= self.cost(evicted)
+
+
+pixmap_cache = PixmapCache()
+
+
+def image_key(digest, size):
+    return 'img', digest, size
+
+
+def avatar_pixmap(path, size) -> QPixmap:
+    """裁成圆形的头像，同一个文件同一尺寸只从磁盘读一次"""
+    key = ('avatar', path, size)
+    avatar = pixmap_cache.get(key)
+    if avatar is None:
+        source = QPixmap(path).scaled(size, size, Qt.AspectRatioMode.KeepAspectRatioByExpanding,
+                                      Qt.TransformationMode.SmoothTransformation)
+        avatar = QPixmap(size, size)
+        avatar.fill(Qt.GlobalColor.transparent)
+        painter = QPainter(avatar)
+        painter.setRenderHints(QPainter.RenderHint.Antialiasing | QPainter.RenderHint.SmoothPixmapTransform)
+        clip = QPainterPath()
+        clip.addEllipse(0, 0, size, size)
+        painter.setClipPath(clip)
+        painter.drawPixmap((size - source.width()) // 2, (size - source.height()) // 2, source)
+        painter.end()
+        pixmap_cache.put(key, avatar)
+    return avatar
+
+
+def decode_image(data: bytes, max_size) -> QImage:
+    """
+    解码并缩小到 max_size 以内。先只读文件头拿到原始尺寸，
+    JPEG 等格式可以直接按目标尺寸解码，不用先生成整张大图。
+    """
+    buffer = QBuffer()
+    buffer.setData(QByteArray(data))
+    buffer.open(QBuffer.OpenModeFlag.ReadOnly)
+    reader = QImageReader(buffer)
+    reader.setAutoTransform(True)
+    size = reader.size()
+    if size.isValid() and (size.width() > max_size or size.height() > max_size):
+        reader.setScaledSize(size.scaled(QSize(max_size, max_size), Qt.AspectRatioMode.KeepAspectRatio))
+    image = reader.read()
+    if not image.isNull() and (image.width() > max_size or image.height() > max_size):
+        # 不支持按尺寸解码的格式在这里补一次缩放
+        image = image.scaled(max_size, max_size, Qt.AspectRatioMode.KeepAspectRatio,
+                             Qt.TransformationMode.SmoothTransformation)
+    return image
+
+
+def encode_image(image: QImage, fmt, quality) -> bytes:
+    data = QByteArray()
+    buffer = QBuffer(data)
+    buffer.open(QBuffer.OpenModeFlag.WriteOnly)
+    image.save(buffer, fmt, quality)
+    return bytes(data)
+
+
+def prepare_image(path, max_size=SEND_MAX_SIZE, quality=SEND_QUALITY):
+    """
+    发送前处理图片，返回 (缩略图 base64, 要发送的原图字节, 扩展名)。
+    原图最长边超过 max_size 时缩小后按 quality 重新压缩；本来就不大的图片取原文件和重新压缩中较小的一个。
+    带透明通道的图片用 PNG，其余用 JPEG。
+    """
+    reader = QImageReader(path)
+    reader.setAutoTransform(True)
+    image = reader.read()
+    if image.isNull():
+        raise ValueError(f"无法读取图片: {reader.errorString()}")
+
+    fmt, ext = ('PNG', '.png') if image.hasAlphaChannel() else ('JPG', '.jpg')
+    if image.width() > max_size or image.height() > max_size:
+        scaled = image.scaled(max_size, max_size, Qt.AspectRatioMode.KeepAspectRatio,
+                              Qt.TransformationMode.SmoothTransformation)
+        data = encode_image(scaled, fmt, quality)
+    else:
+        data = encode_image(image, fmt, quality)
+        with open(path, 'rb') as f:
+            original = f.read()
+        if len(original) <= len(data):
+            data, ext = original, os.path.splitext(path)[1].lower() or ext
+
+    thumb = image
+    if image.width() > THUMB_SIZE or image.height() > THUMB_SIZE:
+        thumb = image.scaled(THUMB_SIZE, THUMB_SIZE, Qt.AspectRatioMode.KeepAspectRatio,
+                             Qt.TransformationMode.SmoothTransformation)
+    thumb_b64 = base64.b64encode(encode_image(thumb, fmt, THUMB_QUALITY)).decode('utf-8')
+    return thumb_b64, data, ext
+
+
+class _DecodeTask(QRunnable):
+    def __init__(self, loader, token, content, max_size, path=None):
+        super().__init__()
+        self.loader = loader
+        self.token = token
+        self.content = content
+        self.max_size = max_size
+        self.path = path
+
+    def run(self):
+        try:
+            if self.path:
+                with open(self.path, 'rb') as f:
+                    data = f.read()
+            else:
+                data = base64.b64decode(self.content)
+        except (OSError, ValueError):
+            data = b''
+        digest = hashlib.sha1(data).hexdigest()
+        image = decode_image(data, self.max_size) if data else QImage()
+        self.loader.loaded.emit(self.token, digest, image)
+
+
+class ImageLoader(QObject):
+    """
+    在全局线程池里解码 base64 图片或本地图片文件。loaded 在 GUI 线程触发：(token, 内容哈希, 缩放后的 QImage)，
+    解码失败时 QImage 为空。
+    """
+    loaded = Signal(object, str, QImage)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool.globalInstance()
+
+    def load(self, token, content, max_size, path=None):
+        self.pool.start(_DecodeTask(self, token, content, max_size, path))
@@ -1,28 +1,195 @@
 import base64
-import os, socket, json, threading
-from PySide6.QtCore import QThread, Signal, QObject
+import collections
+import mmap
+import os, socket, threading, time, uuid, zlib
+from PySide6.QtCore import QThread, Signal, QObject, QSocketNotifier
+from module.Codec import CODECS, JSON, PREFERRED
+from module.Flow import BULK, FRAGMENT_SIZE, LANE_BULK, LANE_CONTROL, LANE_IMAGE, LANES, Pacer, lane_of, \
+    limit_unsent
+from module.Framing import FrameDecoder, FrameError, VERSION, binary_header, encode_message, encode_legacy, \
+    fragment_header
+from module.ImageCache import prepare_image, SEND_MAX_SIZE, SEND_QUALITY
+from module.Transfer import OutgoingState, make_transfer_id, chunk_count, CHUNK_SIZE, STREAMS, STATUS_TIMEOUT, \
+    FINISH_TIMEOUT, MAX_ROUNDS
+
+PING_INTERVAL = 15  # 心跳间隔（秒）
+PING_TIMEOUT = 45  # 服务器回复过 pong 后，超过这么久没有收到任何数据就认为连接已断开
+RECV_MIN = 16 * 1024  # 每次 recv_into 至少留出的空间，按实际读到的量在两者之间调整
+RECV_MAX = 1024 * 1024
+MAX_BATCH_FRAMES = 64  # control、text 通道一次合并发送的帧数上限
+DRAIN_TIMEOUT = 1.0  # 关闭连接前等待 control 通道发完的最长时间
+_HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')  # Windows 没有 sendmsg
+
+
+class LaneWriter:
+    """
+    客户端唯一的发送线程。各线程把编码好的帧放进 module.Flow 的优先级通道，这里总是先发高优先级的：
+    control、text 通道有数据时全部合并发出；否则从 image、bulk 通道取一个帧，
+    服务器支持分片时大帧每次只发 FRAGMENT_SIZE，发完回头再看高优先级通道。
+    所以上传文件时文字消息最多多等一个分片，不会排在整个文件分片后面。
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.cond = threading.Condition()
+        self.lanes = [collections.deque() for _ in LANES]  # 元素为 [缓冲区列表, Event 或 None, 错误, 已开始分片]
+        self.fragment = False  # 服务器在 login_ack 里确认能拼接分片
+        self.closed = False
+        self.error = None
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def enable_fragments(self):
+        with self.cond:
+            self.fragment = True
+        limit_unsent(self.sock)
+
+    def put(self, data, lane=LANE_CONTROL, wait=False):
+        """
+        data 是编码好的帧，或者依次拼起来是一个帧的缓冲区列表（帧头加 mmap 上的文件分片）。
+        wait 为 True 时等到全部写进 socket 才返回，之后调用方可以释放这些缓冲区；发送失败时抛出 OSError
+        """
+        item = [data if isinstance(data, list) else [data], threading.Event() if wait else None, None, False]
+        with self.cond:
+            if self.closed:
+                raise self.error
+            self.lanes[lane].append(item)
+            self.cond.notify()
+        if wait:
+            item[1].wait()
+            if item[2] is not None:
+                raise item[2]
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.closed and not any(self.lanes):
+                    self.cond.wait()
+                if self.closed:
+                    return
+                buffers, finished = self._take()
+            try:
+                self._send(buffers)
+            except OSError as e:
+                print(f"Send error: {e}")
+                self._fail(e, finished)
+                return
+            # 先放掉对缓冲区的引用，等待的线程随后会关闭 mmap
+            del buffers
+            for item in finished:
+                item[0] = None
+                if item[1] is not None:
+                    item[1].set()
+
+    def _take(self):
+        """在锁内取出这一次要发送的缓冲区，返回 (缓冲区列表, 已经全部取出的元素)"""
+        buffers = []
+        finished = []
+        for lane in LANES[:LANE_IMAGE]:
+            queue = self.lanes[lane]
+            while queue and len(finished) < MAX_BATCH_FRAMES:
+                item = queue.popleft()
+                buffers += item[0]
+                finished.append(item)
+        if buffers:
+            return buffers, finished
+
+        for lane in LANES[LANE_IMAGE:]:
+            queue = self.lanes[lane]
+            if not queue:
+                continue
+            item = queue[0]
+            size = sum(map(len, item[0]))
+            if not item[3] and (not self.fragment or size <= FRAGMENT_SIZE):
+                queue.popleft()
+                return item[0], [item]
+            # 切出一个分片，剩下的部分留在队首
+            item[3] = True
+            piece = self._split(item[0], FRAGMENT_SIZE)
+            more = size > FRAGMENT_SIZE
+            if not more:
+                queue.popleft()
+                finished.append(item)
+            return [fragment_header(lane, FRAGMENT_SIZE if more else size, more)] + piece, finished
+        return buffers, finished
+
+    @staticmethod
+    def _split(buffers, n) -> list:
+        """从缓冲区列表开头切下 n 字节，原列表里只留下剩余部分"""
+        head = []
+        while buffers and n:
+            buf = buffers[0]
+            if len(buf) <= n:
+                head.append(buffers.pop(0))
+                n -= len(buf)
+            else:
+                view = memoryview(buf)
+                head.append(view[:n])
+                buffers[0] = view[n:]
+                n = 0
+        return head
+
+    def _send(self, buffers):
+        if not _HAS_SENDMSG:
+            self.sock.sendall(b''.join(buffers))
+            return
+        buffers = [memoryview(b) for b in buffers]
+        while buffers:
+            sent = self.sock.sendmsg(buffers)
+            # 跳过已经发出的部分
+            while sent:
+                if sent >= len(buffers[0]):
+                    sent -= len(buffers[0])
+                    buffers.pop(0)
+                else:
+                    buffers[0] = buffers[0][sent:]
+                    sent = 0
+
+    def _fail(self, error, items=()):
+        with self.cond:
+            self.closed = True
+            self.error = error
+            items = list(items) + [item for queue in self.lanes for item in queue]
+            for queue in self.lanes:
+                queue.clear()
+            self.cond.notify_all()
+        for item in items:
+            item[0] = None
+            item[2] = error
+            if item[1] is not None:
+                item[1].set()
+
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        """等 control 通道里已经排队的帧（例如 logout）写进 socket，最多等 timeout 秒"""
+        item = [[], threading.Event(), None, False]
+        with self.cond:
+            if self.closed:
+                return
+            self.lanes[LANE_CONTROL].append(item)
+            self.cond.notify()
+        item[1].wait(timeout)
 
-msg_template = """{
-    "type": "message", 
-    "private": false,
-    "from_id": "UserA", 
-    "to_id": "UserB",
-    "content": ""
-}"""
+    def close(self):
+        self._fail(OSError("connection closed"))
 
 
 class SendWorker(QThread):
-    finished = Signal(str, str, bool)
+    sent = Signal(str, str, bool)  # 文件发送完成；QThread 自带的 finished 在线程退出时发出
+    lane = LANE_BULK
 
-    def __init__(self, sock, lock, file_path, to_id, from_id, is_private):
+    def __init__(self, writer, encode, file_path, to_id, from_id, is_private, binary=False, transfers=None,
+                 codec=JSON, pacer=None):
         super().__init__()
-        self.sock = sock
-        self.lock = lock  # 接收共享锁
+        self.writer = writer  # 共用的 LaneWriter
+        self.encode = encode  # 按协商结果编码消息
+        self.binary = binary  # 服务器支持时用二进制帧发送分片，不再 base64
+        self.codec = codec  # 二进制分片 meta 的编码
+        self.pacer = pacer  # 按服务器的 bulk 限额发送分片，见 module.Flow
         self.file_path = file_path
         self.to_id = to_id
         self.from_id = from_id
         self.is_private = is_private
-        self.chunk_size = 512 * 1024  # 512KB 分片大小
+        self.chunk_size = CHUNK_SIZE
+        self.transfers = transfers if transfers is not None else {}  # transfer_id -> OutgoingState，接收线程据此转发 file_status
 
     def run(self):
         try:
@@ -30,8 +197,30 @@ class SendWorker(QThread):
                 raise FileNotFoundError("文件不存在")
 
             file_name = os.path.basename(self.file_path)
-            file_size = os.path.getsize(self.file_path)
+            stat = os.stat(self.file_path)
+            transfer_id = make_transfer_id(self.from_id, self.to_id, self.file_path, stat.st_size, stat.st_mtime_ns)
+            with open(self.file_path, 'rb') as f:
+                if stat.st_size:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                        self.send_file(view, file_name, stat.st_size, transfer_id)
+                else:
+                    self.send_file(memoryview(b''), file_name, 0, transfer_id)
+            self.sent.emit(file_name, self.to_id, self.is_private)
+
+        except Exception as e:
+            print(str(e))
+            return
 
+    def send_file(self, view, file_name, file_size, transfer_id, extra=None):
+        """
+        按文件头、分片、结束包的顺序发送，extra 会附加到文件头和结束包上。
+        view 是文件数据的只读视图（通常是 mmap），分片直接从这里发送，不复制。
+        私聊且对方回复了 file_status 时跳过对方已有的分片、多线程乱序发送，结束后按对方的回复补发。
+        """
+        chunks = chunk_count(file_size, self.chunk_size)
+        state = OutgoingState(transfer_id, chunks)
+        self.transfers[transfer_id] = state
+        try:
             # 发送文件头
             header = {
                 'type': 'file_header',
@@ -40,152 +229,382 @@ class SendWorker(QThread):
                 'private': self.is_private,
                 'filename': file_name,
                 'filesize': file_size,
+                'transfer_id': transfer_id,
+                'chunk_size': self.chunk_size,
             }
+            if extra:
+                header.update(extra)
             self.send_safe(header)
 
-            # 循环发送分片
-            sent_size = 0
-            with open(self.file_path, 'rb') as f:
-                while True:
-                    chunk_data = f.read(self.chunk_size)
-                    if not chunk_data:
+            # 房间里可能有旧版客户端，只能按顺序发一遍
+            if self.is_private:
+                state.wait_status(0, STATUS_TIMEOUT)
+
+            for _ in range(MAX_ROUNDS):
+                todo = [index for index in range(chunks) if index not in state.have]
+                state.start_round(todo)
+                self.send_chunks(view, file_name, file_size, transfer_id, todo, state)
+
+                # 发送结束包
+                version = state.version
+                finish_msg = {
+                    'type': 'file_finish',
+                    'filename': file_name,
+                    'private': self.is_private,
+                    'to_id': self.to_id,
+                    'from_id': self.from_id,
+                    'transfer_id': transfer_id,
+                }
+                if extra:
+                    finish_msg.update(extra)
+                self.send_safe(finish_msg)
+
+                if not state.supported:
+                    return
+                # 等待接收方确认，回复里缺少的分片下一轮补发
+                while state.wait_status(version, FINISH_TIMEOUT):
+                    version = state.version
+                    if state.done:
+                        return
+                    if state.final:
                         break
+                else:
+                    raise TimeoutError(f"文件 {file_name} 等待对方确认超时")
+            raise IOError(f"文件 {file_name} 补发 {MAX_ROUNDS} 轮后仍不完整")
+        finally:
+            self.transfers.pop(transfer_id, None)
+
+    def send_chunks(self, view, file_name, file_size, transfer_id, todo, state):
+        """
+        发送 todo 里的分片。接收方支持乱序写入时用 STREAMS 个线程并行读取、计算校验和，
+        发送仍由 LaneWriter 逐帧进行；发送方领先接收方确认超过 WINDOW_CHUNKS 个分片时暂停。
+        """
+        streams = STREAMS if state.supported else 1
+        position = iter(enumerate(todo))
+        position_lock = threading.Lock()
+        errors = []
+
+        def stream():
+            try:
+                while not errors and not state.cancelled:
+                    with position_lock:
+                        item = next(position, None)
+                    if item is None:
+                        return
+                    pos, index = item
+                    if state.supported:
+                        state.wait_window(pos)
+                    offset = index * self.chunk_size
+                    count = min(self.chunk_size, file_size - offset)
+                    with view[offset:offset + count] as chunk:
+                        self.send_chunk(chunk, file_name, transfer_id, offset)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=stream, daemon=True) for _ in range(streams - 1)]
+        for thread in threads:
+            thread.start()
+        stream()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def send_chunk(self, chunk, file_name, transfer_id, offset):
+        meta = {
+            'type': 'file_chunk',
+            'private': self.is_private,
+            'from_id': self.from_id,
+            'to_id': self.to_id,
+            'filename': file_name,
+            'transfer_id': transfer_id,
+            'offset': offset,
+            'crc': zlib.crc32(chunk),
+        }
+        if self.pacer is not None:
+            # 在放进发送队列之前等待，限速期间文字消息仍然可以发出去
+            self.pacer.wait(len(chunk) if self.binary else len(chunk) * 4 // 3)
+        if self.binary:
+            # 二进制分片：帧头后直接跟 mmap 上的数据，不经过 base64 和 JSON
+            header = binary_header(meta, len(chunk), self.codec, self.lane)
+            self.writer.put([header, chunk], self.lane, wait=True)
+        else:
+            meta['content'] = base64.b64encode(chunk).decode('utf-8')
+            self.send_safe(meta)
 
-                    b64_str = base64.b64encode(chunk_data).decode('utf-8')
-                    chunk_msg = {
-                        'type': 'file_chunk',
-                        'to_id': self.to_id,
-                        'from_id': self.from_id,
-                        'private': self.is_private,
-                        'content': b64_str,
-                        'filename': file_name
-                    }
-
-                    # 发送分片 (需要加锁)
-                    self.send_safe(chunk_msg)
-
-                    # 更新进度
-                    # sent_size += len(chunk_data)
-                    # progress = int((sent_size / file_size) * 100)
-                    # print(progress)
-                    # self.progress_signal.emit(progress)
-
-                    # 可选：极短暂休眠防止占满带宽导致心跳包发不出去
-                    # self.msleep(5)
-
-            # 发送结束包
-            finish_msg = {
-                'type': 'file_finish',
-                'filename': file_name,
-                'private': self.is_private,
+    def send_safe(self, data):
+        """放进本传输的通道，等到发出后返回，发送线程因此不会比网络跑得更快"""
+        self.writer.put(self.encode(data, self.lane), self.lane, wait=True)
+
+
+class ImageSendWorker(SendWorker):
+    """
+    发送图片：先压缩原图并生成缩略图，缩略图作为 image 消息立即发出，
+    原图随后按文件分片发送，文件头和结束包带上 image_id 让接收方对应到这条图片消息。
+    都走 image 通道，帧头里标明，服务器转发时也排在普通文件前面。
+    """
+    lane = LANE_IMAGE
+
+    def __init__(self, writer, encode, file_path, to_id, from_id, is_private, binary=False, transfers=None,
+                 codec=JSON, pacer=None, max_size=SEND_MAX_SIZE, quality=SEND_QUALITY):
+        super().__init__(writer, encode, file_path, to_id, from_id, is_private, binary, transfers, codec, pacer)
+        self.max_size = max_size
+        self.quality = quality
+        self.image_id = uuid.uuid4().hex
+
+    def run(self):
+        try:
+            thumb, data, ext = prepare_image(self.file_path, self.max_size, self.quality)
+            file_name = self.image_id + ext
+
+            self.send_safe({
+                'type': 'image',
                 'to_id': self.to_id,
-                'from_id': self.from_id
-            }
-            self.send_safe(finish_msg)
-            self.finished.emit(file_name, self.to_id, self.is_private)
+                'from_id': self.from_id,
+                'private': self.is_private,
+                'content': thumb,
+                'image_id': self.image_id,
+                'filename': file_name,
+                'filesize': len(data),
+            })
+            self.send_file(memoryview(data), file_name, len(data), self.image_id, {'image_id': self.image_id})
 
         except Exception as e:
             print(str(e))
             return
 
-    def send_safe(self, data):
-        """线程安全的发送辅助函数"""
-        json_bytes = json.dumps(data).encode('utf-8')
 
-        with self.lock:
-            self.sock.send(json_bytes)
+class ReceiveWorker(QObject):
+    """
+    在接收线程的事件循环里用 QSocketNotifier 等待 socket 可读，每次可读只调用一次 recv_into，
+    socket 仍是阻塞的（LaneWriter 用阻塞的 sendmsg），但可读时这一次 recv 不会阻塞。
+    线程从不停在 recv 上，Listener.close 只需退出事件循环，不靠关闭 socket 让 recv 抛异常。
+    """
+
+    def __init__(self, sock, on_frames):
+        super().__init__()
+        self.sock = sock
+        self.on_frames = on_frames
+        self.decoder = FrameDecoder(RECV_MIN)
+        self.recv_size = RECV_MIN
+        self.notifier = None
+
+    def start(self):
+        # notifier 要在接收线程里创建
+        self.notifier = QSocketNotifier(self.sock.fileno(), QSocketNotifier.Type.Read, self)
+        self.notifier.activated.connect(self.on_readable)
+
+    def stop(self):
+        if self.notifier is not None:
+            self.notifier.setEnabled(False)
+        self.thread().quit()
+
+    def on_readable(self):
+        try:
+            # 解码器的缓冲区一直复用，帧头到达后按整帧大小一次扩容
+            with self.decoder.get_buffer(self.recv_size) as view:
+                nbytes = self.sock.recv_into(view)
+            if not nbytes:
+                print("stop")
+                self.stop()
+                return
+            frames = self.decoder.buffer_updated(nbytes)
+        except FrameError as e:
+            print(f"Protocol error in receive: {e}")
+            self.stop()
+            return
+        except OSError as e:
+            print(f"Error in receive: {e}")
+            self.stop()
+            return
+
+        # 读满了说明数据还多，下次多留空间；连续读得很少就缩回去
+        if nbytes >= self.recv_size:
+            self.recv_size = min(self.recv_size * 2, RECV_MAX)
+        elif nbytes < self.recv_size // 4:
+            self.recv_size = max(self.recv_size // 2, RECV_MIN)
+
+        if frames:
+            self.on_frames(frames)
 
 
 class Listener(QObject):
     file_finished = Signal(str, str, bool)
 
-    def __init__(self, ip, port, name):
+    def __init__(self, ip, port, name, image_max_size=SEND_MAX_SIZE, image_quality=SEND_QUALITY):
         super().__init__()
         self.name = name
-        self.isrun = True
+        self.image_max_size = image_max_size  # 发送图片前的最长边和压缩质量
+        self.image_quality = image_quality
         self.listener = socket.socket()
         self.listener.connect((ip, port))
-        self.send_lock = threading.Lock()
-
-        self.worker = None
+        self.writer = LaneWriter(self.listener)  # 所有发送都经过它，按通道优先级发出
+        self.framed = False  # 服务器确认支持帧格式后才切换
+        self.binary_file = False  # 服务器确认后文件分片改用二进制帧
+        self.compress = False  # 服务器确认后较大的文本消息压缩发送
+        self.codec = JSON  # 服务器确认后改用协商的编码，见 module.Codec
+        self.pacer = Pacer()  # 文件分片的发送节流，速度来自 login_ack 和 flow 消息
+
+        self.workers = set()  # 正在运行的发送线程，线程退出前必须一直持有引用
+        self.receive_thread = None
+        self.receiver = None
+        self.handle_func = None
+        self.transfers = {}  # 正在发送的文件 transfer_id -> OutgoingState
+
+        # 心跳：定时发 ping，服务器回复过 pong 才检查超时，旧版服务器不回复也不会被误判为断开
+        self.last_received = time.monotonic()
+        self.server_heartbeat = False
+        self.stop_event = threading.Event()
+        threading.Thread(target=self.heartbeat_loop, daemon=True).start()
+
+    def encode(self, msg, lane=LANE_CONTROL):
+        return encode_message(msg, self.compress, self.codec, lane) if self.framed else encode_legacy(msg)
+
+    def send_control(self, msg):
+        try:
+            self.writer.put(self.encode(msg), lane_of(msg['type']))
+        except OSError as e:
+            print(f"Send control error: {e}")
+
+    def heartbeat_loop(self):
+        while not self.stop_event.wait(PING_INTERVAL):
+            if self.server_heartbeat and time.monotonic() - self.last_received > PING_TIMEOUT:
+                # 半开连接上 recv 不会返回，关闭读端让接收线程退出
+                print("Heartbeat timeout")
+                try:
+                    self.listener.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                return
+            self.send_control({'type': 'ping'})
 
     def send_login(self, name):
-        # 登录
+        # 登录，同时告诉服务器本端支持的帧版本、压缩方式、消息编码、在线状态增量和分片
         self.name = name
-        self.send_msg(to_id="All", msg_type="login", content="")
-
-    def receive_msg(self, handle_func):
-        decoder = json.JSONDecoder()
-        buffer = ""
-
-        while self.isrun:
+        self.send_msg(to_id="All", msg_type="login", content="",
+                      extra={'frame': VERSION, 'binary_file': True, 'compress': ['zlib'], 'codecs': list(PREFERRED),
+                             'presence': True, 'lanes': True})
+
+    def start_receiving(self, handle_func):
+        """
+        启动接收线程。handle_func 在接收线程里调用，参数是一次读到的所有消息，
+        控制消息（login_ack、心跳、文件进度）已经在这里处理掉。
+        """
+        self.handle_func = handle_func
+        self.receive_thread = QThread()
+        self.receiver = ReceiveWorker(self.listener, self.on_frames)
+        self.receiver.moveToThread(self.receive_thread)
+        self.receive_thread.started.connect(self.receiver.start)
+        self.receive_thread.start()
+
+    def on_frames(self, frames):
+        self.last_received = time.monotonic()
+        messages = []
+        for frame in frames:
+            obj = frame.message
+            msg_type = obj.get('type')
+            if msg_type == 'login_ack':
+                self.framed = obj.get('frame', 0) >= 1
+                self.binary_file = self.framed and obj.get('binary_file', False)
+                self.compress = self.framed and obj.get('compress') == 'zlib'
+                self.codec = CODECS.get(obj.get('codec'), JSON) if self.framed else JSON
+                if self.framed and obj.get('lanes'):
+                    self.writer.enable_fragments()
+                bulk = (obj.get('limits') or {}).get(BULK)
+                if bulk:
+                    self.pacer.configure(*bulk)
+            elif msg_type == 'flow':
+                # 服务器已经在限流，文件分片暂停一会儿
+                if obj.get('class') == BULK:
+                    self.pacer.hold(obj.get('wait', 0))
+            elif msg_type == 'pong':
+                self.server_heartbeat = True
+            elif msg_type == 'ping':
+                self.send_control({'type': 'pong'})
+            elif msg_type == 'file_status':
+                # 接收方的进度回复，交给对应的发送线程
+                state = self.transfers.get(obj.get('transfer_id'))
+                if state is not None:
+                    state.update(obj)
+            else:
+                messages.append(obj)
+
+        if messages:
             try:
-                # 接收数据并拼接到缓冲区
-                raw_data = self.listener.recv(4096)
-                if not raw_data:
-                    break
-                buffer += raw_data.decode('utf-8')
-
-                # 循环解析缓冲区中的数据，直到解析不出完整的 JSON 为止
-                while buffer:
-                    buffer = buffer.lstrip()
-                    if not buffer:
-                        break
-                    try:
-                        # obj: 解析出来的 Python 对象
-                        # idx: 解析结束的索引位置
-                        obj, idx = decoder.raw_decode(buffer)
-
-                        handle_func(obj)
-
-                        buffer = buffer[idx:]
-
-                    except json.JSONDecodeError:
-                        break
-
+                self.handle_func(messages)
             except Exception as e:
-                print(f"Error in receive_msg: {e}")
-                break
+                print(f"Error in receive handler: {e}")
 
-        print("stop")
-
-    def send_msg(self, content, msg_type, to_id, is_private=True):
+    def send_msg(self, content, msg_type, to_id, is_private=True, extra=None):
         if msg_type == 'file':
             if not content:
                 print("Error: Send file but no path provided.")
                 return
 
-            self.worker = SendWorker(
-                self.listener,
-                self.send_lock,
+            worker = SendWorker(
+                self.writer,
+                self.encode,
                 content,
                 to_id,
                 self.name,
-                is_private
+                is_private,
+                self.binary_file,
+                self.transfers,
+                self.codec,
+                self.pacer
             )
 
-            self.worker.finished.connect(self.file_finished.emit)
+            worker.sent.connect(self.file_finished.emit)
 
             # 启动线程
-            self.worker.start()
+            self.start_worker(worker)
+
+        elif msg_type == 'image':
+            # content 是图片路径，压缩和发送都在线程里完成
+            worker = ImageSendWorker(
+                self.writer,
+                self.encode,
+                content,
+                to_id,
+                self.name,
+                is_private,
+                self.binary_file,
+                self.transfers,
+                self.codec,
+                self.pacer,
+                self.image_max_size,
+                self.image_quality
+            )
+            self.start_worker(worker)
 
         else:
-            msg = json.loads(msg_template)
-            msg['type'] = msg_type
-            msg['content'] = content
-            msg['to_id'] = to_id
-            msg['from_id'] = self.name
-            msg['private'] = is_private
+            msg = {'type': msg_type, 'private': is_private, 'from_id': self.name, 'to_id': to_id, 'content': content}
+            if extra:
+                msg.update(extra)
 
             try:
-                json_bytes = json.dumps(msg).encode('utf-8')
-
-                with self.send_lock:
-                    self.listener.sendall(json_bytes)
+                # 不等发送完成，上传文件时也不会卡住界面
+                self.writer.put(self.encode(msg), lane_of(msg_type))
 
             except Exception as e:
                 print(f"Send text error: {e}")
 
+    def start_worker(self, worker):
+        self.workers.add(worker)
+        worker.finished.connect(self.worker_finished)
+        worker.start()
+
+    def worker_finished(self):
+        self.workers.discard(self.sender())
+
     def close(self):
+        # 先把已经排队的 logout 等控制消息发出去，再丢弃剩下的数据
+        self.writer.drain()
+        self.stop_event.set()
+        for state in list(self.transfers.values()):
+            state.cancel()
+        if self.receive_thread is not None:
+            self.receive_thread.quit()
+            self.receive_thread.wait()
+        self.writer.close()
         self.listener.close()
-        self.isrun = False
@@ -1,131 +1,224 @@
-import base64
-from PySide6.QtCore import Qt
-from PySide6.QtGui import QPixmap
-from PySide6.QtWidgets import QWidget, QHBoxLayout, QVBoxLayout, QFrame, QLabel, QSizePolicy
-from qfluentwidgets import BodyLabel, AvatarWidget, FluentIcon, IconWidget, TitleLabel
+from PySide6.QtCore import Qt, QRect, QRectF, QSize, QModelIndex, QPersistentModelIndex
+from PySide6.QtGui import QPixmap, QPainter, QPainterPath, QColor, QFont, QFontMetrics
+from PySide6.QtWidgets import QStyledItemDelegate
+from qfluentwidgets import getFont
+
+from module.ImageCache import ImageLoader, pixmap_cache, image_key, avatar_pixmap
+
 
 THEME_COLOR = '#0099FF'
 BUBBLE_SELF_COLOR = '#E5F5FF'  # 自己发送的气泡背景色
 BUBBLE_OTHER_COLOR = '#F2F2F2'  # 别人发送的气泡背景色
-
-
-class SystemMessageLabel(BodyLabel):
-    def __init__(self, text):
-        super().__init__()
-        font = self.font()
-        font.setPixelSize(12)
-        self.setFont(font)
-        self.setMinimumSize(100, 25)
-        self.setMaximumWidth(400)
-        self.setContentsMargins(20, 8, 20, 8)
-        self.setSizePolicy(QSizePolicy.Policy.Minimum, QSizePolicy.Policy.Minimum)
-        self.setAlignment(Qt.AlignmentFlag.AlignHCenter | Qt.AlignmentFlag.AlignVCenter)
-        self.setWordWrap(True)
-        self.setText(text)
-        self.setStyleSheet("background-color: rgba(150, 150, 150, 50); border-radius: 15px")
-
-
-class MessageBubble(QWidget):
-    def __init__(self, content, avatar, name, is_me=False, is_room=False, msg_type='text', parent=None):
+SYSTEM_COLOR = QColor(150, 150, 150, 50)  # 文件等系统提示的背景色
+
+MARGIN_H = 10  # 每行左右边距
+MARGIN_V = 5  # 每行上下边距
+AVATAR_SIZE = 60
+SPACING = 8  # 头像与气泡的间距
+PADDING_H = 8  # 气泡内边距
+PADDING_V = 4
+TEXT_MAX_WIDTH = 400
+IMAGE_MAX_SIZE = 300
+IMAGE_PLACEHOLDER = (200, 150)  # 图片解码完成前占位的尺寸
+NAME_SPACING = 6  # 名字与气泡的间距
+SYSTEM_PADDING_H = 20
+SYSTEM_PADDING_V = 8
+SYSTEM_MIN_SIZE = (100, 25)
+SYSTEM_MAX_WIDTH = 400
+ROW_EXTRA = 4  # 行与行之间额外留出的空白
+
+
+def _bubble_path(rect: QRectF, is_me) -> QPainterPath:
+    """圆角气泡，靠近头像的上角是小圆角"""
+    r, small = 8.0, 2.0
+    tl, tr = (r, small) if is_me else (small, r)
+    path = QPainterPath()
+    path.moveTo(rect.left() + tl, rect.top())
+    path.lineTo(rect.right() - tr, rect.top())
+    path.arcTo(rect.right() - 2 * tr, rect.top(), 2 * tr, 2 * tr, 90, -90)
+    path.lineTo(rect.right(), rect.bottom() - r)
+    path.arcTo(rect.right() - 2 * r, rect.bottom() - 2 * r, 2 * r, 2 * r, 0, -90)
+    path.lineTo(rect.left() + r, rect.bottom())
+    path.arcTo(rect.left(), rect.bottom() - 2 * r, 2 * r, 2 * r, 270, -90)
+    path.lineTo(rect.left(), rect.top() + tl)
+    path.arcTo(rect.left(), rect.top(), 2 * tl, 2 * tl, 180, -90)
+    path.closeSubpath()
+    return path
+
+
+class MessageBubbleDelegate(QStyledItemDelegate):
+    """
+    绘制聊天气泡：头像、房间消息的发送者名字、文本/图片气泡和居中的文件提示。
+    不为每条消息创建控件，布局结果按列表宽度缓存在消息上，只有宽度变化时才重新计算。
+    """
+
+    def __init__(self, other_avatar, self_avatar, is_room=False, parent=None):
         super().__init__(parent)
-        self.is_me = is_me
-
-        layout = QHBoxLayout(self)
-        layout.setContentsMargins(10, 5, 10, 5)
-
-        self.avatar = AvatarWidget()
-        self.avatar.setAlignment(Qt.AlignmentFlag.AlignTop | Qt.AlignmentFlag.AlignHCenter)
-        self.avatar.setImage(avatar)
-        self.avatar.setFixedSize(60, 60)
-
-        avatar_layout = QVBoxLayout()
-
-        avatar_layout.addWidget(self.avatar)
-        avatar_layout.setAlignment(Qt.AlignmentFlag.AlignTop | Qt.AlignmentFlag.AlignHCenter)
-        avatar_layout.addStretch(1)
-
-        self.bubble_container = QFrame()
-        self.bubble_layout = QVBoxLayout(self.bubble_container)
-        self.bubble_layout.setContentsMargins(8, 4, 8, 4)
-
-        self.name_bubble_layout = QVBoxLayout()
-        # 判断是否为房间消息，如果是则聊天气泡带上发送方的名字
-        if is_room and not is_me:
-            name_label = TitleLabel(name)
-            name_label.setAlignment(Qt.AlignmentFlag.AlignTop| Qt.AlignmentFlag.AlignLeft)
-            font = name_label.font()
-            font.setPixelSize(10)
-            name_label.setFont(font)
-            self.name_bubble_layout.addWidget(name_label, 0.1)
-        self.name_bubble_layout.addWidget(self.bubble_container, 1)
-        # self.name_bubble_layout.setAlignment(Qt.AlignmentFlag.AlignVCenter | Qt.AlignmentFlag.AlignRight)
-
-        if msg_type == 'file':
-            self.content_widget = SystemMessageLabel(content)
-            self.content_widget.setWordWrap(False)
-            layout.addWidget(self.content_widget, 1)
-            layout.setAlignment(Qt.AlignmentFlag.AlignHCenter)
-
-        else:
-            if msg_type == 'image':
-                # 如果是图片，content 是 base64 字符串
-                self.content_widget = QLabel()
-
-                img_data = base64.b64decode(content)
-                pixmap = QPixmap()
-                pixmap.loadFromData(img_data)
-
-                # 限制图片最大显示尺寸
-                if pixmap.width() > 300:
-                    pixmap = pixmap.scaledToWidth(300, Qt.SmoothTransformation)
-                if pixmap.height() > 300:
-                    pixmap = pixmap.scaledToHeight(300, Qt.SmoothTransformation)
-
-                self.content_widget.setPixmap(pixmap)
-
-                bubble_bg = "transparent"
-
+        self.other_avatar = other_avatar
+        self.self_avatar = self_avatar
+        self.is_room = is_room
+
+        self.text_font = getFont(14)
+        self.name_font = getFont(10, QFont.Weight.DemiBold)
+        self.system_font = getFont(12)
+        self.text_metrics = QFontMetrics(self.text_font)
+        self.name_metrics = QFontMetrics(self.name_font)
+        self.system_metrics = QFontMetrics(self.system_font)
+
+        self.loader = ImageLoader(self)
+        self.loader.loaded.connect(self.on_image_loaded)
+        self._pending = {}  # 正在解码的图片消息 -> QPersistentModelIndex
+
+    def sizeHint(self, option, index):
+        message = index.model().messages[index.row()]  # 直接取对象，省去 QVariant 转换
+        width = self._width(option)
+        return QSize(width, self._layout(message, width)['height'])
+
+    def paint(self, painter: QPainter, option, index):
+        message = index.model().messages[index.row()]  # 直接取对象，省去 QVariant 转换
+        layout = self._layout(message, self._width(option))
+        origin = option.rect.topLeft()
+
+        painter.save()
+        painter.setRenderHints(QPainter.RenderHint.Antialiasing | QPainter.RenderHint.SmoothPixmapTransform)
+        painter.translate(origin)
+
+        if message.msg_type == 'file':
+            rect = layout['bubble']
+            painter.setPen(Qt.PenStyle.NoPen)
+            painter.setBrush(SYSTEM_COLOR)
+            painter.drawRoundedRect(QRectF(rect), 15, 15)
+            painter.setPen(QColor('black'))
+            painter.setFont(self.system_font)
+            painter.drawText(rect, Qt.AlignmentFlag.AlignCenter, layout['text'])
+            painter.restore()
+            return
+
+        avatar = avatar_pixmap(self.self_avatar if message.is_me else self.other_avatar, AVATAR_SIZE)
+        painter.drawPixmap(layout['avatar'], avatar)
+
+        if 'name' in layout:
+            painter.setPen(QColor('black'))
+            painter.setFont(self.name_font)
+            painter.drawText(layout['name'], Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignTop,
+                             message.sender_name)
+
+        if message.msg_type == 'image':
+            pixmap = self._image(message, index)
+            if pixmap is not None:
+                painter.drawPixmap(layout['content'], pixmap)
             else:
-                # 如果是文本，content 是普通字符串
-                self.content_widget = BodyLabel(content)
-                self.content_widget.setMaximumWidth(400)
-                self.content_widget.setMinimumHeight(0)
-                self.content_widget.setWordWrap(True)
-                self.content_widget.setTextInteractionFlags(Qt.TextSelectableByMouse)
-                self.content_widget.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Minimum)
-                if is_me:
-                    self.content_widget.setStyleSheet("color: white;")
-                else:
-                    self.content_widget.setStyleSheet("color: black;")
-                bubble_bg = THEME_COLOR if is_me else BUBBLE_OTHER_COLOR
-
-            self.bubble_layout.addWidget(self.content_widget)
-
-            # 判断是自己发送的消息还是接收的消息
-            if is_me:
-                layout.addStretch(1)
-                layout.addLayout(self.name_bubble_layout)
-                self.name_bubble_layout.setAlignment(Qt.AlignmentFlag.AlignVCenter | Qt.AlignmentFlag.AlignRight)
-                layout.addSpacing(8)
-                layout.addLayout(avatar_layout)
-
-                # 如果是图片，可能不需要背景色，或者保留
-                self.bubble_container.setStyleSheet(f"""
-                    QFrame {{
-                        background-color: {bubble_bg if msg_type == 'text' else 'transparent'};
-                        border-radius: 8px; border-top-right-radius: 2px; 
-                    }}
-                """)
+                # 解码完成前（或解码失败时）画一个占位框
+                painter.setPen(Qt.PenStyle.NoPen)
+                painter.setBrush(SYSTEM_COLOR)
+                painter.drawRoundedRect(QRectF(layout['content']), 8, 8)
+                painter.setPen(QColor('gray'))
+                painter.setFont(self.system_font)
+                painter.drawText(layout['content'], Qt.AlignmentFlag.AlignCenter,
+                                 "图片无法显示" if message.image_key == '' else "图片加载中...")
+        else:
+            painter.setPen(Qt.PenStyle.NoPen)
+            painter.setBrush(QColor(THEME_COLOR if message.is_me else BUBBLE_OTHER_COLOR))
+            painter.drawPath(_bubble_path(QRectF(layout['bubble']), message.is_me))
+            painter.setPen(QColor('white' if message.is_me else 'black'))
+            painter.setFont(self.text_font)
+            painter.drawText(layout['content'], Qt.TextFlag.TextWordWrap | Qt.AlignmentFlag.AlignLeft |
+                             Qt.AlignmentFlag.AlignTop, message.content)
+        painter.restore()
+
+    def _width(self, option):
+        # sizeHint 拿到的 option.rect 不一定带宽度，统一按视口宽度布局
+        view = self.parent()
+        return view.viewport().width() if view is not None else option.rect.width()
+
+    def _layout(self, message, width):
+        if message.layout is not None and message.layout[0] == width:
+            return message.layout[1]
+        if message.msg_type == 'file':
+            layout = self._system_layout(message, width)
+        else:
+            layout = self._bubble_layout(message, width)
+        message.layout = (width, layout)
+        return layout
+
+    def _system_layout(self, message, width):
+        max_text = SYSTEM_MAX_WIDTH - 2 * SYSTEM_PADDING_H
+        text = self.system_metrics.elidedText(message.content, Qt.TextElideMode.ElideMiddle, max_text)
+        w = max(SYSTEM_MIN_SIZE[0], self.system_metrics.horizontalAdvance(text) + 2 * SYSTEM_PADDING_H)
+        h = max(SYSTEM_MIN_SIZE[1], self.system_metrics.height() + 2 * SYSTEM_PADDING_V)
+        rect = QRect((width - w) // 2, MARGIN_V, w, h)
+        return {'height': h + 2 * MARGIN_V + ROW_EXTRA, 'bubble': rect, 'text': text}
+
+    def _bubble_layout(self, message, width):
+        available = width - 2 * MARGIN_H - AVATAR_SIZE - SPACING - 2 * PADDING_H
+        if message.msg_type == 'image':
+            content_w, content_h = message.image_size or IMAGE_PLACEHOLDER
+        else:
+            max_w = max(min(TEXT_MAX_WIDTH, available), 1)
+            advance = self.text_metrics.horizontalAdvance(message.content)
+            if advance <= max_w and '\n' not in message.content:
+                # 大多数消息只有一行，不用走换行排版
+                content_w, content_h = advance, self.text_metrics.height()
             else:
-                layout.addLayout(avatar_layout)
-                layout.addSpacing(8)
-                layout.addLayout(self.name_bubble_layout)
-                self.name_bubble_layout.setAlignment(Qt.AlignmentFlag.AlignVCenter | Qt.AlignmentFlag.AlignLeft)
-                layout.addStretch(1)
-
-                self.bubble_container.setStyleSheet(f"""
-                    QFrame {{
-                        background-color: {bubble_bg if msg_type == 'text' else 'transparent'};
-                        border-radius: 8px; border-top-left-radius: 2px;
-                    }}
-                """)
\ No newline at end of file
+                bound = self.text_metrics.boundingRect(QRect(0, 0, max_w, 0), Qt.TextFlag.TextWordWrap,
+                                                       message.content)
+                content_w, content_h = min(bound.width(), max_w), bound.height()
+
+        bubble_w = content_w + 2 * PADDING_H
+        bubble_h = content_h + 2 * PADDING_V
+        show_name = self.is_room and not message.is_me
+        name_h = self.name_metrics.height() + NAME_SPACING if show_name else 0
+        block_h = name_h + bubble_h
+        row_h = max(AVATAR_SIZE, block_h)
+
+        # 名字和气泡整体在头像高度内垂直居中
+        top = MARGIN_V + (row_h - block_h) // 2
+        if message.is_me:
+            avatar_x = width - MARGIN_H - AVATAR_SIZE
+            bubble_x = avatar_x - SPACING - bubble_w
+        else:
+            avatar_x = MARGIN_H
+            bubble_x = avatar_x + AVATAR_SIZE + SPACING
+
+        layout = {
+            'height': row_h + 2 * MARGIN_V + ROW_EXTRA,
+            'avatar': QRect(avatar_x, MARGIN_V, AVATAR_SIZE, AVATAR_SIZE),
+            'bubble': QRect(bubble_x, top + name_h, bubble_w, bubble_h),
+            'content': QRect(bubble_x + PADDING_H, top + name_h + PADDING_V, content_w, content_h),
+        }
+        if show_name:
+            layout['name'] = QRect(bubble_x, top, max(bubble_w, TEXT_MAX_WIDTH), self.name_metrics.height())
+        return layout
+
+    def _image(self, message, index):
+        """取缓存里缩放好的图片；没有就交给线程池解码，先返回 None 画占位框"""
+        if message.image_key == '':
+            return None
+        if message.image_key is not None:
+            pixmap = pixmap_cache.get(message.image_key)
+            if pixmap is not None:
+                return pixmap
+        if message not in self._pending:
+            self._pending[message] = QPersistentModelIndex(index)
+            # 有缩略图就用缩略图，只有自己刚发送的图片才从本地文件解码
+            path = None if message.content else message.path
+            self.loader.load(message, message.content, IMAGE_MAX_SIZE, path)
+        return None
+
+    def on_image_loaded(self, message, digest, image):
+        index = self._pending.pop(message, None)
+        if image.isNull():
+            message.image_key = ''
+        else:
+            message.image_key = image_key(digest, IMAGE_MAX_SIZE)
+            pixmap_cache.put(message.image_key, QPixmap.fromImage(image))
+        size = (image.width(), image.height()) if not image.isNull() else IMAGE_PLACEHOLDER
+        view = self.parent()
+        if message.image_size != size:
+            # 第一次解码出真实尺寸，行高变了需要重新布局
+            message.image_size = size
+            message.layout = None
+            if index is not None and index.isValid():
+                self.sizeHintChanged.emit(QModelIndex(index))
+        elif view is not None:
+            view.viewport().update()
@@ -0,0 +1,74 @@
+from PySide6.QtCore import Qt, QAbstractListModel, QModelIndex
+
+
+class ChatMessage:
+    """
+    一条聊天消息，只保存数据和绘制时缓存的布局，不创建任何控件
+    """
+    __slots__ = ('content', 'sender_name', 'is_me', 'msg_type', 'image_id', 'path', 'layout', 'image_key',
+                 'image_size')
+
+    def __init__(self, content, sender_name='', is_me=True, msg_type='text', image_id=None, path=None):
+        self.content = content  # 图片消息为缩略图的 base64
+        self.sender_name = sender_name
+        self.is_me = is_me
+        self.msg_type = msg_type
+        self.image_id = image_id  # 图片原图随后走文件分片发送，用这个 id 对应
+        self.path = path  # 原图的本地路径，自己发送的图片或原图接收完成后才有
+        self.layout = None  # (宽度, 布局结果)，宽度变化时由委托重新计算
+        self.image_key = None  # 图片解码后在 pixmap_cache 里的键，解码失败为空字符串
+        self.image_size = None  # 图片缩放后的显示尺寸，解码前为空
+
+
+class MessageModel(QAbstractListModel):
+    """
+    聊天记录模型，配合 QListView 和 MessageBubbleDelegate 使用：只有可见的行会被绘制
+    """
+    MessageRole = Qt.ItemDataRole.UserRole + 1
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.messages: list[ChatMessage] = []
+        self.images: dict[str, ChatMessage] = {}  # image_id -> 图片消息
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.messages)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        message = self.messages[index.row()]
+        if role == self.MessageRole:
+            return message
+        if role == Qt.ItemDataRole.DisplayRole and message.msg_type != 'image':
+            return message.content
+        return None
+
+    def append_message(self, content, sender_name='', is_me=True, msg_type='text', image_id=None, path=None):
+        row = len(self.messages)
+        message = ChatMessage(content, sender_name, is_me, msg_type, image_id, path)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.messages.append(message)
+        self.endInsertRows()
+        if image_id:
+            self.images[image_id] = message
+        return row
+
+    def prepend_messages(self, messages):
+        """在最前面插入一页更早的消息（ChatMessage 列表，按时间顺序）"""
+        if not messages:
+            return
+        self.beginInsertRows(QModelIndex(), 0, len(messages) - 1)
+        self.messages[:0] = messages
+        self.endInsertRows()
+        for message in messages:
+            if message.image_id:
+                self.images.setdefault(message.image_id, message)
+
+    def set_original(self, image_id, path) -> bool:
+        """图片原图接收完成，记下本地路径"""
+        message = self.images.get(image_id)
+        if message is None:
+            return False
+        message.path = path
+        return True
@@ -116,6 +116,9 @@ class Sidebar(QWidget):
     def remove_user(self, name):
         self.user_list.remove_item(name)
 
+    def remove_room(self, name):
+        self.room_list.remove_item(name)
+
     def on_item_clicked(self, name):
         self.userClicked.emit(name, False)
 
@@ -0,0 +1,244 @@
+"""
+可续传的文件传输状态。
+
+每次传输有一个 transfer_id，分片带 offset 和 crc32，接收方预先分配目标文件，按 offset 乱序写入。
+接收方用 file_status 消息把已收到的分片（区间列表）告诉发送方：
+    收到文件头时回复一次，发送方据此跳过已有的分片（断点续传）；
+    之后每收 ACK_EVERY 个分片回复一次，发送方用它控制窗口；
+    收到结束包时回复 done，没收全（丢失或校验失败）时发送方补发缺少的分片。
+接收进度保存在下载目录的 PARTIAL_DIR 里，客户端重启后重新发送同一个文件也能接着传。
+"""
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import zlib
+
+CHUNK_SIZE = 512 * 1024  # 512KB 分片大小
+MAX_CHUNK_SIZE = 16 * 1024 * 1024  # 接受对方声明的分片大小上限
+MAX_FILE_SIZE = 1 << 40  # 接受对方声明的文件大小上限
+STREAMS = 3  # 私聊传输时并行发送分片的线程数
+WINDOW_CHUNKS = 32  # 发送方最多领先接收方确认的分片数
+ACK_EVERY = 8  # 接收方每收多少个分片回复一次进度
+STATUS_TIMEOUT = 1.0  # 等待接收方回复文件头的时间，超时按旧版客户端处理
+FINISH_TIMEOUT = 15.0  # 发送结束包后等待接收方确认的时间
+MAX_ROUNDS = 5  # 补发的最大轮数
+SAVE_EVERY = 16  # 每收多少个分片保存一次接收进度
+PARTIAL_DIR = '.partial'
+TRANSFER_ID = re.compile(r'[0-9a-f]{40}')  # make_transfer_id 的结果，接收进度文件用它命名
+
+
+def make_transfer_id(from_id, to_id, path, size, mtime):
+    """同一个文件再次发给同一个人时 id 不变，接收方才能找到之前的进度"""
+    key = f"{from_id}\x00{to_id}\x00{os.path.abspath(path)}\x00{size}\x00{mtime}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def valid_transfer_id(msg):
+    """对方给的 transfer_id，格式不对的按旧版客户端处理，不能拿来拼进度文件的路径"""
+    transfer_id = msg.get('transfer_id')
+    if isinstance(transfer_id, str) and TRANSFER_ID.fullmatch(transfer_id):
+        return transfer_id
+    return None
+
+
+def valid_header(msg) -> bool:
+    """对方给的文件大小和分片大小要是合理的正整数，否则不接收这次传输"""
+    size = msg.get('filesize')
+    chunk_size = msg.get('chunk_size', CHUNK_SIZE)
+    return (type(size) is int and 0 < size <= MAX_FILE_SIZE
+            and type(chunk_size) is int and 0 < chunk_size <= MAX_CHUNK_SIZE)
+
+
+def chunk_count(size, chunk_size):
+    return math.ceil(size / chunk_size)
+
+
+def to_ranges(indices) -> list:
+    """分片序号集合压缩成 [[start, end), ...]"""
+    ranges = []
+    for index in sorted(indices):
+        if ranges and ranges[-1][1] == index:
+            ranges[-1][1] = index + 1
+        else:
+            ranges.append([index, index + 1])
+    return ranges
+
+
+def from_ranges(ranges, chunks) -> set:
+    """区间列表展开成分片序号，只保留 [0, chunks) 内的部分，格式不对的区间忽略"""
+    indices = set()
+    if not isinstance(ranges, list):
+        return indices
+    for item in ranges:
+        if not (isinstance(item, list) and len(item) == 2 and all(type(n) is int for n in item)):
+            continue
+        indices.update(range(max(item[0], 0), min(item[1], chunks)))
+    return indices
+
+
+def unique_path(save_dir, filename):
+    """同名文件已存在时加序号，不同发送方的同名文件不会互相覆盖"""
+    name, ext = os.path.splitext(os.path.basename(filename))
+    path = os.path.join(save_dir, name + ext)
+    i = 1
+    while os.path.exists(path):
+        path = os.path.join(save_dir, f"{name}({i}){ext}")
+        i += 1
+    return path
+
+
+class IncomingTransfer:
+    """接收方的一次传输，只在接收线程里使用"""
+
+    def __init__(self, save_dir, msg):
+        self.transfer_id = valid_transfer_id(msg)
+        self.from_id = msg.get('from_id')
+        self.filename = msg['filename']
+        self.size = msg['filesize']
+        self.chunk_size = msg.get('chunk_size', CHUNK_SIZE)
+        self.chunks = chunk_count(self.size, self.chunk_size)
+        self.received = set()
+        self.offset = 0  # 旧版客户端不带 offset，按顺序写
+        self.since_ack = 0
+        self.since_save = 0
+
+        self.state_path = None
+        state = None
+        if self.transfer_id:
+            partial_dir = os.path.join(save_dir, PARTIAL_DIR)
+            os.makedirs(partial_dir, exist_ok=True)
+            self.state_path = os.path.join(partial_dir, self.transfer_id + '.json')
+            state = self._load_state()
+
+        if state is not None:
+            self.path = state['path']
+            self.received = from_ranges(state.get('have'), self.chunks)
+            self.file = open(self.path, 'r+b')
+        else:
+            self.path = unique_path(save_dir, self.filename)
+            self.file = open(self.path, 'w+b')
+            # 预先分配，分片可以按 offset 乱序写入
+            self.file.truncate(self.size)
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if (state.get('size') != self.size or state.get('chunk_size') != self.chunk_size
+                or not os.path.exists(state.get('path', ''))):
+            return None
+        return state
+
+    def save_state(self):
+        if self.state_path is None:
+            return
+        self.file.flush()
+        state = {'path': self.path, 'size': self.size, 'chunk_size': self.chunk_size,
+                 'have': to_ranges(self.received)}
+        tmp = self.state_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_path)
+        self.since_save = 0
+
+    def write(self, msg, data) -> bool:
+        """写入一个分片；校验失败或位置不对返回 False，丢弃的分片之后由发送方补发"""
+        offset = msg.get('offset', self.offset)
+        if (not isinstance(offset, int) or offset < 0 or offset + len(data) > self.size
+                or ('offset' in msg and offset % self.chunk_size)):
+            print(f"分片位置无效: {self.filename} @ {offset}")
+            return False
+        if 'crc' in msg and zlib.crc32(data) != msg['crc']:
+            print(f"分片校验失败: {self.filename} @ {offset}")
+            return False
+        self.file.seek(offset)
+        self.file.write(data)
+        self.offset = offset + len(data)
+        self.received.add(offset // self.chunk_size)
+        self.since_ack += 1
+        self.since_save += 1
+        if self.since_save >= SAVE_EVERY:
+            self.save_state()
+        return True
+
+    def should_ack(self) -> bool:
+        if self.since_ack >= ACK_EVERY:
+            self.since_ack = 0
+            return True
+        return False
+
+    @property
+    def complete(self):
+        if not self.transfer_id:
+            return True  # 旧版客户端没有分片信息，收到结束包即认为完成
+        return len(self.received) >= self.chunks
+
+    def status(self, final=False) -> dict:
+        return {'transfer_id': self.transfer_id, 'have': to_ranges(self.received), 'done': self.complete,
+                'final': final}
+
+    def close(self):
+        if not self.complete:
+            self.save_state()
+        self.file.close()
+        if self.complete and self.state_path and os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+
+class OutgoingState:
+    """
+    发送方一次传输的确认状态。接收线程调用 update，发送线程等待确认。
+    """
+
+    def __init__(self, transfer_id, chunks):
+        self.transfer_id = transfer_id
+        self.chunks = chunks
+        self.cond = threading.Condition()
+        self.supported = False  # 收到过 file_status，说明接收方支持续传和乱序写入
+        self.have = set()
+        self.todo = set()  # 这一轮要发送的分片
+        self.acked = 0  # 这一轮里接收方已确认的分片数
+        self.done = False
+        self.final = False  # 接收方对结束包的回复
+        self.version = 0  # 每收到一次 file_status 加一
+        self.cancelled = False
+
+    def update(self, msg):
+        with self.cond:
+            self.supported = True
+            self.have = from_ranges(msg.get('have', []), self.chunks)
+            self.acked = len(self.have & self.todo)
+            self.done = msg.get('done', False)
+            self.final = msg.get('final', False)
+            self.version += 1
+            self.cond.notify_all()
+
+    def start_round(self, todo):
+        with self.cond:
+            self.todo = set(todo)
+            self.acked = len(self.have & self.todo)
+
+    def cancel(self):
+        with self.cond:
+            self.cancelled = True
+            self.cond.notify_all()
+
+    def wait_status(self, version, timeout) -> bool:
+        """等待版本号超过 version 的 file_status"""
+        with self.cond:
+            return self.cond.wait_for(lambda: self.version > version or self.cancelled, timeout) and \
+                not self.cancelled
+
+    def wait_window(self, position, timeout=FINISH_TIMEOUT):
+        """
+        发送这一轮第 position 个分片前调用：接收方确认的分片数落后太多时等待。
+        长时间没有确认（例如接收方掉线）时不再等待，交给结束时的补发处理。
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.cancelled or position - self.acked < WINDOW_CHUNKS,
+                               timeout)
@@ -1,178 +1,609 @@
+import argparse
+import itertools
+import os
 import socket
-import json
 import asyncio
 
-###type: text, image, login, logout, user_list, create_room, join_room
-msg_template = """{
-    "type": "message", 
-    "private": false,
-    "from_id": "UserA", 
-    "to_id": "UserB",
-    "content": ""
-}"""
-
-
-class Room:
-    def __init__(self, name, creator):
-        self.name: str = name
-        self.users: set = set()
-        self.creator = creator
-
-    # def Add(self, user: User):
-    #     self.users.append(user)
-    #
-    # def Remove(self, user):
-    #     self.users.remove(user)
+from Client.module.Codec import negotiate
+from Client.module.Flow import LANE_TEXT, lane_of
+from Client.module.Framing import Frame, FrameDecoder, FrameError, VERSION, encode_message, encode_legacy
+from service.Connection import Connection, MAX_QUEUE_BYTES, POLICY_DROP_FILE_CHUNK
+from service.History import HistoryStore, private_key, room_key
+from service.Mailbox import OfflineStore, flush_batches
+from service.Metrics import Metrics, METRICS_HOST
+from service.Presence import PresenceService
+from service.Protocol import CORE_PROTOCOL, CORE_SOCK, CORES, ChatProtocol, run
+from service.SearchIndex import SearchIndex
+from service.RateLimit import RateLimiter, DEFAULT_LIMITS, DEFAULT_ROOM_LIMITS, parse_limits
+from service.Rooms import RoomRegistry
+from service.TimerWheel import TimerWheel
+
+RECV_SIZE = 64 * 1024
+
+# 原样转发给接收者的消息类型
+RELAY_TYPES = ('text', 'image', 'file_header', 'file_chunk', 'file_finish', 'file_status')
+# 写入聊天记录的消息类型，文件分片不记录
+HISTORY_TYPES = ('text', 'image', 'file_header')
+HISTORY_PAGE = 50
+SEARCH_PAGE = 20
+SEARCH_TIMEOUT = 2.0  # 分片模式下等其他分片返回搜索结果的最长时间
+# 收件人离线时存进信箱的消息类型，文件传输需要双方在线
+OFFLINE_TYPES = ('text', 'image', 'join_room', 'delete_room')
+SWEEP_INTERVAL = 60
+# 客户端每隔一段时间发 ping，超过 IDLE_TIMEOUT 没有收到任何数据的连接视为已断开
+IDLE_TIMEOUT = 45
+WHEEL_TICK = 1.0
+PONG = {True: encode_message({'type': 'pong'}), False: encode_legacy({'type': 'pong'})}
+
+###type: text, image, login, logout, user_list, create_room, join_room, leave_room, delete_room
 
 
 class Server:
-    def __init__(self, ip, port, max_user):
-        self.users: dict = {}
-        self.rooms: dict[str, Room] = {}
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.bind((ip, port))
-        self.server.listen(max_user)
+    def __init__(self, ip, port, max_user, max_queue_bytes=MAX_QUEUE_BYTES, slow_policy=POLICY_DROP_FILE_CHUNK,
+                 sock=None, history_dir=None, mailbox_dir=None, metrics_port=None, idle_timeout=IDLE_TIMEOUT,
+                 rate_limit=True, rate_limits=None, room_rate_limits=None, core=CORE_SOCK, search_index=True,
+                 shard_id=None, metrics_host=METRICS_HOST):
+        self.ip = ip
+        self.port = port
+        self.users: dict[str, Connection] = {}  # 本进程上的连接
+        self.rooms = RoomRegistry(self)  # 房间成员和用户 -> 房间的反向索引，见 service.Rooms
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.bind((ip, port))
+            sock.listen(max_user)
+        self.server = sock
         self.server.setblocking(False)
         self.loop: asyncio.AbstractEventLoop
-
-    async def broadcast(self, client_name, data_dict):
+        # 发送队列上限和慢消费者策略，见 service.Connection
+        self.max_queue_bytes = max_queue_bytes
+        self.slow_policy = slow_policy
+
+        # 分片模式下的跨进程总线和其他分片上的在线用户，见 service.Shard
+        self.bus = None
+        self.remote_users: dict[str, int] = {}
+
+        # 聊天记录，磁盘读写都在 HistoryStore 的后台线程里
+        self.history = HistoryStore(history_dir) if history_dir else None
+        # 聊天记录的全文索引，分词和合并都在 SearchIndex 的后台线程里，见 service.SearchIndex。
+        # 分片模式下每个分片一个目录，各自的段文件编号互不干扰
+        self.index = None
+        if history_dir and search_index:
+            index_dir = os.path.join(history_dir, 'index')
+            if shard_id is not None:
+                index_dir = os.path.join(index_dir, str(shard_id))
+            self.index = SearchIndex(index_dir)
+        self.search_ids = itertools.count()
+        self.searches = {}  # 分片模式下正在汇总的搜索：id -> [Future, 还在等的分片数, 结果]
+        # 离线信箱，分片模式下每个分片一个目录，启动时清理溢出文件不会删到别的分片正在用的
+        self.offline = None
+        if mailbox_dir:
+            self.offline = OfflineStore(mailbox_dir if shard_id is None else os.path.join(mailbox_dir, str(shard_id)))
+        # 运行指标，metrics_port 不为空时在本地端口输出
+        self.metrics = Metrics()
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        # 每个连接、每个房间的限流，rate_limit 为 False 时不限，见 service.RateLimit
+        self.limiter = RateLimiter(self.metrics, rate_limits, room_rate_limits) if rate_limit else None
+        # 在线状态：合并后按版本发布增量
+        self.presence = PresenceService(self)
+        # 心跳超时，所有连接共用一个时间轮和一个定时器
+        self.idle_timeout = idle_timeout
+        self.idle_wheel: TimerWheel
+        # 服务端核心：sock 是每个连接一个读协程加写协程，protocol 是 asyncio.Protocol 回调
+        if core not in CORES:
+            raise ValueError(f"unknown server core {core!r}")
+        self.core = core
+
+    def broadcast(self, client_name, data_dict):
         """
-        广播消息
+        广播消息，只入队不等待发送完成
         """
-        bytes_data = json.dumps(data_dict).encode('utf-8')
+        frame = Frame.from_message(data_dict)
+        self.broadcast_local(frame, client_name)
+        if self.bus:
+            self.bus.broadcast(frame, client_name)
+
+    def broadcast_local(self, frame, client_name):
+        count = nbytes = 0
+        lane = lane_of(frame.route.get('type'), frame.lane)
         for name, conn in self.users.items():
             if name != client_name:
-                try:
-                    await self.loop.sock_sendall(conn, bytes_data)
-                except Exception as e:
-                    print(f"Broadcast error to {name}: {e}")
+                data = frame.encoded(conn.framed, conn.binary, conn.compress, conn.codec)
+                conn.send(data, lane=lane)
+                count += 1
+                nbytes += len(data)
+        self.metrics.sent(frame.route.get('type'), count, nbytes)
 
-    async def send_to_user(self, to_id, msg):
+    def send_to_user(self, to_id, msg):
         """发送给指定用户"""
-        if to_id in self.users:
-            bytes_data = json.dumps(msg).encode('utf-8')
+        self.deliver(Frame.from_message(msg), [to_id])
+
+    def deliver(self, frame, recipients, bulk=False):
+        """本地用户直接入队，其他分片上的用户经总线转发，离线用户存进信箱"""
+        self.deliver_local(frame, recipients, bulk)
+        for user in recipients:
+            if user in self.remote_users:
+                self.bus.deliver(frame, user, bulk)
+            elif user not in self.users:
+                self.store_offline(user, frame)
+
+    def deliver_local(self, frame, recipients, bulk=False):
+        users = self.users
+        self.send_conns(frame, [users[user] for user in recipients if user in users], bulk)
+
+    def send_conns(self, frame, conns, bulk=False):
+        count = nbytes = 0
+        # 按消息类型排进优先级通道，图片原图的分片由发送方在帧头里标明
+        lane = lane_of(frame.route.get('type'), frame.lane)
+        for conn in conns:
+            data = frame.encoded(conn.framed, conn.binary, conn.compress, conn.codec)
+            conn.send(data, bulk, lane)
+            count += 1
+            nbytes += len(data)
+        if count:
+            self.metrics.sent(frame.route.get('type'), count, nbytes)
+
+    def relay(self, frame):
+        """
+        转发聊天帧：只看路由字段，把收到的原始字节（或共享的一次编码结果）交给每个接收者
+        """
+        route = frame.route
+        recipient_id = route['to_id']
+        bulk = route['type'] == 'file_chunk'
+        if route['private']:
+            self.deliver(frame, [recipient_id], bulk)
+        elif recipient_id in self.rooms:
+            # 本进程的在线成员直接拿连接对象入队，离线成员只遍历 away
+            room = self.rooms.get(recipient_id)
+            sender = route['from_id']
+            conns = room.recipients(sender)
+            self.metrics.room_fanout(recipient_id, len(conns))
+            self.send_conns(frame, conns, bulk)
+            if self.bus:
+                # 其他分片上的成员由各自的分片投递
+                self.bus.room_deliver(frame, recipient_id, sender, bulk)
+            if room.away and route['type'] in OFFLINE_TYPES:
+                for user in room.away:
+                    if user != sender:
+                        self.store_offline(user, frame)
+        else:
+            return
+
+        if route['type'] in HISTORY_TYPES:
+            self.record_history(frame, route)
+
+    def owner_shard(self, key):
+        """分片模式下每个会话记录和信箱只由一个分片保存，返回 None 表示就在本进程"""
+        if self.bus is None:
+            return None
+        owner = self.bus.owner_of(key)
+        return None if owner == self.bus.shard_id else owner
+
+    def record_history(self, frame, route):
+        key = private_key(route['from_id'], route['to_id']) if route['private'] else room_key(route['to_id'])
+        owner = self.owner_shard(key)
+        if owner is not None:
+            self.bus.history_append(owner, key, frame)
+        else:
+            self.store_history(key, frame)
+
+    def store_history(self, key, frame):
+        """本进程保存的会话：写入记录并建索引，都只是入队"""
+        if self.history:
+            self.history.append(key, frame)
+        if self.index:
+            self.index.add(key, frame)
+
+    def store_offline(self, user, frame):
+        if frame.route.get('type') not in OFFLINE_TYPES:
+            return
+        owner = self.owner_shard('m:' + user)
+        if owner is not None:
+            self.bus.mail_store(owner, user, frame)
+        elif self.offline:
+            self.offline.put(user, frame.encoded(True))
+
+    def flush_offline(self, user):
+        """用户登录后取出信箱，交给用户所在的分片合并发送"""
+        owner = self.owner_shard('m:' + user)
+        if owner is not None:
+            self.bus.mail_flush(owner, user)
+        elif self.offline:
+            messages = self.offline.take(user)
+            if not messages:
+                return
+            if user in self.users:
+                self.deliver_offline(user, messages)
+            elif user in self.remote_users:
+                self.bus.mail_batch(user, messages)
+
+    def deliver_offline(self, user, messages):
+        conn = self.users.get(user)
+        if conn:
+            for batch in flush_batches(messages, conn.framed, conn.compress, conn.codec):
+                conn.send(batch, lane=LANE_TEXT)
+                self.metrics.sent('offline', 1, len(batch))
+
+    def reap_idle(self):
+        """
+        时间轮到期的连接：期间收到过数据就按最近一次的时间改期，否则断开。
+        连接断开后 handle 的 finally 负责清理，和对端正常断开走同一条路径。
+        """
+        now = self.loop.time()
+        for conn in self.idle_wheel.advance(now):
+            if conn.closed:
+                continue
+            deadline = conn.last_seen + self.idle_timeout
+            if deadline > now:
+                self.idle_wheel.schedule(conn, deadline)
+            else:
+                print(f"{conn.name} heartbeat timeout")
+                self.metrics.connections_reaped += 1
+                conn.close()
+        self.loop.call_later(WHEEL_TICK, self.reap_idle)
+
+    def sweep_offline(self):
+        self.offline.sweep()
+        self.loop.call_later(SWEEP_INTERVAL, self.sweep_offline)
+
+    def request_history(self, msg, conn):
+        """
+        处理 history 请求：私聊只能查自己参与的会话，房间只能由成员查询
+        """
+        chat = msg['to_id']
+        if msg.get('private', True):
+            key = private_key(conn.name, chat)
+        elif self.rooms.is_member(chat, conn.name):
+            key = room_key(chat)
+        else:
+            return
+        request = {
+            'user': conn.name,
+            'key': key,
+            'chat': chat,
+            'private': msg.get('private', True),
+            'before': msg.get('before'),
+            'limit': max(min(int(msg.get('limit') or HISTORY_PAGE), HISTORY_PAGE), 1),
+        }
+
+        owner = self.owner_shard(key)
+        if owner is not None:
+            self.bus.history_read(owner, request)
+        else:
+            self.loop.create_task(self.read_history(request))
+
+    async def read_history(self, request):
+        if self.history:
+            messages, cursor = await asyncio.wrap_future(
+                self.history.read(request['key'], request['before'], request['limit']))
+        else:
+            messages, cursor = [], None
+
+        reply = {
+            'type': 'history',
+            'private': request['private'],
+            'from_id': request['chat'],
+            'to_id': request['user'],
+            'content': messages,
+            'cursor': cursor,
+        }
+        self.send_to_user(request['user'], reply)
+
+    def request_search(self, msg, conn):
+        """
+        处理 search 请求：只在自己参与的私聊和当前所在的房间里搜索。
+        分片模式下每个分片只索引自己保存的会话，由收到请求的分片汇总所有分片的结果
+        """
+        query = msg.get('content')
+        if not isinstance(query, str) or not query.strip():
+            return
+        request = {
+            'user': conn.name,
+            'rooms': [room.name for room in self.rooms.rooms_of(conn.name)],
+            'query': query,
+            'before': msg.get('before'),
+            'limit': max(min(int(msg.get('limit') or SEARCH_PAGE), SEARCH_PAGE), 1),
+        }
+        self.loop.create_task(self.search(request))
+
+    async def search(self, request):
+        future = None
+        if self.bus:
+            request['id'] = next(self.search_ids)
+            request['origin'] = self.bus.shard_id
+            future = self.loop.create_future()
+            self.searches[request['id']] = [future, self.bus.shards - 1, []]
+            self.bus.search(request)
+
+        hits, _ = await self.search_local(request)
+        if future is not None:
             try:
-                await self.loop.sock_sendall(self.users[to_id], bytes_data)
-            except Exception as e:
-                print(f"Send error to {to_id}: {e}")
-
-    async def join_room(self, room_name, user, inviter):
-        msg = json.loads(msg_template)
-        msg['type'] = 'join_room'
-        msg['to_id'] = user
-        msg['from_id'] = inviter
-        msg['content'] = room_name
-        self.rooms[room_name].users.add(user)
-        await self.send_to_user(user, msg)
-
-    async def get_allusers(self, sock, client_name):
-        online_users = [name for name in self.users.keys() if name != client_name]
-
-        if online_users:
-            data = json.loads(msg_template)
-            data['type'] = 'user_list'
-            data['to_id'] = client_name
-            data['from_id'] = online_users
-
-            raw_data = json.dumps(data).encode('utf-8')
-            await self.loop.sock_sendall(sock, raw_data)
-
-    async def handle(self, client_sock):
-        buffer = ""
-        decoder = json.JSONDecoder()
-        current_user_name = None  # 记录当前连接的用户名
+                await asyncio.wait_for(asyncio.shield(future), SEARCH_TIMEOUT)
+            except asyncio.TimeoutError:
+                print(f"Search {request['id']}: some shards did not answer")
+            hits.extend(self.searches.pop(request['id'])[2])
+            hits.sort(key=lambda hit: hit['ts'], reverse=True)
+            del hits[request['limit']:]
+
+        reply = {
+            'type': 'search',
+            'to_id': request['user'],
+            'query': request['query'],
+            'content': hits,
+            'cursor': hits[-1]['ts'] if len(hits) == request['limit'] else None,
+        }
+        self.send_to_user(request['user'], reply)
+
+    async def search_local(self, request):
+        if not self.index:
+            return [], None
+        return await asyncio.wrap_future(self.index.search(
+            request['user'], request['rooms'], request['query'], request['before'], request['limit']))
+
+    async def answer_search(self, request):
+        """其他分片转来的搜索请求，结果发回汇总的分片"""
+        hits, _ = await self.search_local(request)
+        self.bus.search_result(request['origin'], request['id'], hits)
+
+    def search_result(self, search_id, hits):
+        pending = self.searches.get(search_id)
+        if pending is None:
+            return
+        pending[1] -= 1
+        pending[2].extend(hits)
+        if pending[1] <= 0 and not pending[0].done():
+            pending[0].set_result(None)
+
+    def add_remote_room(self, room_name, creator, users):
+        """其他分片创建的房间"""
+        self.rooms.create(room_name, creator, users)
+
+    def join_room(self, room_name, user, inviter):
+        msg = {'type': 'join_room', 'private': False, 'from_id': inviter, 'to_id': user, 'content': room_name}
+        self.rooms.add_member(self.rooms.get(room_name), user)
+        self.send_to_user(user, msg)
+
+    def leave_room(self, room_name, user):
+        """成员退出房间，通知其余成员；最后一个人退出时房间随之删除"""
+        room = self.rooms.leave(room_name, user)
+        if room is None:
+            return
+        if self.bus:
+            self.bus.room_leave(room_name, user)
+        if room.users:
+            self.deliver(Frame.from_message({'type': 'leave_room', 'private': False, 'from_id': user,
+                                             'to_id': room_name, 'content': room_name}), list(room.users))
+
+    def delete_room(self, room_name, user):
+        """只有创建者能删除房间，所有成员收到 delete_room"""
+        room = self.rooms.get(room_name)
+        if room is None or room.creator != user:
+            return
+        self.rooms.delete(room_name)
+        if self.bus:
+            self.bus.room_delete(room_name)
+        self.deliver(Frame.from_message({'type': 'delete_room', 'private': False, 'from_id': user,
+                                         'to_id': room_name, 'content': room_name}), list(room.users))
+
+    def user_offline(self, conn):
+        """连接对应的用户下线；用户已经在别的连接上重新登录时不处理"""
+        name = conn.name
+        if name and self.users.get(name) is conn:
+            print(f"{name} disconnected")
+            self.users.pop(name)
+            self.rooms.refresh(name)
+            if self.bus:
+                self.bus.presence(name, False)
+            self.presence.changed(name)
+
+    async def handle(self, conn):
+        decoder = FrameDecoder()
+        conn.decoder = decoder
+        metrics = self.metrics
 
         try:
             while True:
-                # 接收数据块
-                raw_chunk = await self.loop.sock_recv(client_sock, 4096)
-                if not raw_chunk:
+                # 直接收进解码器的预分配缓冲区
+                with decoder.get_buffer(RECV_SIZE) as view:
+                    nbytes = await self.loop.sock_recv_into(conn.sock, view)
+                if not nbytes:
                     break
-
-                try:
-                    buffer += raw_chunk.decode('utf-8')
-                except UnicodeDecodeError:
-                    continue
-
-                while buffer:
-                    buffer = buffer.lstrip()
-                    if not buffer:
-                        break
-
-                    try:
-                        data, idx = decoder.raw_decode(buffer)
-
-                        await self.process_message(data, client_sock, current_user_name)
-
-                        if data.get('type') == 'login':
-                            current_user_name = data['from_id']
-
-                        buffer = buffer[idx:]
-
-                    except json.JSONDecodeError:
-                        break
-
+                metrics.recv_bytes += nbytes
+                conn.last_seen = self.loop.time()
+
+                for frame in decoder.buffer_updated(nbytes):
+                    # 超限时先等够时间再处理，这期间不读这个连接，其他连接照常
+                    wait = self.admit(conn, frame)
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                    self.process_message(frame, conn)
+
+        except FrameError as e:
+            print(f"Protocol error from {conn.name}: {e}")
         except Exception as e:
             print(f"Connection error: {e}")
         finally:
             # 断开连接后的清理
-            if current_user_name and current_user_name in self.users:
-                print(f"{current_user_name} disconnected")
-                self.users.pop(current_user_name)
-
-                logout_msg = {'type': 'logout', 'from_id': current_user_name}
-                await self.broadcast(current_user_name, logout_msg)
-
-            client_sock.close()
-
-    async def process_message(self, msg, client_sock, current_user_name):
+            conn.close()
+            await conn.wait_closed()
+            conn.sock.close()
+            self.connection_closed(conn)
+
+    def connection_opened(self, conn):
+        """新连接建立，两种服务端核心共用"""
+        self.metrics.connections_opened += 1
+        self.presence.send_snapshot(conn)
+
+    def connection_closed(self, conn):
+        self.idle_wheel.cancel(conn)
+        self.user_offline(conn)
+        self.metrics.connection_closed(conn)
+
+    def admit(self, conn, frame) -> float:
+        """限流记账，返回处理这一帧前需要等待的秒数"""
+        if self.limiter is None:
+            return 0.0
+        return self.limiter.admit(conn, frame, self.target_room(frame), self.loop.time())
+
+    def target_room(self, frame):
+        route = frame.route
+        if route.get('private', True):
+            return None
+        to_id = route.get('to_id')
+        return self.rooms.get(to_id) if isinstance(to_id, str) else None
+
+    def process_message(self, frame, conn):
         """
-        处理单条完整的 JSON 消息
+        处理单条完整的消息
         """
-        msg_type = msg.get('type')
-
+        msg_type = frame.route.get('type')
+        # 旧版裸 JSON 没有帧长度，只计条数
+        self.metrics.received(msg_type, len(frame.raw) if frame.raw is not None else 0)
+
+        if msg_type in RELAY_TYPES:
+            # 聊天消息走转发路径，不解析消息体
+            self.relay(frame)
+            return
+
+        if msg_type == 'ping':
+            # 回复 pong；第一次收到 ping 后开始检查这个连接的心跳
+            conn.send(PONG[conn.framed])
+            if not conn.heartbeat:
+                conn.heartbeat = True
+                self.idle_wheel.schedule(conn, conn.last_seen + self.idle_timeout)
+            return
+        if msg_type == 'pong':
+            return
+
+        msg = frame.message
         if msg_type == 'login':
             client_name = msg['from_id']
-            self.users[client_name] = client_sock
+            conn.name = client_name
+            self.users[client_name] = conn
+            self.rooms.refresh(client_name)
+            if self.bus:
+                self.bus.presence(client_name, True)
             print(f"User {client_name} logged in")
 
-            # 广播登录
-            await self.broadcast(client_name, msg)
+            # 协商帧格式：新客户端在登录消息里带上自己支持的帧版本，旧客户端没有这个字段
+            frame_version = min(msg.get('frame', 0), VERSION)
+            if frame_version:
+                # binary_file: 对方能直接解析 KIND_BINARY 文件分片，否则转发时转回 base64
+                binary = bool(msg.get('binary_file'))
+                # compress: 对方支持的压缩方式，目前只有 zlib
+                compress = 'zlib' in (msg.get('compress') or ())
+                # codecs: 对方支持的消息编码，见 Client.module.Codec
+                codec = negotiate(msg.get('codecs'))
+                # limits: 各类流量的限额，客户端按这个速度发送
+                # lanes: 对方能拼接分片帧，大帧分片发送，见 Client.module.Flow
+                lanes = bool(msg.get('lanes'))
+                conn.send_msg({'type': 'login_ack', 'frame': frame_version, 'binary_file': binary,
+                               'compress': 'zlib' if compress else None, 'codec': codec.name,
+                               'limits': self.limiter.announce() if self.limiter else None, 'lanes': lanes})
+                conn.framed = True
+                conn.binary = binary
+                conn.compress = compress
+                conn.codec = codec
+                if lanes:
+                    conn.enable_fragments()
+
+            # 登录状态在下一个 tick 合并发布；补发连接建立以来的变化，新客户端之后改收 presence 增量
+            self.presence.changed(client_name)
+            self.presence.subscribe(conn, bool(frame_version and msg.get('presence')), msg.get('interest'))
+            self.flush_offline(client_name)
 
         elif msg_type == 'logout':
-            if current_user_name:
-                await self.broadcast(current_user_name, msg)
+            self.user_offline(conn)
 
-        elif msg_type in ['text', 'image', 'file_header', 'file_chunk', 'file_finish']:
-            recipient_id = msg['to_id']
-            if msg['private']:
-                await self.send_to_user(recipient_id, msg)
-            else:
-                if recipient_id in self.rooms.keys():
-                    for user in self.rooms[recipient_id].users:
-                        if user != msg['from_id']:
-                            await self.send_to_user(user, msg)
+        elif msg_type == 'presence_interest':
+            if conn.presence:
+                self.presence.set_interest(conn, msg.get('content'))
+
+        elif msg_type == 'history':
+            if conn.name:
+                self.request_history(msg, conn)
+
+        elif msg_type == 'search':
+            if conn.name:
+                self.request_search(msg, conn)
 
         elif msg_type in 'create_room':
             room_name = msg['content']
             users = msg['to_id']
             creator = msg['from_id']
-            room = Room(room_name, creator)
-            self.rooms[room_name] = room
+            self.rooms.create(room_name, creator)
+            if self.bus:
+                # 先同步成员表，其他分片的成员收到邀请后马上发言也能正确转发
+                self.bus.room(room_name, creator, users)
             for user in users:
-                await self.join_room(room_name, user, creator)
+                self.join_room(room_name, user, creator)
+
+        elif msg_type == 'leave_room':
+            if conn.name:
+                self.leave_room(msg['content'], conn.name)
+
+        elif msg_type == 'delete_room':
+            if conn.name:
+                self.delete_room(msg['content'], conn.name)
 
     async def run(self):
         self.loop = asyncio.get_running_loop()
-        print("Server started on port 8888...")
+        self.idle_wheel = TimerWheel(WHEEL_TICK, self.loop.time())
+        self.loop.call_later(WHEEL_TICK, self.reap_idle)
+        if self.bus:
+            self.bus.start(self.loop)
+        if self.offline:
+            self.loop.call_later(SWEEP_INTERVAL, self.sweep_offline)
+        if self.metrics_port:
+            await self.metrics.serve(self, self.metrics_host, self.metrics_port)
+            self.loop.create_task(self.metrics.monitor_loop(self.loop))
+        print(f"Server started on port {self.port} ({self.core} core)...")
+        if self.core == CORE_PROTOCOL:
+            # 收发都由事件循环的 transport 完成，见 service.Protocol
+            listener = await self.loop.create_server(lambda: ChatProtocol(self), sock=self.server)
+            await listener.serve_forever()
         while True:
             client_sock, addr = await self.loop.sock_accept(self.server)
             print(f"Connection from {addr}")
             client_sock.setblocking(False)
-            await self.get_allusers(client_sock, '')
-            self.loop.create_task(self.handle(client_sock))
+            conn = Connection(client_sock, self.loop, self.max_queue_bytes, self.slow_policy, self.metrics)
+            self.connection_opened(conn)
+            self.loop.create_task(self.handle(conn))
 
 
 if __name__ == '__main__':
-    server = Server('localhost', 8888, 10)
-    asyncio.run(server.run())
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--max-user', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=1, help="大于 1 时启动多进程分片模式")
+    parser.add_argument('--history-dir', default='history', help="聊天记录目录，为空时不保存")
+    parser.add_argument('--no-search-index', action='store_true', help="不建立聊天记录的全文索引，不支持 search 请求")
+    parser.add_argument('--mailbox-dir', default='mailbox', help="离线信箱溢出目录，为空时不保存离线消息")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="在此端口输出 Prometheus 格式的指标，分片模式下第 i 个分片使用端口 + i")
+    parser.add_argument('--metrics-host', default=METRICS_HOST, help="指标端口监听的地址，默认只允许本机访问")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help="发过心跳的连接超过这么多秒没有数据就断开")
+    parser.add_argument('--no-rate-limit', action='store_true', help="不限制客户端的发送速度")
+    parser.add_argument('--rate-limit', action='append', default=[], metavar='CLASS=MSGS,BYTES',
+                        help="每个连接的限额，CLASS 为 control/text/bulk，0 表示不限，可以重复")
+    parser.add_argument('--room-rate-limit', action='append', default=[], metavar='CLASS=MSGS,BYTES',
+                        help="每个房间的限额，格式同 --rate-limit")
+    parser.add_argument('--core', choices=CORES, default=CORE_SOCK,
+                        help="sock: 读写协程；protocol: asyncio.Protocol 和 transport，带高低水位")
+    parser.add_argument('--uvloop', action='store_true', help="安装了 uvloop 时用它作为事件循环")
+    args = parser.parse_args()
+
+    options = {'history_dir': args.history_dir, 'mailbox_dir': args.mailbox_dir, 'metrics_port': args.metrics_port,
+               'metrics_host': args.metrics_host,
+               'idle_timeout': args.idle_timeout, 'rate_limit': not args.no_rate_limit,
+               'rate_limits': parse_limits(args.rate_limit, DEFAULT_LIMITS),
+               'room_rate_limits': parse_limits(args.room_rate_limit, DEFAULT_ROOM_LIMITS), 'core': args.core,
+               'search_index': not args.no_search_index}
+    if args.workers > 1:
+        from service.Shard import run_sharded
+        run_sharded(args.host, args.port, args.max_user, args.workers, use_uvloop=args.uvloop, **options)
+    else:
+        server = Server(args.host, args.port, args.max_user, **options)
+        run(server.run(), args.uvloop)
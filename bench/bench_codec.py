@@ -0,0 +1,72 @@
+"""
+消息编码微基准：每种编码对典型消息的编码、解码耗时和帧大小。
+
+编码 = encode_message（拆出路由头、编码 meta 和 body、按需压缩），
+解码 = decode_frame 后取 message（服务端转发只解析 route，另列一栏）。
+
+    python bench/bench_codec.py --compress
+"""
+import argparse
+import base64
+import os
+import random
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from Client.module.Codec import CODECS
+from Client.module.Framing import decode_frame, encode_message
+
+
+def sample_messages():
+    rng = random.Random(1)
+    users = [f"user{i:05d}" for i in range(1000)]
+    return {
+        'text': {'type': 'text', 'private': True, 'from_id': 'user00001', 'to_id': 'user00002',
+                 'content': 'hello, are we still on for lunch?', 'ts': 1234.5678},
+        'text_cjk': {'type': 'text', 'private': False, 'from_id': '小明', 'to_id': '项目群',
+                     'content': '今天下午三点在三楼会议室开会，请大家准时参加。' * 4},
+        'image': {'type': 'image', 'private': True, 'from_id': 'user00001', 'to_id': 'user00002',
+                  'content': base64.b64encode(rng.randbytes(12 * 1024)).decode(), 'image_id': 'f' * 32},
+        'file_status': {'type': 'file_status', 'private': True, 'from_id': 'user00002', 'to_id': 'user00001',
+                        'content': '', 'transfer_id': 'a' * 32, 'have': [[0, 96], [98, 120]], 'final': False},
+        'presence': {'type': 'presence', 'version': 812, 'online': users[:50], 'offline': users[50:70]},
+        'user_list': {'type': 'user_list', 'from_id': users, 'to_id': '', 'version': 812, 'page': 0, 'pages': 1},
+        'create_room': {'type': 'create_room', 'private': False, 'from_id': 'user00001', 'to_id': users[:40],
+                        'content': 'weekend-hiking'},
+    }
+
+
+def per_call(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=2000, help="每项计时的调用次数")
+    parser.add_argument('--compress', action='store_true', help="同时测 zlib 压缩后的结果")
+    args = parser.parse_args()
+
+    variants = [(name, codec, False) for name, codec in CODECS.items()]
+    if args.compress:
+        variants += [(name + '+zlib', codec, True) for name, codec in CODECS.items()]
+
+    print(f"{'message':<12} {'codec':<12} {'bytes':>7} {'encode us':>10} {'decode us':>10} {'route us':>9}")
+    for label, msg in sample_messages().items():
+        number = max(args.number // (1 + len(str(msg)) // 4096), 50)
+        for name, codec, compress in variants:
+            raw = encode_message(msg, compress, codec)
+            assert decode_frame(raw).message == msg
+            if compress and label == 'user_list':
+                # 用户名都在路由头里，压缩也必须生效
+                assert len(raw) < len(encode_message(msg, False, codec)) // 2, (label, name, len(raw))
+            encode = per_call(lambda: encode_message(msg, compress, codec), number)
+            decode = per_call(lambda: decode_frame(raw).message, number)
+            route = per_call(lambda: decode_frame(raw).route, number)
+            print(f"{label:<12} {name:<12} {len(raw):>7} {encode:>10.2f} {decode:>10.2f} {route:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
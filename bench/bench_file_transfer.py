@@ -0,0 +1,143 @@
+"""
+文件传输吞吐对比：base64 JSON 分片（旧路径）与二进制帧 + sendfile（新路径）。
+
+在本机启动一个服务器子进程，一个发送端把临时文件私聊发给一个接收端，
+接收端把分片写入临时文件，统计从发送文件头到收到 file_finish 的 MB/s。
+
+    python bench/bench_file_transfer.py --size-mb 128
+"""
+import argparse
+import base64
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from Client.module.Framing import FrameDecoder, VERSION, encode_message, encode_legacy, send_file_frame
+
+CHUNK_SIZE = 512 * 1024
+
+
+def start_server(port):
+    # 队列上限放大，避免发送端比接收端快时按慢消费者策略丢分片；关掉限流，测的是传输路径本身
+    code = (f"import asyncio, Server; "
+            f"asyncio.run(Server.Server('127.0.0.1', {port}, 100, max_queue_bytes=1 << 30, rate_limit=False).run())")
+    proc = subprocess.Popen([sys.executable, '-c', code], cwd=ROOT, stdout=subprocess.DEVNULL)
+    for _ in range(50):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+
+def login(port, name, framed, binary):
+    sock = socket.create_connection(('127.0.0.1', port))
+    decoder = FrameDecoder()
+    msg = {'type': 'login', 'private': True, 'from_id': name, 'to_id': 'All', 'content': ''}
+    if framed:
+        msg.update({'frame': VERSION, 'binary_file': binary})
+    sock.sendall(encode_legacy(msg))
+    if framed:
+        # 等待 login_ack，之后改用帧格式
+        while not any(f.message.get('type') == 'login_ack' for f in decoder.recv_from(sock)):
+            pass
+    return sock, decoder
+
+
+def send_file(sock, path, mode):
+    encode = encode_legacy if mode == 'legacy' else encode_message
+    route = {'type': 'file_chunk', 'private': True, 'from_id': 'sender', 'to_id': 'receiver', 'filename': 'bench'}
+    size = os.path.getsize(path)
+    sock.sendall(encode(dict(route, type='file_header', filesize=size)))
+    with open(path, 'rb') as f:
+        if mode == 'binary':
+            offset = 0
+            while offset < size:
+                count = min(CHUNK_SIZE, size - offset)
+                send_file_frame(sock, route, f, offset, count)
+                offset += count
+        else:
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                sock.sendall(encode(dict(route, content=base64.b64encode(data).decode('utf-8'))))
+    sock.sendall(encode(dict(route, type='file_finish')))
+
+
+def receive_file(sock, decoder, out):
+    while True:
+        for frame in decoder.recv_from(sock):
+            msg = frame.message
+            if msg['type'] == 'file_chunk':
+                out.write(msg['data'] if 'data' in msg else base64.b64decode(msg['content']))
+            elif msg['type'] == 'file_finish':
+                return
+
+
+def run_mode(port, mode, path):
+    framed = mode != 'legacy'
+    binary = mode == 'binary'
+    receiver, decoder = login(port, 'receiver', framed, binary)
+    sender, _ = login(port, 'sender', framed, binary)
+    time.sleep(0.2)
+    # 丢掉登录阶段的 user_list / login 广播
+    receiver.setblocking(False)
+    try:
+        while receiver.recv(1 << 20):
+            pass
+    except BlockingIOError:
+        pass
+    receiver.setblocking(True)
+    decoder = FrameDecoder()
+
+    with tempfile.TemporaryFile() as out:
+        start = time.perf_counter()
+        reader = threading.Thread(target=receive_file, args=(receiver, decoder, out))
+        reader.start()
+        send_file(sender, path, mode)
+        reader.join()
+        elapsed = time.perf_counter() - start
+        received = out.tell()
+
+    sender.close()
+    receiver.close()
+    return received, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=64)
+    parser.add_argument('--port', type=int, default=18888)
+    parser.add_argument('--modes', default='legacy,base64,binary',
+                        help="legacy: 裸 JSON + base64, base64: 帧 + base64, binary: 二进制帧 + sendfile")
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        f.write(os.urandom(size))
+        path = f.name
+
+    proc = start_server(args.port)
+    try:
+        print(f"{'mode':<8} {'MB':>8} {'seconds':>8} {'MB/s':>8}")
+        for mode in args.modes.split(','):
+            received, elapsed = run_mode(args.port, mode, path)
+            assert received == size, f"{mode}: received {received} of {size} bytes"
+            print(f"{mode:<8} {size / 2 ** 20:>8.0f} {elapsed:>8.2f} {size / 2 ** 20 / elapsed:>8.1f}")
+    finally:
+        proc.terminate()
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,568 @@
+"""
+聊天服务器负载测试。
+
+在本机启动服务器子进程，用若干个进程模拟成千上万个客户端，按与 Listener 相同的协议登录，
+然后按设定的比例和总速率发送私聊文本、房间文本、图片（缩略图消息加原图分片）、文件和创建房间。
+每条消息带上发送时的 time.monotonic()，接收端据此计算端到端延迟；
+同时从 /proc 采样服务器进程的 CPU 和内存（仅 Linux）。
+
+    python bench/bench_load.py --clients 2000 --rate 4000 --duration 30
+    python bench/bench_load.py --mix text=60,room=30,image=5,file=5 --save-baseline bench/baseline.json
+    python bench/bench_load.py --baseline bench/baseline.json   # 任一指标超过阈值时以状态 1 退出
+    python bench/bench_load.py --core protocol --uvloop   # 比较服务端核心，看 msgs/cpu-s
+
+基线文件里可以加一个 "thresholds" 字段覆盖 DEFAULT_THRESHOLDS。
+"""
+import argparse
+import array
+import asyncio
+import base64
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from Client.module.Framing import FrameDecoder, VERSION, encode_message, binary_header
+from Client.module.Transfer import CHUNK_SIZE
+
+DEFAULT_MIX = 'text=70,room=24,image=3,file=1,create=2'
+CONNECT_BATCH = 200  # 每批同时建立的连接数，避免 accept 队列溢出
+SETUP_WAIT = 1.0  # 创建房间后等待邀请送达的时间
+SAMPLE_INTERVAL = 0.5  # 服务器 CPU 和内存的采样间隔
+
+# 与基线相比的容许退化比例；lost_ratio 是绝对值
+DEFAULT_THRESHOLDS = {
+    'throughput': 0.10,
+    'mb_per_s': 0.10,
+    'p50': 0.25,
+    'p99': 0.30,
+    'cpu_percent': 0.20,
+    'rss_peak_mb': 0.20,
+    'msgs_per_cpu_s': 0.15,
+    'lost_ratio': 0.01,
+}
+LATENCY_SLACK = 0.002  # 延迟的绝对差小于这个值时不算退化，毫秒级的 p50 抖动很正常
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        mix[name.strip()] = float(weight)
+    unknown = set(mix) - {'text', 'room', 'image', 'file', 'create'}
+    if unknown:
+        raise ValueError(f"unknown message kinds: {', '.join(sorted(unknown))}")
+    return mix
+
+
+def raise_nofile():
+    """几千个连接需要放开文件描述符上限"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+# ---------------------------------------------------------------- 服务器进程
+
+def start_server(port, workers, persist_dir, core, use_uvloop):
+    history = repr(os.path.join(persist_dir, 'history')) if persist_dir else "''"
+    mailbox = repr(os.path.join(persist_dir, 'mailbox')) if persist_dir else "''"
+    # 关掉限流，基线不随限流的默认值变化
+    options = f"history_dir={history} or None, mailbox_dir={mailbox} or None, core={core!r}, rate_limit=False"
+    if workers > 1:
+        run = (f"from service.Shard import run_sharded; "
+               f"run_sharded('127.0.0.1', {port}, 4096, {workers}, use_uvloop={use_uvloop}, {options})")
+    else:
+        run = (f"import Server; from service.Protocol import run; "
+               f"run(Server.Server('127.0.0.1', {port}, 4096, {options}).run(), {use_uvloop})")
+    code = ("import resource; soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE); "
+            "resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard)); " + run)
+    proc = subprocess.Popen([sys.executable, '-c', code], cwd=ROOT, stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+
+def process_tree(pid):
+    """pid 和它的所有子进程（分片模式下的 worker）"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    pids, todo = [], [pid]
+    while todo:
+        current = todo.pop()
+        pids.append(current)
+        todo.extend(children.get(current, []))
+    return pids
+
+
+def cpu_seconds(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            total += int(fields[11]) + int(fields[12])  # utime + stime
+        except (OSError, IndexError, ValueError):
+            pass
+    return total / os.sysconf('SC_CLK_TCK')
+
+
+def rss_bytes(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/statm') as f:
+                total += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, IndexError, ValueError):
+            pass
+    return total
+
+
+class ServerSampler(threading.Thread):
+    """后台采样服务器进程树的 CPU 时间和 RSS 峰值"""
+
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.available = os.path.isdir('/proc')
+        self.stop_event = threading.Event()
+        self.rss_peak = 0
+        self.cpu_start = self.cpu_end = 0.0
+        self.wall_start = self.wall_end = 0.0
+
+    def begin(self):
+        if self.available:
+            self.cpu_start = cpu_seconds(process_tree(self.pid))
+        self.wall_start = time.monotonic()
+        self.start()
+
+    def run(self):
+        while self.available and not self.stop_event.wait(SAMPLE_INTERVAL):
+            self.rss_peak = max(self.rss_peak, rss_bytes(process_tree(self.pid)))
+
+    def end(self):
+        self.stop_event.set()
+        self.join()
+        self.wall_end = time.monotonic()
+        if self.available:
+            pids = process_tree(self.pid)
+            self.cpu_end = cpu_seconds(pids)
+            self.rss_peak = max(self.rss_peak, rss_bytes(pids))
+
+    def result(self, delivered):
+        if not self.available:
+            return {}
+        wall = self.wall_end - self.wall_start
+        cpu = self.cpu_end - self.cpu_start
+        return {
+            'cpu_percent': round(cpu / wall * 100, 1),
+            'rss_peak_mb': round(self.rss_peak / 2 ** 20, 1),
+            # 每个 CPU 秒投递的消息数，比较服务端核心和事件循环时看这一项
+            'msgs_per_cpu_s': round(delivered / cpu, 1) if cpu else None,
+        }
+
+
+# ---------------------------------------------------------------- 模拟客户端
+
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.expected = 0  # 预期的投递次数（房间消息每个成员算一次）
+        self.delivered = 0
+        self.bytes = 0
+        self.latency = {}  # kind -> array('d')
+
+    def record(self, kind, latency):
+        samples = self.latency.get(kind)
+        if samples is None:
+            samples = self.latency[kind] = array.array('d')
+        samples.append(latency)
+
+    def to_dict(self):
+        return {'sent': self.sent, 'expected': self.expected, 'delivered': self.delivered, 'bytes': self.bytes,
+                'latency': {kind: samples.tobytes() for kind, samples in self.latency.items()}}
+
+
+class SimClient:
+    def __init__(self, index, name, gen):
+        self.index = index
+        self.name = name
+        self.gen = gen
+        self.reader = self.writer = None
+        self.logged_in = None
+        self.created = 0
+
+    async def connect(self, port):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', port)
+        self.logged_in = asyncio.get_running_loop().create_future()
+        asyncio.get_running_loop().create_task(self.read_loop())
+        # 与 Listener.send_login 相同：声明支持的帧版本和二进制文件分片
+        login = {'type': 'login', 'private': False, 'from_id': self.name, 'to_id': 'All', 'content': '',
+                 'frame': VERSION, 'binary_file': True}
+        if self.gen.args.compress:
+            login['compress'] = ['zlib']
+        self.writer.write(encode_message(login))
+        await self.logged_in
+
+    async def read_loop(self):
+        decoder = FrameDecoder()
+        stats = self.gen.stats
+        try:
+            while True:
+                data = await self.reader.read(256 * 1024)
+                if not data:
+                    break
+                for frame in decoder.feed(data):
+                    msg_type = frame.route.get('type')
+                    if msg_type == 'file_chunk':
+                        stats.bytes += len(frame.body)
+                        continue
+                    if msg_type == 'login_ack':
+                        self.logged_in.set_result(None)
+                        continue
+                    if msg_type not in ('text', 'image', 'file_finish'):
+                        continue
+                    msg = frame.message
+                    ts = msg.get('ts')
+                    if ts is None or not self.gen.measuring:
+                        continue
+                    stats.delivered += 1
+                    stats.bytes += len(frame.raw)
+                    stats.record(msg['kind'], time.monotonic() - ts)
+        except (OSError, asyncio.CancelledError):
+            pass
+        finally:
+            if not self.logged_in.done():
+                self.logged_in.set_exception(ConnectionError(f"{self.name} disconnected before login_ack"))
+
+    def message(self, msg_type, to_id, private, kind, **fields):
+        msg = {'type': msg_type, 'private': private, 'from_id': self.name, 'to_id': to_id, 'kind': kind,
+               'ts': time.monotonic()}
+        msg.update(fields)
+        return encode_message(msg, self.gen.args.compress)
+
+    def file_frames(self, to_id, filename, size, kind, extra):
+        """与 SendWorker 相同的文件头、二进制分片、结束包"""
+        route = {'type': 'file_chunk', 'private': True, 'from_id': self.name, 'to_id': to_id, 'filename': filename}
+        frames = [self.message('file_header', to_id, True, kind, filename=filename, filesize=size, **extra)]
+        payload = self.gen.payload
+        for offset in range(0, size, CHUNK_SIZE):
+            count = min(CHUNK_SIZE, size - offset)
+            frames.append(binary_header(dict(route, offset=offset), count))
+            frames.append(payload[:count])
+        frames.append(self.message('file_finish', to_id, True, kind, filename=filename, **extra))
+        return frames
+
+    async def send_one(self, op):
+        gen = self.gen
+        stats = gen.stats
+        if op == 'room' and self.index < gen.room_clients:
+            room = f"bench-r{self.index // gen.room_size}"
+            data = [self.message('text', room, False, 'room', content=gen.text())]
+            stats.expected += gen.room_size - 1
+        elif op == 'image':
+            peer = gen.peer(self.index)
+            image_id = f"{self.name}-{stats.sent}"
+            # 先发缩略图消息，原图随后按文件分片发送
+            data = [self.message('image', peer, True, 'image', content=gen.thumb, image_id=image_id,
+                                 filename=image_id + '.jpg', filesize=gen.image_size)]
+            data += self.file_frames(peer, image_id + '.jpg', gen.image_size, 'image_file', {'image_id': image_id})
+            stats.expected += 2
+        elif op == 'file':
+            peer = gen.peer(self.index)
+            data = self.file_frames(peer, f"{self.name}-{stats.sent}.bin", gen.file_size, 'file', {})
+            stats.expected += 1
+        elif op == 'create':
+            self.created += 1
+            members = [self.name] + [gen.name(gen.peer(self.index, raw=True)) for _ in range(gen.room_size - 1)]
+            msg = {'type': 'create_room', 'private': False, 'from_id': self.name, 'to_id': members,
+                   'content': f"bench-c{self.name}-{self.created}"}
+            data = [encode_message(msg)]
+        else:
+            data = [self.message('text', gen.peer(self.index), True, 'text', content=gen.text())]
+            stats.expected += 1
+        stats.sent += 1
+        self.writer.writelines(data)
+        await self.writer.drain()
+
+    async def run_load(self, rate, deadline, ops, weights):
+        rng = random.Random(self.index)
+        loop = asyncio.get_running_loop()
+        # 泊松到达，错开各客户端的发送时间
+        while True:
+            await asyncio.sleep(rng.expovariate(rate))
+            if loop.time() >= deadline:
+                return
+            await self.send_one(rng.choices(ops, weights)[0])
+
+
+class Generator:
+    """一个进程里的一组模拟客户端"""
+
+    def __init__(self, first, count, args):
+        self.first = first
+        self.count = count
+        self.args = args
+        self.clients_total = args.clients
+        self.room_size = args.room_size
+        # 前 room_clients 个客户端按 room_size 一组分到固定房间
+        self.room_clients = args.clients // args.room_size * args.room_size if args.room_size > 1 else 0
+        self.image_size = args.image_kb * 1024
+        self.file_size = args.file_kb * 1024
+        self.payload = os.urandom(max(min(CHUNK_SIZE, max(self.image_size, self.file_size)), 1))
+        self.thumb = base64.b64encode(os.urandom(args.thumb_kb * 1024)).decode('ascii')
+        self.rng = random.Random(first)
+        self.stats = Stats()
+        self.measuring = False
+
+    @staticmethod
+    def name(index):
+        return f"bench{index}"
+
+    def peer(self, index, raw=False):
+        other = self.rng.randrange(self.clients_total - 1)
+        other += other >= index
+        return other if raw else self.name(other)
+
+    def text(self):
+        return 'x' * self.rng.randint(self.args.text_min, self.args.text_max)
+
+    async def run(self, barrier):
+        loop = asyncio.get_running_loop()
+        clients = [SimClient(i, self.name(i), self) for i in range(self.first, self.first + self.count)]
+        for start in range(0, len(clients), CONNECT_BATCH):
+            await asyncio.gather(*(c.connect(self.args.port) for c in clients[start:start + CONNECT_BATCH]))
+        await loop.run_in_executor(None, barrier.wait)
+
+        # 每组的第一个客户端创建固定房间
+        for client in clients:
+            if client.index < self.room_clients and client.index % self.room_size == 0:
+                members = [self.name(i) for i in range(client.index, client.index + self.room_size)]
+                client.writer.write(encode_message({'type': 'create_room', 'private': False,
+                                                    'from_id': client.name, 'to_id': members,
+                                                    'content': f"bench-r{client.index // self.room_size}"}))
+        await asyncio.sleep(SETUP_WAIT)
+        await loop.run_in_executor(None, barrier.wait)
+
+        mix = parse_mix(self.args.mix)
+        ops, weights = list(mix), list(mix.values())
+        self.measuring = True
+        deadline = loop.time() + self.args.duration
+        per_client = self.args.rate / self.clients_total
+        await asyncio.gather(*(c.run_load(per_client, deadline, ops, weights) for c in clients))
+        # 等待在途消息送达
+        await asyncio.sleep(self.args.drain)
+        self.measuring = False
+        for client in clients:
+            client.writer.close()
+        return self.stats.to_dict()
+
+
+def run_worker(first, count, args, barrier, results):
+    raise_nofile()
+    try:
+        results.put(asyncio.run(Generator(first, count, args).run(barrier)))
+    except Exception as e:
+        barrier.abort()
+        results.put({'error': f"{type(e).__name__}: {e}"})
+
+
+# ---------------------------------------------------------------- 汇总与基线
+
+def percentile(sorted_samples, q):
+    if not sorted_samples:
+        return None
+    return sorted_samples[min(len(sorted_samples) - 1, int(q * len(sorted_samples)))]
+
+
+def summarize(parts, args, elapsed, server):
+    sent = sum(p['sent'] for p in parts)
+    expected = sum(p['expected'] for p in parts)
+    delivered = sum(p['delivered'] for p in parts)
+    nbytes = sum(p['bytes'] for p in parts)
+    samples = {}
+    for part in parts:
+        for kind, raw in part['latency'].items():
+            samples.setdefault(kind, array.array('d')).frombytes(raw)
+
+    latency = {}
+    everything = []
+    for kind, values in sorted(samples.items()):
+        values = sorted(values)
+        everything.extend(values)
+        latency[kind] = {'p50': percentile(values, 0.5), 'p99': percentile(values, 0.99), 'count': len(values)}
+    everything.sort()
+    latency['all'] = {'p50': percentile(everything, 0.5), 'p99': percentile(everything, 0.99),
+                      'count': len(everything)}
+
+    return {
+        'config': {key: getattr(args, key) for key in
+                   ('clients', 'rate', 'duration', 'mix', 'room_size', 'thumb_kb', 'image_kb', 'file_kb',
+                    'text_min', 'text_max', 'workers', 'persist', 'compress', 'core', 'uvloop')},
+        'sent': sent,
+        'send_rate': round(sent / args.duration, 1),
+        'delivered': delivered,
+        'throughput': round(delivered / elapsed, 1),
+        'mb_per_s': round(nbytes / elapsed / 2 ** 20, 2),
+        'lost_ratio': round(max(expected - delivered, 0) / expected, 4) if expected else 0.0,
+        'latency': latency,
+        'server': server,
+    }
+
+
+def print_report(result):
+    print(f"sent {result['sent']} ops ({result['send_rate']}/s), delivered {result['delivered']} "
+          f"({result['throughput']}/s, {result['mb_per_s']} MB/s), lost {result['lost_ratio']:.2%}")
+    print(f"{'kind':<12} {'count':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    for kind, values in result['latency'].items():
+        if values['count']:
+            print(f"{kind:<12} {values['count']:>9} {values['p50'] * 1000:>9.2f} {values['p99'] * 1000:>9.2f}")
+    if result['server']:
+        print(f"server cpu {result['server']['cpu_percent']}%  rss peak {result['server']['rss_peak_mb']} MB  "
+              f"{result['server']['msgs_per_cpu_s']} msgs/cpu-s")
+
+
+def compare(result, baseline) -> list:
+    """返回超过阈值的指标说明，空列表表示没有退化"""
+    thresholds = dict(DEFAULT_THRESHOLDS, **baseline.get('thresholds', {}))
+    failures = []
+
+    def check(name, new, old, threshold, higher_is_better=False, slack=0.0):
+        if new is None or old is None:
+            return
+        if higher_is_better:
+            bad = new < old * (1 - threshold)
+        else:
+            bad = new > old * (1 + threshold) and new - old > slack
+        if bad:
+            failures.append(f"{name}: {new} vs baseline {old} (threshold {threshold:.0%})")
+
+    check('throughput', result['throughput'], baseline.get('throughput'), thresholds['throughput'], True)
+    check('mb_per_s', result['mb_per_s'], baseline.get('mb_per_s'), thresholds['mb_per_s'], True)
+    check('server.msgs_per_cpu_s', result['server'].get('msgs_per_cpu_s'),
+          baseline.get('server', {}).get('msgs_per_cpu_s'), thresholds['msgs_per_cpu_s'], True)
+    for kind, values in result['latency'].items():
+        old = baseline.get('latency', {}).get(kind, {})
+        for q in ('p50', 'p99'):
+            check(f"latency.{kind}.{q}", values[q], old.get(q), thresholds[q], slack=LATENCY_SLACK)
+    for key in ('cpu_percent', 'rss_peak_mb'):
+        check(f"server.{key}", result['server'].get(key), baseline.get('server', {}).get(key), thresholds[key])
+    if result['lost_ratio'] > baseline.get('lost_ratio', 0.0) + thresholds['lost_ratio']:
+        failures.append(f"lost_ratio: {result['lost_ratio']} vs baseline {baseline.get('lost_ratio', 0.0)}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=2000, help="所有客户端合计每秒发送的操作数")
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--drain', type=float, default=2, help="停止发送后等待在途消息的秒数")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="text/room/image/file/create 的权重")
+    parser.add_argument('--room-size', type=int, default=20)
+    parser.add_argument('--thumb-kb', type=int, default=20, help="图片消息里缩略图的大小")
+    parser.add_argument('--image-kb', type=int, default=300, help="图片原图的大小")
+    parser.add_argument('--file-kb', type=int, default=2048)
+    parser.add_argument('--text-min', type=int, default=10)
+    parser.add_argument('--text-max', type=int, default=200)
+    parser.add_argument('--procs', type=int, default=max(1, min(4, (os.cpu_count() or 2) - 1)),
+                        help="模拟客户端的进程数")
+    parser.add_argument('--workers', type=int, default=1, help="服务器分片数")
+    parser.add_argument('--persist', action='store_true', help="开启聊天记录和离线信箱（写临时目录）")
+    parser.add_argument('--compress', action='store_true', help="登录时协商 zlib 压缩")
+    parser.add_argument('--core', choices=('sock', 'protocol'), default='sock', help="服务端核心，见 service.Protocol")
+    parser.add_argument('--uvloop', action='store_true', help="服务器用 uvloop 事件循环（需要已安装）")
+    parser.add_argument('--port', type=int, default=18890)
+    parser.add_argument('--json', help="把结果写到这个文件")
+    parser.add_argument('--save-baseline', help="把结果保存为基线")
+    parser.add_argument('--baseline', help="与基线比较，超过阈值时以状态 1 退出")
+    args = parser.parse_args()
+    parse_mix(args.mix)
+    raise_nofile()
+
+    persist_dir = tempfile.mkdtemp(prefix='bench-load-') if args.persist else None
+    proc = start_server(args.port, args.workers, persist_dir, args.core, args.uvloop)
+    sampler = ServerSampler(proc.pid)
+    try:
+        procs = max(1, min(args.procs, args.clients))
+        ctx = multiprocessing.get_context('spawn')
+        barrier = ctx.Barrier(procs + 1)
+        results = ctx.Queue()
+        workers = []
+        for i in range(procs):
+            first = args.clients * i // procs
+            count = args.clients * (i + 1) // procs - first
+            worker = ctx.Process(target=run_worker, args=(first, count, args, barrier, results), daemon=True)
+            worker.start()
+            workers.append(worker)
+
+        barrier.wait()  # 全部登录
+        print(f"{args.clients} clients logged in")
+        barrier.wait()  # 房间已创建，开始计时
+        sampler.begin()
+        parts = [results.get() for _ in workers]
+        sampler.end()
+        for worker in workers:
+            worker.join()
+    except threading.BrokenBarrierError:
+        parts = [results.get() for _ in workers]
+    finally:
+        proc.terminate()
+        proc.wait()
+        if persist_dir:
+            shutil.rmtree(persist_dir, ignore_errors=True)
+
+    errors = [p['error'] for p in parts if 'error' in p]
+    if errors:
+        sys.exit("client error: " + errors[0])
+
+    delivered = sum(p['delivered'] for p in parts)
+    result = summarize(parts, args, sampler.wall_end - sampler.wall_start, sampler.result(delivered))
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"baseline saved to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != result['config']:
+            print("warning: baseline was recorded with a different configuration")
+        failures = compare(result, baseline)
+        for failure in failures:
+            print("REGRESSION", failure)
+        if failures:
+            sys.exit(1)
+        print("no regression against baseline")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+import asyncio
+import collections
+import socket
+
+from Client.module.Codec import JSON
+from Client.module.Flow import FRAGMENT_SIZE, LANE_CONTROL, LANE_IMAGE, LANES, lane_of, limit_unsent
+from Client.module.Framing import encode_message, encode_legacy, fragment_header
+
+# 慢消费者策略：发送队列超过上限时如何处理
+POLICY_DROP = 'drop'  # 丢弃新消息
+POLICY_DROP_FILE_CHUNK = 'drop_file_chunk'  # 优先丢弃队列里最旧的文件分片，仍不够再丢新消息
+POLICY_DISCONNECT = 'disconnect'  # 直接断开连接
+
+MAX_QUEUE_BYTES = 8 * 1024 * 1024  # 每个连接发送队列的字节上限
+MAX_BATCH_BYTES = 256 * 1024  # 一次 sendmsg 合并发送的上限
+MAX_BATCH_FRAMES = 64
+
+_HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')  # Windows 没有 sendmsg
+
+
+class Connection:
+    """
+    一个客户端连接。
+    发送不在调用方的协程里等待：消息先进入有界队列，由每个连接自己的写协程取出，
+    小帧合并后一次 sendmsg 发出。某个客户端接收慢只会让它自己的队列变长。
+    队列按 Flow.LANES 分成几条通道，写协程总是先取高优先级的；对方支持分片时
+    image、bulk 通道的大帧每批只发一个分片，文字消息不会排在整个文件分片后面。
+    """
+    def __init__(self, sock, loop, max_queue_bytes=MAX_QUEUE_BYTES, policy=POLICY_DROP_FILE_CHUNK, metrics=None):
+        self.sock = sock
+        self.loop = loop
+        self.name = None
+        self.framed = False  # 登录时协商，True 表示对方支持长度前缀帧
+        self.binary = False  # 对方能否接收原始字节的文件分片帧
+        self.compress = False  # 对方能否解压 FLAG_ZLIB 帧
+        self.codec = JSON  # 发给对方的帧用的编码，见 Client.module.Codec
+        self.presence = False  # 登录时订阅了在线状态增量，否则按旧方式收 login/logout
+        self.interest = None  # 只关心这些用户的在线状态，None 表示全部，见 service.Presence
+        self.presence_version = None  # 最近发给这个连接的在线状态版本
+        self.decoder = None  # 读协程的 FrameDecoder，抓取指标时查看缓冲区大小
+        self.metrics = metrics  # service.Metrics，为 None 时不统计
+        self.last_seen = loop.time()  # 最近一次收到数据的时间
+        self.heartbeat = False  # 对方发过 ping，之后长时间没有数据就可以断开
+        self.buckets = None  # 限流用的令牌桶，见 service.RateLimit
+        self.flow_sent = {}  # 类别 -> 下次可以再发 flow 消息的时间
+        self.fragment = False  # 对方能拼接 KIND_FRAGMENT 分片，登录时协商
+
+        self.max_queue_bytes = max_queue_bytes
+        self.policy = policy
+        self.lanes = [collections.deque() for _ in LANES]  # 每条通道一个队列，元素为 (data, is_bulk, 入队时间)
+        self.partial = {}  # 通道 -> (未发完的帧剩下的部分, 入队时间)，已经开始发送，不再参与丢弃
+        self.queued_bytes = 0
+        self.dropped = 0
+        self.closed = False
+
+        self._wakeup = asyncio.Event()
+        self._writer = self._start_writer()
+
+    def _start_writer(self):
+        return self.loop.create_task(self._write_loop())
+
+    def encode(self, msg):
+        return encode_message(msg, self.compress, self.codec) if self.framed else encode_legacy(msg)
+
+    def enable_fragments(self):
+        """对方在登录时声明支持分片"""
+        self.fragment = True
+        limit_unsent(self.sock)
+
+    def send(self, data, bulk=False, lane=LANE_CONTROL) -> bool:
+        """
+        把已编码的数据放入 lane 通道的发送队列，不阻塞。
+        bulk 表示文件分片等可以按策略丢弃的大块数据。返回是否入队成功。
+        """
+        if self.closed:
+            return False
+
+        size = len(data)
+        if self.queued_bytes + size > self.max_queue_bytes and self.queued_bytes:
+            if not self._make_room(size):
+                return False
+
+        self.lanes[lane].append((data, bulk, self.loop.time()))
+        self.queued_bytes += size
+        self._wakeup.set()
+        return True
+
+    def send_msg(self, msg) -> bool:
+        return self.send(self.encode(msg), lane=lane_of(msg.get('type')))
+
+    @property
+    def queued_frames(self):
+        return sum(map(len, self.lanes)) + len(self.partial)
+
+    def _make_room(self, size) -> bool:
+        if self.policy == POLICY_DISCONNECT:
+            print(f"Slow consumer {self.name}: queue full, disconnecting")
+            self.close()
+            return False
+
+        if self.policy == POLICY_DROP_FILE_CHUNK:
+            # 从优先级最低的通道、最旧的开始丢文件分片
+            for lane in reversed(LANES):
+                queue = self.lanes[lane]
+                kept = collections.deque()
+                while queue and self.queued_bytes + size > self.max_queue_bytes:
+                    item = queue.popleft()
+                    if item[1]:
+                        self.queued_bytes -= len(item[0])
+                        self.dropped += 1
+                    else:
+                        kept.append(item)
+                kept.extend(queue)
+                self.lanes[lane] = kept
+                if self.queued_bytes + size <= self.max_queue_bytes:
+                    return True
+
+        self.dropped += 1
+        return False
+
+    async def _write_loop(self):
+        try:
+            while not self.closed:
+                if not self.queued_bytes:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+
+                batch, batch_bytes, enqueued = self._take_batch()
+                await self._send_buffers(batch)
+                self._batch_sent(batch_bytes, enqueued)
+        except asyncio.CancelledError:
+            pass
+        except OSError as e:
+            print(f"Send error to {self.name}: {e}")
+            self.close()
+
+    def _take_batch(self):
+        """
+        按通道优先级取出一批帧合并发送，返回 (数据列表, 字节数, 批内最早的入队时间)。
+        image、bulk 通道每批最多带 FRAGMENT_SIZE 字节，写完这一批就回来重新看高优先级的通道
+        """
+        batch = []
+        batch_bytes = 0
+        enqueued = None
+        for lane, queue in enumerate(self.lanes):
+            limit = MAX_BATCH_BYTES if lane < LANE_IMAGE else FRAGMENT_SIZE
+            while len(batch) < MAX_BATCH_FRAMES and batch_bytes < limit:
+                if lane in self.partial:
+                    rest, queued_at = self.partial.pop(lane)
+                elif queue:
+                    data, _, queued_at = queue.popleft()
+                    if not (self.fragment and lane >= LANE_IMAGE and len(data) > FRAGMENT_SIZE):
+                        batch.append(data)
+                        batch_bytes += len(data)
+                        enqueued = queued_at if enqueued is None else min(enqueued, queued_at)
+                        continue
+                    rest = memoryview(data)
+                else:
+                    break
+                # 大帧切出一个分片，剩下的留到下一批
+                piece = rest[:FRAGMENT_SIZE]
+                more = len(rest) > FRAGMENT_SIZE
+                if more:
+                    self.partial[lane] = (rest[FRAGMENT_SIZE:], queued_at)
+                batch.append(fragment_header(lane, len(piece), more))
+                batch.append(piece)
+                batch_bytes += len(piece)
+                enqueued = queued_at if enqueued is None else min(enqueued, queued_at)
+        self.queued_bytes -= batch_bytes
+        return batch, batch_bytes, enqueued
+
+    def _batch_sent(self, batch_bytes, enqueued):
+        if self.metrics:
+            # 每批只记一次，延迟取批内最早的一帧
+            self.metrics.send_latency.observe(self.loop.time() - enqueued)
+            self.metrics.sent_bytes += batch_bytes
+
+    async def _send_buffers(self, buffers):
+        if not _HAS_SENDMSG:
+            await self.loop.sock_sendall(self.sock, b''.join(buffers))
+            return
+
+        buffers = [memoryview(b) for b in buffers]
+        while buffers:
+            try:
+                sent = self.sock.sendmsg(buffers)
+            except (BlockingIOError, InterruptedError):
+                await self._wait_writable()
+                continue
+
+            # 跳过已经发出的部分
+            while sent:
+                if sent >= len(buffers[0]):
+                    sent -= len(buffers[0])
+                    buffers.pop(0)
+                else:
+                    buffers[0] = buffers[0][sent:]
+                    sent = 0
+
+    async def _wait_writable(self):
+        fut = self.loop.create_future()
+        fd = self.sock.fileno()
+
+        def on_writable():
+            if not fut.done():
+                fut.set_result(None)
+
+        self.loop.add_writer(fd, on_writable)
+        try:
+            await fut
+        finally:
+            self.loop.remove_writer(fd)
+
+    def close(self):
+        """停止写协程并让读协程尽快结束"""
+        if self.closed:
+            return
+        self.closed = True
+        self._clear()
+        self._writer.cancel()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _clear(self):
+        for queue in self.lanes:
+            queue.clear()
+        self.partial.clear()
+        self.queued_bytes = 0
+
+    @property
+    def pending_bytes(self):
+        """还没写进 socket 的字节数"""
+        return self.queued_bytes
+
+    @property
+    def recv_buffer_size(self):
+        return self.decoder.capacity if self.decoder else 0
+
+    async def wait_closed(self):
+        await asyncio.gather(self._writer, return_exceptions=True)
@@ -0,0 +1,293 @@
+"""
+服务端聊天记录存储。
+
+每个私聊会话和每个房间一个目录，目录下是分段的追加写日志：
+    <base_seq>.log  记录 = length(4) | seq(8) | ts(8) | payload，payload 是消息的帧编码
+    <base_seq>.idx  稀疏索引，每 index_every 条记录写一项 seq(8) | offset(8)
+读取时按 seq 找到分段，在稀疏索引里二分定位后用 mmap 顺序扫描。
+
+所有磁盘操作都在一个后台线程里完成：事件循环只把帧放进队列，写线程批量写入，
+按 fsync_interval 的节奏 fsync。读请求也进同一个队列，所以一定能读到之前已提交的消息。
+"""
+import bisect
+import collections
+import concurrent.futures
+import hashlib
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+from Client.module.Framing import decode_frame, FrameError
+
+RECORD = struct.Struct('!IQd')  # payload 长度, seq, 时间戳
+INDEX = struct.Struct('!QQ')  # seq, 记录在分段文件里的偏移
+
+SEGMENT_BYTES = 16 * 1024 * 1024  # 单个分段文件的大小上限
+INDEX_EVERY = 64  # 每多少条记录写一项稀疏索引
+FSYNC_INTERVAL = 1.0  # 秒；0 表示每批写入后都 fsync
+MAX_OPEN_LOGS = 128  # 同时打开的会话日志数量，超过后关闭最久未用的
+MAX_BATCH = 1024
+
+
+def private_key(user_a, user_b):
+    a, b = sorted((user_a, user_b))
+    return f"p:{a}\x00{b}"
+
+
+def room_key(room_name):
+    return f"r:{room_name}"
+
+
+class ConversationLog:
+    """一个会话的分段日志，只在写线程里使用"""
+
+    def __init__(self, path, segment_bytes, index_every):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.index_every = index_every
+
+        # 目录在第一次写入时才创建，只读不存在的会话不会在磁盘上留下空目录
+        names = os.listdir(path) if os.path.isdir(path) else []
+        self.segments = sorted(int(name[:-4]) for name in names if name.endswith('.log'))
+        self.next_seq = 0
+        self.log_file = None
+        self.idx_file = None
+        self.size = 0
+        self.since_index = 0
+        if self.segments:
+            self._recover(self.segments[-1])
+
+    def _recover(self, base):
+        """扫描最后一个分段，确定下一个 seq，截掉写了一半的尾部记录"""
+        log_path = self._log_path(base)
+        offset = 0
+        seq = base
+        with open(log_path, 'rb') as f:
+            data = f.read()
+        while offset + RECORD.size <= len(data):
+            length, seq_, _ = RECORD.unpack_from(data, offset)
+            end = offset + RECORD.size + length
+            if end > len(data):
+                break
+            seq = seq_ + 1
+            offset = end
+        if offset != len(data):
+            with open(log_path, 'r+b') as f:
+                f.truncate(offset)
+        self.next_seq = seq
+        self.size = offset
+        self.since_index = self.index_every  # 续写时先补一项索引
+
+    def _log_path(self, base):
+        return os.path.join(self.path, f"{base:020d}.log")
+
+    def _idx_path(self, base):
+        return os.path.join(self.path, f"{base:020d}.idx")
+
+    def _open_tail(self):
+        if not self.segments or self.size >= self.segment_bytes:
+            self.close()
+            os.makedirs(self.path, exist_ok=True)
+            self.segments.append(self.next_seq)
+            self.size = 0
+            self.since_index = self.index_every
+        if self.log_file is None:
+            base = self.segments[-1]
+            self.log_file = open(self._log_path(base), 'ab')
+            self.idx_file = open(self._idx_path(base), 'ab')
+
+    def append(self, payload, ts):
+        self._open_tail()
+        if self.since_index >= self.index_every:
+            self.idx_file.write(INDEX.pack(self.next_seq, self.size))
+            self.since_index = 0
+        self.log_file.write(RECORD.pack(len(payload), self.next_seq, ts))
+        self.log_file.write(payload)
+        self.size += RECORD.size + len(payload)
+        self.since_index += 1
+        self.next_seq += 1
+
+    def flush(self, fsync):
+        if self.log_file is None:
+            return
+        self.log_file.flush()
+        self.idx_file.flush()
+        if fsync:
+            os.fsync(self.log_file.fileno())
+            os.fsync(self.idx_file.fileno())
+
+    def read(self, lo, hi):
+        """读取 seq 在 [lo, hi) 之间的记录，返回 [(seq, ts, payload)]"""
+        records = []
+        first = max(bisect.bisect_right(self.segments, lo) - 1, 0)
+        for base in self.segments[first:]:
+            if base >= hi:
+                break
+            records.extend(self._read_segment(base, lo, hi))
+        return records
+
+    def _read_segment(self, base, lo, hi):
+        log_path = self._log_path(base)
+        if not os.path.exists(log_path) or os.path.getsize(log_path) == 0:
+            return []
+
+        # 稀疏索引里找不超过 lo 的最后一项
+        offset = 0
+        idx_path = self._idx_path(base)
+        if os.path.exists(idx_path):
+            with open(idx_path, 'rb') as f:
+                idx = f.read()
+            entries = [INDEX.unpack_from(idx, i) for i in range(0, len(idx) - INDEX.size + 1, INDEX.size)]
+            pos = bisect.bisect_right([seq for seq, _ in entries], lo) - 1
+            if pos >= 0:
+                offset = entries[pos][1]
+
+        records = []
+        with open(log_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            while offset + RECORD.size <= len(mm):
+                length, seq, ts = RECORD.unpack_from(mm, offset)
+                start = offset + RECORD.size
+                offset = start + length
+                if offset > len(mm) or seq >= hi:
+                    break
+                if seq >= lo:
+                    records.append((seq, ts, mm[start:offset]))
+        return records
+
+    def close(self):
+        if self.log_file is not None:
+            self.flush(fsync=True)
+            self.log_file.close()
+            self.idx_file.close()
+            self.log_file = None
+            self.idx_file = None
+
+
+class HistoryStore:
+    """
+    聊天记录引擎。append 和 read 可以在事件循环里直接调用，都不会阻塞。
+    """
+
+    def __init__(self, root, segment_bytes=SEGMENT_BYTES, index_every=INDEX_EVERY,
+                 fsync_interval=FSYNC_INTERVAL, max_open_logs=MAX_OPEN_LOGS):
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.index_every = index_every
+        self.fsync_interval = fsync_interval
+        self.max_open_logs = max_open_logs
+
+        self.logs = collections.OrderedDict()  # key -> ConversationLog，按最近使用排序
+        self.dirty = set()
+        self.last_fsync = time.monotonic()
+
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._run, name='history-writer', daemon=True)
+        self.thread.start()
+
+    def append(self, key, frame):
+        """记录一条消息，只入队"""
+        self.queue.put(('append', key, frame, time.time()))
+
+    def read(self, key, before=None, limit=50) -> concurrent.futures.Future:
+        """
+        读取 seq 小于 before 的最近 limit 条消息（before 为空表示从最新开始）。
+        结果是 (messages, cursor)，cursor 为这一页第一条的 seq，传给下一次的 before 继续向前翻。
+        """
+        future = concurrent.futures.Future()
+        self.queue.put(('read', key, (before, limit), future))
+        return future
+
+    def close(self):
+        future = concurrent.futures.Future()
+        self.queue.put(('close', None, None, future))
+        future.result()
+
+    def _log_path(self, key):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, name[:2], name)
+
+    def _log(self, key):
+        log = self.logs.get(key)
+        if log is None:
+            log = ConversationLog(self._log_path(key), self.segment_bytes, self.index_every)
+            self.logs[key] = log
+            while len(self.logs) > self.max_open_logs:
+                old_key, old = self.logs.popitem(last=False)
+                old.close()
+                self.dirty.discard(old_key)
+        else:
+            self.logs.move_to_end(key)
+        return log
+
+    def _run(self):
+        while True:
+            timeout = self.fsync_interval if self.dirty else None
+            try:
+                batch = [self.queue.get(timeout=timeout)]
+            except queue.Empty:
+                batch = []
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            reads = []
+            for op, key, arg, extra in batch:
+                if op == 'append':
+                    try:
+                        self._log(key).append(arg.encoded(True), extra)
+                        self.dirty.add(key)
+                    except OSError as e:
+                        print(f"History write error: {e}")
+                else:
+                    reads.append((op, key, arg, extra))
+
+            self._flush(force=bool(reads))
+
+            for op, key, arg, future in reads:
+                if op == 'close':
+                    for log in self.logs.values():
+                        log.close()
+                    self.logs.clear()
+                    future.set_result(None)
+                    return
+                try:
+                    future.set_result(self._read_page(key, *arg))
+                except Exception as e:
+                    future.set_exception(e)
+
+    def _flush(self, force):
+        if not self.dirty:
+            return
+        now = time.monotonic()
+        fsync = now - self.last_fsync >= self.fsync_interval
+        if not (fsync or force or self.fsync_interval == 0):
+            # 写入已进入用户态缓冲区，等到 fsync 时间点再一起落盘
+            return
+        for key in self.dirty:
+            self.logs[key].flush(fsync or self.fsync_interval == 0)
+        if fsync or self.fsync_interval == 0:
+            self.dirty.clear()
+            self.last_fsync = now
+
+    def _read_page(self, key, before, limit):
+        # 会话名来自客户端，没有记录的会话直接返回空页，不打开也不缓存
+        if key not in self.logs and not os.path.isdir(self._log_path(key)):
+            return [], None
+        log = self._log(key)
+        hi = log.next_seq if before is None else min(before, log.next_seq)
+        lo = max(hi - limit, 0)
+        messages = []
+        for seq, ts, payload in log.read(lo, hi):
+            try:
+                msg = decode_frame(bytes(payload)).json_message()
+            except (FrameError, ValueError):
+                continue
+            msg['seq'] = seq
+            msg['ts'] = ts
+            messages.append(msg)
+        return messages, (lo if lo > 0 else None)
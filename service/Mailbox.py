@@ -0,0 +1,188 @@
+"""
+离线消息信箱。
+
+发给离线用户的私聊、房间消息和房间邀请先存进收件人的信箱，登录时合并成少量大块一次性发出。
+信箱先放在内存里，超过 memory_threshold 后新消息追加写入磁盘上的溢出文件；
+每个信箱有条数、字节数和存放时间上限，长期不上线的用户占用的内存和磁盘都是有界的。
+溢出文件只用于控制内存，不保证服务器重启后仍然存在。
+"""
+import collections
+import hashlib
+import os
+import re
+import struct
+import time
+
+from Client.module.Codec import JSON
+from Client.module.Framing import decode_frame
+
+SPILL_RECORD = struct.Struct('!dI')  # 时间戳, 帧长度
+
+MEMORY_THRESHOLD = 256 * 1024  # 单个信箱在内存里的字节数上限，超过后写入溢出文件
+MAX_BYTES = 16 * 1024 * 1024  # 单个信箱总字节数上限
+MAX_MESSAGES = 10000  # 单个信箱总条数上限
+MAX_AGE = 7 * 24 * 3600  # 消息最长保存时间（秒）
+MAX_MAILBOXES = 100000  # 信箱总数上限，超过后淘汰最久没有新消息的信箱
+FLUSH_BATCH_BYTES = 1024 * 1024  # 登录时每次发送合并的字节数
+SPILL_NAME = re.compile(r'[0-9a-f]{40}\.spill')  # 溢出文件名，见 OfflineStore.put
+
+
+class Mailbox:
+    def __init__(self, path, memory_threshold):
+        self.path = path
+        self.memory_threshold = memory_threshold
+        self.memory = collections.deque()  # (ts, data)，最早的消息
+        self.memory_bytes = 0
+        self.spill_file = None
+        self.spilled = 0  # 溢出文件里的条数
+        self.spilled_bytes = 0
+        self.updated = time.time()
+
+    def __len__(self):
+        return len(self.memory) + self.spilled
+
+    @property
+    def total_bytes(self):
+        return self.memory_bytes + self.spilled_bytes
+
+    def put(self, data, ts):
+        self.updated = ts
+        # 一旦开始溢出，后续消息都写文件，保证顺序
+        if self.spilled or self.memory_bytes + len(data) > self.memory_threshold:
+            if self.spill_file is None:
+                self.spill_file = open(self.path, 'ab')
+            self.spill_file.write(SPILL_RECORD.pack(ts, len(data)))
+            self.spill_file.write(data)
+            self.spilled += 1
+            self.spilled_bytes += len(data)
+        else:
+            self.memory.append((ts, data))
+            self.memory_bytes += len(data)
+
+    def drop_oldest(self) -> bool:
+        if not self.memory:
+            return False
+        _, data = self.memory.popleft()
+        self.memory_bytes -= len(data)
+        return True
+
+    def expire(self, deadline):
+        while self.memory and self.memory[0][0] < deadline:
+            self.drop_oldest()
+
+    def take(self, deadline) -> list:
+        """取出全部未过期的消息并清空信箱"""
+        messages = [data for ts, data in self.memory if ts >= deadline]
+        if self.spill_file is not None:
+            self.spill_file.close()
+            with open(self.path, 'rb') as f:
+                spill = f.read()
+            offset = 0
+            while offset + SPILL_RECORD.size <= len(spill):
+                ts, length = SPILL_RECORD.unpack_from(spill, offset)
+                offset += SPILL_RECORD.size
+                if ts >= deadline:
+                    messages.append(spill[offset:offset + length])
+                offset += length
+        self.clear()
+        return messages
+
+    def clear(self):
+        self.memory.clear()
+        self.memory_bytes = 0
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+        if self.spilled and os.path.exists(self.path):
+            os.remove(self.path)
+        self.spilled = 0
+        self.spilled_bytes = 0
+
+
+class OfflineStore:
+    """按用户名管理信箱"""
+
+    def __init__(self, root, memory_threshold=MEMORY_THRESHOLD, max_bytes=MAX_BYTES,
+                 max_messages=MAX_MESSAGES, max_age=MAX_AGE, max_mailboxes=MAX_MAILBOXES):
+        self.root = root
+        self.memory_threshold = memory_threshold
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.max_mailboxes = max_mailboxes
+        self.mailboxes = collections.OrderedDict()  # user -> Mailbox，按最近收到消息排序
+        self.dropped = 0
+
+        # 上次运行留下的溢出文件没有对应的内存部分，直接清掉；目录可能和别的数据共用，只删溢出文件
+        os.makedirs(root, exist_ok=True)
+        for name in os.listdir(root):
+            if SPILL_NAME.fullmatch(name):
+                try:
+                    os.remove(os.path.join(root, name))
+                except OSError:
+                    pass
+
+    def put(self, user, data):
+        box = self.mailboxes.get(user)
+        if box is None:
+            name = hashlib.sha1(user.encode('utf-8')).hexdigest()
+            box = Mailbox(os.path.join(self.root, name + '.spill'), self.memory_threshold)
+            self.mailboxes[user] = box
+            while len(self.mailboxes) > self.max_mailboxes:
+                _, old = self.mailboxes.popitem(last=False)
+                self.dropped += len(old)
+                old.clear()
+        else:
+            self.mailboxes.move_to_end(user)
+
+        # 超过上限时先丢最早的消息，丢不掉（都在溢出文件里）就丢新消息
+        while len(box) >= self.max_messages or box.total_bytes + len(data) > self.max_bytes:
+            if not box.drop_oldest():
+                self.dropped += 1
+                return False
+            self.dropped += 1
+        box.put(data, time.time())
+        return True
+
+    def take(self, user) -> list:
+        box = self.mailboxes.pop(user, None)
+        if box is None:
+            return []
+        return box.take(time.time() - self.max_age)
+
+    def sweep(self):
+        """清理过期消息和空信箱，由服务器定时调用"""
+        deadline = time.time() - self.max_age
+        for user in list(self.mailboxes):
+            box = self.mailboxes[user]
+            box.expire(deadline)
+            # 溢出文件里的消息都比最后一次写入早，整箱过期时一起删除
+            if box.updated < deadline or not len(box):
+                box.clear()
+                del self.mailboxes[user]
+
+    def close(self):
+        for box in self.mailboxes.values():
+            box.clear()
+        self.mailboxes.clear()
+
+
+def flush_batches(messages, framed, compress=False, codec=JSON):
+    """
+    把信箱里的帧（JSON 编码）按连接的格式合并成不超过 FLUSH_BATCH_BYTES 的几大块，对方支持时逐帧压缩
+    """
+    batch = []
+    size = 0
+    for data in messages:
+        if not framed:
+            data = decode_frame(data).encoded(False)
+        elif compress or codec is not JSON:
+            data = decode_frame(data).encoded(True, True, compress, codec)
+        batch.append(data)
+        size += len(data)
+        if size >= FLUSH_BATCH_BYTES:
+            yield b''.join(batch)
+            batch = []
+            size = 0
+    if batch:
+        yield b''.join(batch)
@@ -0,0 +1,219 @@
+"""
+服务端运行指标。
+
+热路径上只做整数累加和一次 bisect：按消息类型统计收发条数和字节数、房间扇出、发送延迟。
+连接数、发送队列深度、缓冲区大小这类状态量不在热路径上维护，抓取时遍历连接现算。
+指标以 Prometheus 文本格式通过本地 HTTP 端口输出：curl http://localhost:<port>/metrics
+默认只监听 METRICS_HOST，不跟着聊天端口的 --host 对外暴露。
+"""
+import asyncio
+import bisect
+import collections
+import time
+
+try:
+    import fcntl
+    import termios
+except ImportError:  # Windows
+    fcntl = termios = None
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)  # 秒
+FANOUT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+LAG_INTERVAL = 0.5  # 事件循环延迟的采样间隔（秒）
+TOP_CONNECTIONS = 20  # 按队列字节数输出前几个连接的明细
+METRICS_HOST = '127.0.0.1'
+
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # 最后一个桶是 +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, help_text, labels=''):
+        lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        sep = ',' if labels else ''
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {total}')
+        lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}" if labels else f"{name}_sum {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}" if labels else f"{name}_count {self.count}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _counter(name, help_text, values: dict, label, kind='counter'):
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    for key, value in values.items():
+        lines.append(f'{name}{{{label}="{_escape(key)}"}} {value}')
+    return lines
+
+
+def _gauge(name, help_text, value, kind='gauge'):
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+
+
+def unsent_bytes(sock):
+    """内核发送缓冲区里还没发出的字节数，只有 Linux 支持"""
+    if fcntl is None:
+        return 0
+    try:
+        buf = fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b'\0\0\0\0')
+        return int.from_bytes(buf, 'little')
+    except (OSError, ValueError):
+        return 0
+
+
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.messages_in = collections.defaultdict(int)  # type -> 条数
+        self.bytes_in = collections.defaultdict(int)  # type -> 帧字节数（旧版裸 JSON 不计）
+        self.messages_out = collections.defaultdict(int)
+        self.bytes_out = collections.defaultdict(int)
+        self.recv_bytes = 0  # socket 收到的全部字节
+        self.sent_bytes = 0  # socket 实际写出的全部字节
+        self.room_deliveries = collections.defaultdict(int)  # 房间 -> 累计投递人次
+        self.fanout = Histogram(FANOUT_BUCKETS)
+        self.send_latency = Histogram(LATENCY_BUCKETS)  # 入队到写入 socket
+        self.loop_lag = Histogram(LATENCY_BUCKETS)
+        self.loop_lag_max = 0.0
+        self.connections_opened = 0
+        self.connections_closed = 0
+        self.connections_reaped = 0
+        self.dropped = 0  # 已关闭连接被丢弃的消息数，活跃连接的在抓取时累加
+        self.throttled_frames = collections.defaultdict(int)  # 流量类别 -> 因限流等待过的帧数
+        self.throttled_seconds = collections.defaultdict(float)
+
+    # 以下在热路径上调用，只做累加
+
+    def received(self, msg_type, nbytes):
+        self.messages_in[msg_type] += 1
+        self.bytes_in[msg_type] += nbytes
+
+    def sent(self, msg_type, count, nbytes):
+        self.messages_out[msg_type] += count
+        self.bytes_out[msg_type] += nbytes
+
+    def room_fanout(self, room_name, count):
+        self.room_deliveries[room_name] += count
+        self.fanout.observe(count)
+
+    def room_removed(self, room_name):
+        """房间删除后不再输出它的序列，临时房间不会让标签无限增长"""
+        self.room_deliveries.pop(room_name, None)
+
+    def throttled(self, traffic_class, wait):
+        self.throttled_frames[traffic_class] += 1
+        self.throttled_seconds[traffic_class] += wait
+
+    def connection_closed(self, conn):
+        self.connections_closed += 1
+        self.dropped += conn.dropped
+
+    async def monitor_loop(self, loop):
+        """定时器实际触发时间与预期的差值就是事件循环被阻塞的时间"""
+        while True:
+            expected = loop.time() + LAG_INTERVAL
+            await asyncio.sleep(LAG_INTERVAL)
+            lag = max(loop.time() - expected, 0.0)
+            self.loop_lag.observe(lag)
+            self.loop_lag_max = max(self.loop_lag_max, lag)
+
+    def render(self, server) -> str:
+        conns = list(server.users.values())
+        lines = []
+        lines += _gauge('chat_uptime_seconds', "Seconds since the server started", time.time() - self.started)
+        lines += _counter('chat_messages_in_total', "Messages received by type", self.messages_in, 'type')
+        lines += _counter('chat_bytes_in_total', "Framed bytes received by type", self.bytes_in, 'type')
+        lines += _counter('chat_messages_out_total', "Messages queued to clients by type", self.messages_out, 'type')
+        lines += _counter('chat_bytes_out_total', "Bytes queued to clients by type", self.bytes_out, 'type')
+        lines += _gauge('chat_socket_recv_bytes_total', "Bytes read from client sockets", self.recv_bytes, 'counter')
+        lines += _gauge('chat_socket_sent_bytes_total', "Bytes written to client sockets", self.sent_bytes, 'counter')
+        lines += _counter('chat_room_deliveries_total', "Recipients per room message, summed", self.room_deliveries,
+                          'room')
+        lines += self.fanout.render('chat_room_fanout', "Local recipients per room message")
+        lines += self.send_latency.render('chat_send_latency_seconds', "Time from enqueue to socket write")
+        lines += self.loop_lag.render('chat_event_loop_lag_seconds', "Event loop scheduling delay")
+        lines += _gauge('chat_event_loop_lag_max_seconds', "Largest event loop delay seen", self.loop_lag_max)
+
+        lines += _gauge('chat_connections', "Logged-in connections on this process", len(conns))
+        lines += _gauge('chat_connections_opened_total', "Accepted connections", self.connections_opened, 'counter')
+        lines += _gauge('chat_connections_closed_total', "Closed connections", self.connections_closed, 'counter')
+        lines += _gauge('chat_connections_reaped_total', "Connections closed for missing heartbeats",
+                        self.connections_reaped, 'counter')
+        lines += _gauge('chat_remote_users', "Users online on other shards", len(server.remote_users))
+        lines += _gauge('chat_rooms', "Known rooms", len(server.rooms))
+        counts = server.rooms.member_counts().values()
+        lines += _gauge('chat_room_members', "Room memberships, summed over rooms", sum(c[0] for c in counts))
+        lines += _gauge('chat_room_members_online', "Room memberships with a local connection",
+                        sum(c[1] for c in counts))
+
+        queue_frames = sum(conn.queued_frames for conn in conns)
+        queue_bytes = sum(conn.pending_bytes for conn in conns)
+        lines += _gauge('chat_send_queue_frames', "Frames waiting in outbound queues", queue_frames)
+        lines += _gauge('chat_send_queue_bytes', "Bytes waiting in outbound queues", queue_bytes)
+        lines += _gauge('chat_send_queue_bytes_max', "Largest outbound queue",
+                        max((conn.pending_bytes for conn in conns), default=0))
+        lines += _gauge('chat_dropped_messages_total', "Messages dropped by slow-consumer policy",
+                        self.dropped + sum(conn.dropped for conn in conns), 'counter')
+        lines += _counter('chat_throttled_frames_total', "Frames delayed by rate limits by traffic class",
+                          self.throttled_frames, 'class')
+        lines += _counter('chat_throttled_seconds_total', "Read delay imposed by rate limits by traffic class",
+                          self.throttled_seconds, 'class')
+
+        # 队列最长的几个连接的明细：应用层队列、内核发送缓冲区和接收缓冲区大小
+        top = sorted(conns, key=lambda conn: conn.pending_bytes, reverse=True)[:TOP_CONNECTIONS]
+        lines += _counter('chat_connection_queue_bytes', "Outbound queue bytes of the busiest connections",
+                          {conn.name: conn.pending_bytes for conn in top}, 'user', 'gauge')
+        lines += _counter('chat_connection_queue_frames', "Outbound queue frames of the busiest connections",
+                          {conn.name: conn.queued_frames for conn in top}, 'user', 'gauge')
+        lines += _counter('chat_connection_unsent_bytes', "Kernel send buffer bytes of the busiest connections",
+                          {conn.name: unsent_bytes(conn.sock) for conn in top}, 'user', 'gauge')
+        lines += _counter('chat_connection_recv_buffer_bytes', "Receive buffer size of the busiest connections",
+                          {conn.name: conn.recv_buffer_size for conn in top}, 'user', 'gauge')
+
+        if server.history:
+            lines += _gauge('chat_history_queue', "Pending history operations", server.history.queue.qsize())
+        if server.offline:
+            lines += _gauge('chat_offline_mailboxes', "Mailboxes holding messages", len(server.offline.mailboxes))
+            lines += _gauge('chat_offline_dropped_total', "Offline messages dropped by limits",
+                            server.offline.dropped, 'counter')
+        return '\n'.join(lines) + '\n'
+
+    async def serve(self, server, host, port):
+        """本地 HTTP 端口，只响应 GET /metrics"""
+
+        async def on_client(reader, writer):
+            try:
+                request = await reader.readline()
+                while (await reader.readline()).strip():
+                    pass  # 忽略请求头
+                parts = request.split()
+                if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+                    status, body = b'200 OK', self.render(server).encode('utf-8')
+                else:
+                    status, body = b'404 Not Found', b'not found\n'
+                writer.write(b'HTTP/1.0 ' + status + b'\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                             b'Content-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body)
+                await writer.drain()
+            except (OSError, asyncio.IncompleteReadError):
+                pass
+            finally:
+                writer.close()
+
+        await asyncio.start_server(on_client, host, port)
+        print(f"Metrics on http://{host}:{port}/metrics")
@@ -0,0 +1,179 @@
+"""
+在线状态服务。
+
+登录和下线不再立即广播，只记下哪些用户变了；PRESENCE_TICK 之后一次性比较实际状态和上次发布的状态，
+版本号加一，生成一条增量。登录风暴时 N 个用户登录只产生几次增量，而不是 N 次全员广播。
+
+    协商过的客户端（登录时带 presence）收到 presence 增量：{version, online: [...], offline: [...]}，
+    同一份帧编码一次后发给所有人；带 interest 的客户端只收到联系人和同房间用户的变化。
+    旧客户端仍收到逐个的 login / logout 消息，但同一个 tick 里的消息合并成一次发送。
+
+快照（user_list）按 SNAPSHOT_PAGE 分页，每页预先编码并按版本缓存，同一版本下所有新连接共用。
+快照和增量都基于已发布的状态。连接建立时发快照并记下版本，登录时补发这之后的变化，
+所以登录前（例如停在登录对话框时）别人的上下线也不会漏掉。
+"""
+import collections
+
+from Client.module.Framing import Frame
+
+PRESENCE_TICK = 0.1  # 合并状态变化的时间窗口（秒）
+SNAPSHOT_PAGE = 1000  # 快照每页的用户数
+DELTA_HISTORY = 1024  # 保留最近多少个版本的增量，用于客户端登录时补发
+
+
+class PresenceService:
+    def __init__(self, server):
+        self.server = server
+        self.version = 0
+        self.published = set()  # 最近一次发布时的在线用户
+        self.dirty = set()  # 状态可能变化、等待下一个 tick 的用户
+        self.history = collections.deque(maxlen=DELTA_HISTORY)  # (version, online, offline)
+        self.scheduled = False
+        self._pages_version = -1
+        self._pages = {}  # (framed, compress, codec) -> [每页的字节]
+
+    def is_online(self, user):
+        return user in self.server.users or user in self.server.remote_users
+
+    def changed(self, user):
+        """用户登录、下线或换了连接时调用，实际状态在 tick 时再判断"""
+        self.dirty.add(user)
+        if not self.scheduled:
+            self.scheduled = True
+            self.server.loop.call_later(PRESENCE_TICK, self.flush)
+
+    def flush(self):
+        self.scheduled = False
+        online = [user for user in self.dirty if user not in self.published and self.is_online(user)]
+        offline = [user for user in self.dirty if user in self.published and not self.is_online(user)]
+        self.dirty.clear()
+        if not online and not offline:
+            return
+
+        self.version += 1
+        self.published.update(online)
+        self.published.difference_update(offline)
+        self.history.append((self.version, online, offline))
+        self.publish(online, offline)
+
+    # ---------------------------------------------------------------- 发布增量
+
+    def publish(self, online, offline):
+        server = self.server
+        delta = Frame.from_message({'type': 'presence', 'version': self.version, 'online': online,
+                                    'offline': offline})
+        changed = set(online) | set(offline)
+        legacy_shared = {}  # (framed, compress, codec) -> 合并后的 login/logout 字节
+        count = nbytes = 0
+
+        for name, conn in server.users.items():
+            if conn.presence:
+                if conn.interest is None:
+                    data = delta.encoded(conn.framed, conn.binary, conn.compress, conn.codec)
+                else:
+                    data = self.filtered_delta(conn, online, offline)
+            elif name in changed:
+                # 旧版客户端不应收到自己的 login，这几个连接单独编码
+                data = self.legacy_updates(conn, [user for user in online if user != name],
+                                           [user for user in offline if user != name])
+            else:
+                key = (conn.framed, conn.compress, conn.codec)
+                data = legacy_shared.get(key)
+                if data is None:
+                    data = legacy_shared[key] = self.legacy_updates(conn, online, offline)
+            if data:
+                conn.send(data)
+                count += 1
+                nbytes += len(data)
+        server.metrics.sent('presence', count, nbytes)
+
+    def legacy_updates(self, conn, online, offline) -> bytes:
+        messages = [{'type': 'login', 'from_id': user} for user in online]
+        messages += [{'type': 'logout', 'from_id': user} for user in offline]
+        return b''.join(conn.encode(msg) for msg in messages)
+
+    def interested(self, conn, user) -> bool:
+        rooms = self.server.rooms
+        return user in conn.interest or not rooms.rooms_of(user).isdisjoint(rooms.rooms_of(conn.name))
+
+    def filtered_delta(self, conn, online, offline):
+        online = [user for user in online if self.interested(conn, user)]
+        offline = [user for user in offline if self.interested(conn, user)]
+        if not online and not offline:
+            return None
+        return conn.encode({'type': 'presence', 'version': self.version, 'online': online,
+                            'offline': offline})
+
+    # ---------------------------------------------------------------- 快照和订阅
+
+    def snapshot_pages(self, conn) -> list:
+        """已发布状态的分页快照，每种编码每个版本只生成一次"""
+        if self._pages_version != self.version:
+            self._pages_version = self.version
+            self._pages = {}
+        key = (conn.framed, conn.compress, conn.codec)
+        pages = self._pages.get(key)
+        if pages is None:
+            users = sorted(self.published)
+            chunks = [users[i:i + SNAPSHOT_PAGE] for i in range(0, len(users), SNAPSHOT_PAGE)] or [[]]
+            pages = self._pages[key] = [
+                conn.encode({'type': 'user_list', 'from_id': chunk, 'to_id': '', 'version': self.version,
+                             'page': i, 'pages': len(chunks)})
+                for i, chunk in enumerate(chunks)]
+        return pages
+
+    def send_snapshot(self, conn, reset=False):
+        conn.presence_version = self.version
+        if not reset:
+            for page in self.snapshot_pages(conn):
+                conn.send(page)
+            return
+        # 客户端的版本太旧，补不上增量：重新发一遍快照，客户端收齐后整体替换
+        users = sorted(self.published)
+        chunks = [users[i:i + SNAPSHOT_PAGE] for i in range(0, len(users), SNAPSHOT_PAGE)] or [[]]
+        for i, chunk in enumerate(chunks):
+            conn.send(conn.encode({'type': 'user_list', 'from_id': chunk, 'to_id': '', 'version': self.version,
+                                   'page': i, 'pages': len(chunks), 'reset': True}))
+
+    def subscribe(self, conn, presence=False, interest=None):
+        """
+        登录时调用。presence 为 True 的连接改收增量，interest 见 set_interest。
+        从连接收到的快照版本补发到当前版本，中间的增量已经不在 history 里时重新发快照。
+        """
+        conn.presence = presence
+        self.set_interest(conn, interest if presence else None)
+        known = conn.presence_version
+        if known == self.version:
+            return
+        if known is None or not self.history or self.history[0][0] > known + 1:
+            if presence:
+                self.send_snapshot(conn, reset=True)
+            else:
+                # 旧客户端不认识 reset，只能补发现在在线的用户
+                conn.send(self.legacy_updates(conn, sorted(self.published - {conn.name}), []))
+                conn.presence_version = self.version
+            return
+
+        online, offline = set(), set()
+        for version, added, removed in self.history:
+            if version > known:
+                online.difference_update(removed)
+                offline.difference_update(added)
+                online.update(added)
+                offline.update(removed)
+        online, offline = sorted(online - {conn.name}), sorted(offline - {conn.name})
+        conn.presence_version = self.version
+        if not presence:
+            data = self.legacy_updates(conn, online, offline)
+        elif conn.interest is not None:
+            data = self.filtered_delta(conn, online, offline)
+        else:
+            data = conn.encode({'type': 'presence', 'version': self.version, 'online': online,
+                                'offline': offline})
+        if data:
+            conn.send(data)
+
+    @staticmethod
+    def set_interest(conn, interest):
+        """interest 为 None 时接收所有用户的变化，否则只接收这些用户和同房间用户的变化"""
+        conn.interest = None if interest is None else set(interest)
@@ -0,0 +1,194 @@
+"""
+基于 asyncio.Protocol 和 transport 的服务端核心，用 --core protocol 启用。
+
+sock 核心每个连接有一个 sock_recv_into 读协程和一个写协程，每次收发都要经过一次协程调度。
+这里改由事件循环直接回调：
+    收  BufferedProtocol，transport 直接 recv_into 到 FrameDecoder 的缓冲区，buffer_updated 里同步处理完整的帧
+    发  直接 transport.write，写不完的部分由 transport 缓冲，事件循环在可写时发出
+transport 写缓冲超过高水位时回调 pause_writing，之后的数据进入 Connection 原有的有界队列，
+沿用同样的上限和慢消费者策略；降到低水位时 resume_writing 把队列按通道优先级、按批写回 transport。
+要分片的大帧总是先进队列，和 sock 核心一样一次只写一个分片；这种连接的水位也更低，
+transport 里积压的分片不会让后来的文字消息等太久。
+限流等待时 pause_reading，等够时间再处理这一帧并恢复读，和 sock 核心的行为一致。
+
+消息层面两种核心完全相同：都调用 Server.process_message，帧的编码、转发、在线状态和限流都不区分核心。
+安装了 uvloop 时可以用 --uvloop 作为事件循环，两种核心都适用。
+"""
+import asyncio
+import collections
+
+from Client.module.Flow import FRAGMENT_SIZE, LANE_CONTROL, LANE_IMAGE
+from Client.module.Framing import FrameDecoder, FrameError
+from service.Connection import Connection, MAX_QUEUE_BYTES, POLICY_DROP_FILE_CHUNK
+
+CORE_SOCK = 'sock'
+CORE_PROTOCOL = 'protocol'
+CORES = (CORE_SOCK, CORE_PROTOCOL)
+
+RECV_SIZE = 64 * 1024
+# transport 写缓冲的高低水位
+WRITE_HIGH_WATER = 256 * 1024
+WRITE_LOW_WATER = 64 * 1024
+# 协商了分片的连接
+LANE_HIGH_WATER = 2 * FRAGMENT_SIZE
+LANE_LOW_WATER = FRAGMENT_SIZE // 2
+
+
+def run(main, use_uvloop=False):
+    """运行协程直到结束；use_uvloop 为 True 且安装了 uvloop 时用它的事件循环"""
+    if use_uvloop:
+        try:
+            import uvloop
+        except ImportError:
+            print("uvloop is not installed, using asyncio event loop")
+        else:
+            if not hasattr(asyncio, 'Runner'):  # Python 3.10 及以前
+                uvloop.install()
+                return asyncio.run(main)
+            with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+                return runner.run(main)
+    return asyncio.run(main)
+
+
+class TransportConnection(Connection):
+    """
+    Protocol 核心的连接。没有写协程：未暂停时直接写进 transport，暂停期间进入父类的队列。
+    metrics.sent_bytes 在这里统计的是交给 transport 的字节数
+    """
+    def __init__(self, transport, loop, max_queue_bytes=MAX_QUEUE_BYTES, policy=POLICY_DROP_FILE_CHUNK, metrics=None):
+        self.transport = transport
+        self.paused = False  # transport 写缓冲超过高水位
+        super().__init__(transport.get_extra_info('socket'), loop, max_queue_bytes, policy, metrics)
+
+    def _start_writer(self):
+        return None
+
+    def enable_fragments(self):
+        super().enable_fragments()
+        self.transport.set_write_buffer_limits(LANE_HIGH_WATER, LANE_LOW_WATER)
+
+    def send(self, data, bulk=False, lane=LANE_CONTROL) -> bool:
+        if self.closed:
+            return False
+        if self.paused or self.queued_bytes or (self.fragment and lane >= LANE_IMAGE and len(data) > FRAGMENT_SIZE):
+            if not super().send(data, bulk, lane):
+                return False
+            if not self.paused:
+                self._drain()
+            return True
+        self.transport.write(data)
+        if self.metrics:
+            self.metrics.sent_bytes += len(data)
+        return True
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self._drain()
+
+    def _drain(self):
+        # 写入时可能再次越过高水位，transport 会同步回调 pause_writing
+        while self.queued_bytes and not self.paused and not self.closed:
+            batch, batch_bytes, enqueued = self._take_batch()
+            self.transport.writelines(batch)
+            self._batch_sent(batch_bytes, enqueued)
+
+    def close(self):
+        """丢弃未发送的数据并断开，之后 ChatProtocol.connection_lost 负责清理"""
+        if self.closed:
+            return
+        self.closed = True
+        self._clear()
+        self.transport.abort()
+
+    @property
+    def pending_bytes(self):
+        return self.queued_bytes + self.transport.get_write_buffer_size()
+
+    async def wait_closed(self):
+        pass
+
+
+class ChatProtocol(asyncio.BufferedProtocol):
+    def __init__(self, server):
+        self.server = server
+        self.decoder = FrameDecoder()
+        self.transport = None
+        self.conn: TransportConnection = None
+        self.pending = collections.deque()  # 已收到、还没处理的帧
+        self.throttled = False  # 正在等待限流，暂停了读
+
+    def connection_made(self, transport):
+        server = self.server
+        self.transport = transport
+        transport.set_write_buffer_limits(WRITE_HIGH_WATER, WRITE_LOW_WATER)
+        print(f"Connection from {transport.get_extra_info('peername')}")
+        self.conn = TransportConnection(transport, server.loop, server.max_queue_bytes, server.slow_policy,
+                                        server.metrics)
+        self.conn.decoder = self.decoder
+        server.connection_opened(self.conn)
+
+    def get_buffer(self, sizehint):
+        # 解码器扩容时换新缓冲区，不在原处 resize，transport 持有的旧 memoryview 不受影响
+        return self.decoder.get_buffer(RECV_SIZE)
+
+    def buffer_updated(self, nbytes):
+        conn = self.conn
+        self.server.metrics.recv_bytes += nbytes
+        conn.last_seen = self.server.loop.time()
+        try:
+            self.pending.extend(self.decoder.buffer_updated(nbytes))
+        except FrameError as e:
+            print(f"Protocol error from {conn.name}: {e}")
+            conn.close()
+            return
+        if not self.throttled:
+            self._process()
+
+    def _process(self):
+        server = self.server
+        conn = self.conn
+        try:
+            while self.pending and not conn.closed:
+                frame = self.pending.popleft()
+                wait = server.admit(conn, frame)
+                if wait > 0:
+                    # 等够时间再处理这一帧，这期间不读这个连接
+                    self.throttled = True
+                    self.transport.pause_reading()
+                    server.loop.call_later(wait, self._resume, frame)
+                    return
+                server.process_message(frame, conn)
+        except Exception as e:
+            print(f"Connection error: {e}")
+            conn.close()
+
+    def _resume(self, frame):
+        self.throttled = False
+        conn = self.conn
+        if conn.closed:
+            return
+        # 这一帧已经记过账，直接处理
+        try:
+            self.server.process_message(frame, conn)
+        except Exception as e:
+            print(f"Connection error: {e}")
+            conn.close()
+            return
+        self._process()
+        if not self.throttled and not conn.closed:
+            self.transport.resume_reading()
+
+    def pause_writing(self):
+        self.conn.pause_writing()
+
+    def resume_writing(self):
+        self.conn.resume_writing()
+
+    def connection_lost(self, exc):
+        conn = self.conn
+        conn.close()
+        self.pending.clear()
+        self.server.connection_closed(conn)
@@ -0,0 +1,92 @@
+"""
+服务端限流：每个连接、每个房间按流量类别各有消息数和字节数两个令牌桶，见 Client.module.Flow。
+
+超限的帧不丢弃：Server.handle 在处理这一帧前等待 admit 返回的秒数，这期间不读这个连接，
+TCP 窗口会让客户端自然慢下来；同时发一条 flow 消息，新客户端的 SendWorker 据此主动暂停。
+等待只发生在超限连接自己的读协程里，事件循环上的其他连接不受影响。
+"""
+from Client.module.Flow import BULK, CONTROL, TEXT, TokenBucket, traffic_class
+
+# 类别 -> (每秒消息数, 每秒字节数)，None 表示不限；桶容量是两秒的量
+DEFAULT_LIMITS = {
+    CONTROL: (50, 256 * 1024),
+    TEXT: (20, 2 * 1024 * 1024),
+    BULK: (1000, 16 * 1024 * 1024),
+}
+DEFAULT_ROOM_LIMITS = {
+    TEXT: (100, 8 * 1024 * 1024),
+    BULK: (1000, 32 * 1024 * 1024),
+}
+BURST_SECONDS = 2.0
+FLOW_MIN_WAIT = 0.01  # 等待超过这个时间才通知客户端
+FLOW_INTERVAL = 1.0  # 同一连接同一类别的 flow 消息最短间隔
+
+
+class Buckets:
+    """一组按类别划分的 (消息桶, 字节桶)"""
+    __slots__ = ('buckets',)
+
+    def __init__(self, limits, now):
+        self.buckets = {}
+        for cls, (messages, nbytes) in limits.items():
+            self.buckets[cls] = (
+                TokenBucket(messages, messages * BURST_SECONDS, now) if messages else None,
+                TokenBucket(nbytes, nbytes * BURST_SECONDS, now) if nbytes else None,
+            )
+
+    def take(self, cls, nbytes, now) -> float:
+        pair = self.buckets.get(cls)
+        if pair is None:
+            return 0.0
+        messages, size = pair
+        wait = messages.take(1, now) if messages else 0.0
+        if size:
+            wait = max(wait, size.take(nbytes, now))
+        return wait
+
+
+class RateLimiter:
+    def __init__(self, metrics, limits=None, room_limits=None):
+        self.metrics = metrics
+        self.limits = DEFAULT_LIMITS if limits is None else limits
+        self.room_limits = DEFAULT_ROOM_LIMITS if room_limits is None else room_limits
+
+    def announce(self) -> dict:
+        """login_ack 里告诉客户端的限额"""
+        return {cls: list(limit) for cls, limit in self.limits.items()}
+
+    def admit(self, conn, frame, room, now) -> float:
+        """
+        给这一帧记账，返回处理前需要等待的秒数。
+        room 是群聊帧的目标房间（service.Rooms.Room），私聊和控制消息为 None
+        """
+        msg_type = frame.route.get('type')
+        cls = traffic_class(msg_type)
+        nbytes = len(frame.raw) if frame.raw is not None else len(frame.encoded(False))
+
+        if conn.buckets is None:
+            conn.buckets = Buckets(self.limits, now)
+        wait = conn.buckets.take(cls, nbytes, now)
+        if room is not None and self.room_limits:
+            if room.buckets is None:
+                room.buckets = Buckets(self.room_limits, now)
+            wait = max(wait, room.buckets.take(cls, nbytes, now))
+
+        if wait > 0:
+            self.metrics.throttled(cls, wait)
+            if wait >= FLOW_MIN_WAIT and conn.framed and now >= conn.flow_sent.get(cls, 0.0):
+                conn.flow_sent[cls] = now + FLOW_INTERVAL
+                conn.send_msg({'type': 'flow', 'class': cls, 'wait': round(wait, 3)})
+        return wait
+
+
+def parse_limits(specs, defaults) -> dict:
+    """命令行的 CLASS=MSGS,BYTES 覆盖默认限额"""
+    limits = dict(defaults)
+    for spec in specs:
+        cls, _, values = spec.partition('=')
+        if cls not in (CONTROL, TEXT, BULK):
+            raise ValueError(f"unknown traffic class {cls!r}")
+        messages, nbytes = (float(value) or None for value in values.split(','))
+        limits[cls] = (messages, nbytes)
+    return limits
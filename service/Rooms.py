@@ -0,0 +1,133 @@
+"""
+房间注册表。
+
+每个房间记三组成员：
+    users   全部成员的名字，决定谁能发言、查记录，离线成员的消息存进信箱
+    online  本进程上在线成员的连接对象，转发时直接入队，不再按名字逐个查 Server.users
+    away    哪里都不在线的成员（本进程和其他分片都没有），只有这些人需要存离线消息
+另有用户 -> 所在房间的反向索引，上线、下线时只更新这个用户所在的 k 个房间。
+所以一次房间转发的开销只和在线成员数有关，和历史上加入过的人数无关。
+"""
+
+NO_ROOMS = frozenset()
+
+
+class Room:
+    __slots__ = ('name', 'creator', 'users', 'online', 'away', 'buckets')
+
+    def __init__(self, name, creator):
+        self.name: str = name
+        self.creator = creator
+        self.users: set = set()
+        self.online: dict = {}  # 名字 -> Connection
+        self.away: set = set()
+        self.buckets = None  # 房间的限流令牌桶，见 service.RateLimit
+
+    def __len__(self):
+        return len(self.users)
+
+    def __contains__(self, user):
+        return user in self.users
+
+    def recipients(self, exclude=None) -> list:
+        """本进程上除 exclude 以外的在线成员连接"""
+        return [conn for name, conn in self.online.items() if name != exclude]
+
+
+class RoomRegistry:
+    def __init__(self, server):
+        self.server = server
+        self.rooms: dict[str, Room] = {}
+        self.by_user: dict[str, set] = {}  # 用户名 -> 所在的 Room
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def __contains__(self, room_name):
+        return room_name in self.rooms
+
+    def __iter__(self):
+        return iter(self.rooms)
+
+    def get(self, room_name):
+        return self.rooms.get(room_name)
+
+    def rooms_of(self, user):
+        return self.by_user.get(user, NO_ROOMS)
+
+    def is_member(self, room_name, user):
+        room = self.rooms.get(room_name)
+        return room is not None and user in room.users
+
+    def create(self, room_name, creator, users=()) -> Room:
+        """新建房间；同名房间已存在时先删除旧的"""
+        if room_name in self.rooms:
+            self.delete(room_name)
+        room = Room(room_name, creator)
+        self.rooms[room_name] = room
+        for user in users:
+            self.add_member(room, user)
+        return room
+
+    def add_member(self, room, user):
+        if user in room.users:
+            return
+        room.users.add(user)
+        self.by_user.setdefault(user, set()).add(room)
+        self._update(room, user)
+
+    def leave(self, room_name, user):
+        """
+        成员退出房间，返回房间对象；最后一个成员退出后房间随之删除。
+        房间或成员不存在时返回 None
+        """
+        room = self.rooms.get(room_name)
+        if room is None or user not in room.users:
+            return None
+        room.users.discard(user)
+        room.online.pop(user, None)
+        room.away.discard(user)
+        rooms = self.by_user.get(user)
+        if rooms is not None:
+            rooms.discard(room)
+            if not rooms:
+                del self.by_user[user]
+        if not room.users:
+            del self.rooms[room_name]
+            self.server.metrics.room_removed(room_name)
+        return room
+
+    def delete(self, room_name):
+        room = self.rooms.pop(room_name, None)
+        if room is None:
+            return None
+        for user in room.users:
+            rooms = self.by_user.get(user)
+            if rooms is not None:
+                rooms.discard(room)
+                if not rooms:
+                    del self.by_user[user]
+        self.server.metrics.room_removed(room_name)
+        return room
+
+    def refresh(self, user):
+        """用户在本进程或其他分片上线、下线后调用，只更新他所在的房间"""
+        for room in self.by_user.get(user, ()):
+            self._update(room, user)
+
+    def _update(self, room, user):
+        server = self.server
+        conn = server.users.get(user)
+        if conn is not None:
+            room.online[user] = conn
+            room.away.discard(user)
+            return
+        room.online.pop(user, None)
+        if user in server.remote_users:
+            room.away.discard(user)
+        else:
+            room.away.add(user)
+
+    def member_counts(self) -> dict:
+        """房间名 -> (成员数, 本进程在线成员数)"""
+        return {name: (len(room.users), len(room.online)) for name, room in self.rooms.items()}
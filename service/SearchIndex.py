@@ -0,0 +1,473 @@
+"""
+服务端聊天记录的全文索引，放在记录目录的 index 子目录下，只索引本进程保存的会话。
+一个目录只能由一个 SearchIndex 使用：段文件按本索引自己的文档号命名，分片模式下每个分片用 index/<分片号>。
+
+分词：中日韩文字连续的一段切成相邻两字的 bigram（只有一个字时用单字），其他文字按单词小写。
+查询时所有词都要出现，再确认查询里每个空格分开的部分分出的词在原文的词序列里是连续的，
+bigram 拼出来的误命中会被去掉，标点不影响匹配，单词也不会匹配到更长单词的一部分。
+所以中文至少要输入两个字才能搜到，除非那个字在原文里前后都不是中文。
+
+索引是分段的：
+    内存缓冲  新消息先进这里，攒够 FLUSH_DOCS 条或空闲 FLUSH_INTERVAL 秒后写成一个段
+    段文件    <base>-<文档数>.seg 写好后不再修改：文档表、词典、倒排表（文档号差值的 varint）和原文
+段的数量按层合并：有连续 MERGE_FACTOR 个段属于同一层时，由合并线程合成一个大段，
+完成后交回索引线程替换，旧段文件随即删除。合并只读不可变的段文件，不阻塞写入和查询。
+
+和 HistoryStore 一样，分词、写段和查询都在后台线程里，事件循环只把帧放进队列。
+"""
+import concurrent.futures
+import json
+import math
+import mmap
+import os
+import queue
+import re
+import struct
+import threading
+import time
+
+from Client.module.Framing import FrameError
+
+HEADER = struct.Struct('!4sQIII')  # magic, base, 文档数, 会话数, 词数
+MAGIC = b'CSX1'
+DOC = struct.Struct('!IdQI')  # 会话序号, 时间戳, 原文偏移, 原文长度
+TERM = struct.Struct('!IQI')  # 文档频率, 倒排表偏移, 倒排表长度
+NAME = struct.Struct('!H')
+
+FLUSH_DOCS = 4096  # 内存缓冲攒够这么多条写成一个段
+FLUSH_INTERVAL = 5.0  # 秒；缓冲区里有消息且这么久没有新消息时也写段
+MERGE_FACTOR = 8  # 同一层的段攒够这么多个就合并
+MAX_BATCH = 1024
+MAX_WORD = 32  # 单词超过这个长度只取前面的部分
+
+# 索引的消息类型和取文字的字段
+INDEX_FIELDS = {'text': 'content', 'file_header': 'filename'}
+
+_CJK = '぀-ヿ㐀-䶿一-鿿가-힯豈-﫿'
+TOKEN = re.compile(f'([{_CJK}]+)|([^\\W_{_CJK}]+)')
+
+
+def tokenize(text):
+    """返回文字里的词，可能有重复"""
+    terms = []
+    for cjk, word in TOKEN.findall(text.lower()):
+        if cjk:
+            if len(cjk) == 1:
+                terms.append(cjk)
+            else:
+                terms.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+        else:
+            terms.append(word[:MAX_WORD])
+    return terms
+
+
+def _contains(terms, phrase):
+    """phrase 是否作为连续的一段出现在 terms 里"""
+    n = len(phrase)
+    first = phrase[0]
+    return any(terms[i] == first and terms[i:i + n] == phrase for i in range(len(terms) - n + 1))
+
+
+def encode_postings(doc_ids) -> bytes:
+    """升序的文档号编码成差值的 varint"""
+    out = bytearray()
+    last = 0
+    for doc in doc_ids:
+        n = doc - last
+        last = doc
+        while n >= 0x80:
+            out.append((n & 0x7f) | 0x80)
+            n >>= 7
+        out.append(n)
+    return bytes(out)
+
+
+def decode_postings(data) -> list:
+    doc_ids = []
+    doc = 0
+    n = 0
+    shift = 0
+    for byte in data:
+        n |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        doc += n
+        doc_ids.append(doc)
+        n = 0
+        shift = 0
+    return doc_ids
+
+
+def _tier(ndocs, flush_docs, merge_factor):
+    """段按文档数分层：不超过 flush_docs 为第 0 层，每大 merge_factor 倍升一层"""
+    return int(math.log(ndocs / flush_docs, merge_factor)) if ndocs > flush_docs else 0
+
+
+class Buffer:
+    """还没写成段的新消息，只在索引线程里使用。文档号和段一样从 0 开始，加上 base 是全局文档号"""
+
+    def __init__(self, base):
+        self.base = base
+        self.keys = []
+        self.key_index = {}
+        self.docs = []  # (会话序号, 时间戳, from_id, 原文)
+        self.terms = {}  # 词 -> 文档号列表
+
+    @property
+    def ndocs(self):
+        return len(self.docs)
+
+    def add(self, key, ts, from_id, text):
+        index = self.key_index.get(key)
+        if index is None:
+            index = self.key_index[key] = len(self.keys)
+            self.keys.append(key)
+        doc = len(self.docs)
+        self.docs.append((index, ts, from_id, text))
+        for term in set(tokenize(text)):
+            self.terms.setdefault(term, []).append(doc)
+
+    def postings(self, term):
+        return self.terms.get(term, ())
+
+    def key_of(self, doc):
+        return self.docs[doc][0]
+
+    def ts_of(self, doc):
+        return self.docs[doc][1]
+
+    def doc(self, doc):
+        return self.docs[doc][2:]
+
+
+class Segment:
+    """一个只读的段文件，文档表和词典读进内存，倒排表和原文按需从 mmap 里取"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mm = self.mm
+        magic, self.base, ndocs, nkeys, nterms = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC:
+            self.mm.close()
+            raise ValueError(f"bad index segment {path}")
+        pos = HEADER.size
+        self.keys = []
+        for _ in range(nkeys):
+            name, pos = _read_name(mm, pos)
+            self.keys.append(name)
+        self.docs = [DOC.unpack_from(mm, pos + i * DOC.size) for i in range(ndocs)]
+        pos += ndocs * DOC.size
+        self.terms = {}
+        for _ in range(nterms):
+            term, pos = _read_name(mm, pos)
+            self.terms[term] = TERM.unpack_from(mm, pos)
+            pos += TERM.size
+
+    @property
+    def ndocs(self):
+        return len(self.docs)
+
+    def postings(self, term):
+        entry = self.terms.get(term)
+        if entry is None:
+            return ()
+        _, offset, length = entry
+        return decode_postings(self.mm[offset:offset + length])
+
+    def key_of(self, doc):
+        return self.docs[doc][0]
+
+    def ts_of(self, doc):
+        return self.docs[doc][1]
+
+    def doc(self, doc):
+        _, _, offset, length = self.docs[doc]
+        return json.loads(self.mm[offset:offset + length])
+
+    def close(self):
+        self.mm.close()
+
+
+def _name(text) -> bytes:
+    data = text.encode('utf-8')
+    return NAME.pack(len(data)) + data
+
+
+def _read_name(mm, pos):
+    (length,) = NAME.unpack_from(mm, pos)
+    start = pos + NAME.size
+    return mm[start:start + length].decode('utf-8'), start + length
+
+
+def write_segment(path, base, keys, docs, terms):
+    """
+    docs 为 [(会话序号, 时间戳, 原文 JSON 字节)]，terms 为 {词: 升序的段内文档号}。
+    先写临时文件再改名，进程中途退出不会留下写了一半的段
+    """
+    names = b''.join(_name(key) for key in keys)
+    sorted_terms = sorted(terms)
+    term_table_size = sum(NAME.size + len(term.encode('utf-8')) + TERM.size for term in sorted_terms)
+    offset = HEADER.size + len(names) + len(docs) * DOC.size + term_table_size
+
+    postings = []
+    term_table = bytearray()
+    for term in sorted_terms:
+        data = encode_postings(terms[term])
+        term_table += _name(term) + TERM.pack(len(terms[term]), offset, len(data))
+        postings.append(data)
+        offset += len(data)
+
+    doc_table = bytearray()
+    for key_index, ts, body in docs:
+        doc_table += DOC.pack(key_index, ts, offset, len(body))
+        offset += len(body)
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, base, len(docs), len(keys), len(sorted_terms)))
+        f.write(names)
+        f.write(doc_table)
+        f.write(term_table)
+        f.writelines(postings)
+        f.writelines(body for _, _, body in docs)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def merge_segments(root, segments) -> str:
+    """把相邻的几个段合成一个，返回新段的路径；在合并线程里运行"""
+    base = segments[0].base
+    keys = []
+    key_index = {}
+    docs = []
+    terms = {}
+    for segment in segments:
+        shift = segment.base - base
+        remap = []
+        for key in segment.keys:
+            index = key_index.get(key)
+            if index is None:
+                index = key_index[key] = len(keys)
+                keys.append(key)
+            remap.append(index)
+        for key, ts, offset, length in segment.docs:
+            docs.append((remap[key], ts, segment.mm[offset:offset + length]))
+        for term in segment.terms:
+            terms.setdefault(term, []).extend(doc + shift for doc in segment.postings(term))
+    path = os.path.join(root, f"{base:020d}-{len(docs)}.seg")
+    write_segment(path, base, keys, docs, terms)
+    return path
+
+
+class SearchIndex:
+    """
+    add 可以在事件循环里直接调用，只入队；search 返回 Future
+    """
+
+    def __init__(self, root, flush_docs=FLUSH_DOCS, flush_interval=FLUSH_INTERVAL, merge_factor=MERGE_FACTOR):
+        self.root = root
+        self.flush_docs = flush_docs
+        self.flush_interval = flush_interval
+        self.merge_factor = merge_factor
+        os.makedirs(root, exist_ok=True)
+
+        self.segments = self._load()
+        end = self.segments[-1].base + self.segments[-1].ndocs if self.segments else 0
+        self.buffer = Buffer(end)
+        self.merging = False
+
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._run, name='search-index', daemon=True)
+        self.thread.start()
+
+    def _load(self):
+        segments = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.endswith('.tmp'):
+                os.remove(path)
+            elif name.endswith('.seg'):
+                try:
+                    segments.append(Segment(path))
+                except (OSError, ValueError, struct.error) as e:
+                    print(f"Skip index segment {name}: {e}")
+        # 合并完成后、删除旧段前退出的话，旧段被新段覆盖，这里补删
+        segments.sort(key=lambda s: (s.base, -s.ndocs))
+        kept = []
+        for segment in segments:
+            if kept and segment.base < kept[-1].base + kept[-1].ndocs:
+                segment.close()
+                os.remove(segment.path)
+            else:
+                kept.append(segment)
+        return kept
+
+    def add(self, key, frame):
+        """记录一条消息，只入队"""
+        self.queue.put(('add', (key, frame, time.time()), None))
+
+    def search(self, user, rooms, query, before=None, limit=20) -> concurrent.futures.Future:
+        """
+        在 user 参与的私聊和 rooms 里搜索，按时间从新到旧返回时间早于 before 的最多 limit 条。
+        结果是 (hits, cursor)，hit 为 {'chat', 'private', 'from_id', 'content', 'ts'}；
+        cursor 为最后一条的时间，传给下一次的 before 继续往前翻，没有更多时为 None
+        """
+        future = concurrent.futures.Future()
+        self.queue.put(('search', (user, frozenset(rooms), query, before, limit), future))
+        return future
+
+    def close(self):
+        future = concurrent.futures.Future()
+        self.queue.put(('close', None, future))
+        future.result()
+
+    def _run(self):
+        while True:
+            timeout = self.flush_interval if self.buffer.ndocs else None
+            try:
+                batch = [self.queue.get(timeout=timeout)]
+            except queue.Empty:
+                self._flush()
+                continue
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for op, arg, future in batch:
+                if op == 'add':
+                    self._add(*arg)
+                    if self.buffer.ndocs >= self.flush_docs:
+                        self._flush()
+                elif op == 'search':
+                    try:
+                        future.set_result(self._search(*arg))
+                    except Exception as e:
+                        future.set_exception(e)
+                elif op == 'merged':
+                    self._replace(*arg)
+                elif op == 'close':
+                    self._flush()
+                    for segment in self.segments:
+                        segment.close()
+                    future.set_result(None)
+                    return
+
+    def _add(self, key, frame, ts):
+        route = frame.route
+        field = INDEX_FIELDS.get(route.get('type'))
+        if field is None:
+            return
+        try:
+            text = frame.message.get(field)
+        except (FrameError, ValueError):
+            return
+        if isinstance(text, str) and text:
+            self.buffer.add(key, ts, route.get('from_id'), text)
+
+    def _flush(self):
+        buffer = self.buffer
+        if not buffer.ndocs:
+            return
+        path = os.path.join(self.root, f"{buffer.base:020d}-{buffer.ndocs}.seg")
+        docs = [(key, ts, json.dumps([from_id, text], ensure_ascii=False).encode('utf-8'))
+                for key, ts, from_id, text in buffer.docs]
+        try:
+            write_segment(path, buffer.base, buffer.keys, docs, buffer.terms)
+            self.segments.append(Segment(path))
+        except OSError as e:
+            # 写不进去就继续留在内存里，下次再试
+            print(f"Search index write error: {e}")
+            return
+        self.buffer = Buffer(buffer.base + buffer.ndocs)
+        self._maybe_merge()
+
+    def _maybe_merge(self):
+        """找到层数最低的、连续 merge_factor 个同一层的段，交给合并线程"""
+        if self.merging or len(self.segments) < self.merge_factor:
+            return
+        tiers = [_tier(segment.ndocs, self.flush_docs, self.merge_factor) for segment in self.segments]
+        best = None
+        for start in range(len(tiers) - self.merge_factor + 1):
+            run = tiers[start:start + self.merge_factor]
+            if min(run) == max(run) and (best is None or run[0] < tiers[best]):
+                best = start
+        if best is None:
+            return
+        self.merging = True
+        segments = self.segments[best:best + self.merge_factor]
+        threading.Thread(target=self._merge, args=(segments,), name='search-merge', daemon=True).start()
+
+    def _merge(self, segments):
+        try:
+            path = merge_segments(self.root, segments)
+        except (OSError, ValueError) as e:
+            # 关闭时段文件可能已经被 close 掉
+            print(f"Search index merge error: {e}")
+            path = None
+        self.queue.put(('merged', (segments, path), None))
+
+    def _replace(self, old, path):
+        self.merging = False
+        if path is None:
+            return
+        start = self.segments.index(old[0])
+        self.segments[start:start + len(old)] = [Segment(path)]
+        for segment in old:
+            segment.close()
+            os.remove(segment.path)
+        self._maybe_merge()
+
+    def _search(self, user, rooms, query, before, limit):
+        terms = set(tokenize(query))
+        if not terms:
+            return [], None
+        phrases = [phrase for phrase in map(tokenize, query.split()) if phrase]
+        hits = []
+        # 文档号越大越新，从缓冲区和最新的段开始找
+        for segment in [self.buffer, *reversed(self.segments)]:
+            lists = sorted((segment.postings(term) for term in terms), key=len)
+            if not lists[0]:
+                continue
+            candidates = set(lists[0])
+            for postings in lists[1:]:
+                candidates.intersection_update(postings)
+                if not candidates:
+                    break
+            allowed = {}  # 会话序号 -> (chat, private)，不能看的为 None
+            for doc in sorted(candidates, reverse=True):
+                ts = segment.ts_of(doc)
+                if before is not None and ts >= before:
+                    continue
+                key = segment.key_of(doc)
+                if key not in allowed:
+                    allowed[key] = _visible(segment.keys[key], user, rooms)
+                chat = allowed[key]
+                if chat is None:
+                    continue
+                from_id, text = segment.doc(doc)
+                text_terms = tokenize(text)
+                if not all(_contains(text_terms, phrase) for phrase in phrases):
+                    continue
+                hits.append({'chat': chat[0], 'private': chat[1], 'from_id': from_id, 'content': text, 'ts': ts})
+                if len(hits) == limit:
+                    return hits, ts
+        return hits, None
+
+
+def _visible(key, user, rooms):
+    """user 能否看到这个会话，能的话返回 (会话名, 是否私聊)；会话键见 service.History"""
+    if key.startswith('r:'):
+        room = key[2:]
+        return (room, False) if room in rooms else None
+    a, _, b = key[2:].partition('\x00')
+    if user == a:
+        return b, True
+    if user == b:
+        return a, True
+    return None
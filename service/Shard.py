@@ -0,0 +1,376 @@
+"""
+多进程分片模式。
+
+supervisor 启动 N 个 worker 进程，每个 worker 跑一个完整的 Server 事件循环，只负责自己接受的连接。
+监听端口通过 SO_REUSEPORT 由内核在 worker 之间分配；平台不支持时由 supervisor 创建监听 socket 传给 worker。
+
+worker 之间通过本地总线通信：每个 worker 与 supervisor 之间有一对 socketpair，
+supervisor 里的 BusHub 维护全局的用户目录（用户名 -> 分片号）和房间成员表，按目录把消息转给目标分片。
+总线消息本身也是 KIND_BINARY 帧：meta 是总线头（op 等），body 是要投递的原始聊天帧，转发时不重新编码。
+"""
+import asyncio
+import json
+import multiprocessing
+import signal
+import socket
+import zlib
+
+from Client.module.Flow import LANE_CONTROL, lane_of
+from Client.module.Framing import FrameDecoder, FrameError, binary_header, decode_frame
+from service.Connection import Connection, POLICY_DROP_FILE_CHUNK
+from service.Protocol import run
+
+BUS_QUEUE_BYTES = 256 * 1024 * 1024  # 总线链路的发送队列上限
+WORKER_JOIN_TIMEOUT = 5.0  # supervisor 退出时等 worker 结束的秒数，超时后强制结束
+
+# 总线操作
+OP_HELLO = 'hello'  # worker -> hub，请求快照
+OP_SNAPSHOT = 'snapshot'  # hub -> worker，全局用户目录和房间
+OP_PRESENCE = 'presence'  # 用户上线/下线
+OP_ROOM = 'room'  # 房间创建，成员列表在 body 里
+OP_ROOM_LEAVE = 'room_leave'  # 成员退出房间
+OP_ROOM_DELETE = 'room_delete'  # 删除房间
+OP_BROADCAST = 'broadcast'  # 投递给所有分片的本地用户
+OP_DELIVER = 'deliver'  # 投递给某个用户
+OP_ROOM_DELIVER = 'room_deliver'  # 投递给房间成员
+OP_HISTORY_APPEND = 'history_append'  # 写入聊天记录，发给会话所属的分片
+OP_HISTORY_READ = 'history_read'  # 查询聊天记录，发给会话所属的分片
+OP_SEARCH = 'search'  # 搜索请求，发给其他所有分片，各自查自己保存的会话
+OP_SEARCH_RESULT = 'search_result'  # 搜索结果，发回汇总的分片
+OP_MAIL_STORE = 'mail_store'  # 存离线消息，发给信箱所属的分片
+OP_MAIL_FLUSH = 'mail_flush'  # 用户上线，请求信箱所属的分片取出信箱
+OP_MAIL_BATCH = 'mail_batch'  # 取出的离线消息，按用户所在分片投递
+
+
+def bus_frame(meta: dict, body=b'') -> bytes:
+    return binary_header(meta, len(body)) + bytes(body)
+
+
+async def read_frames(loop, sock, on_frame):
+    """从总线 socket 读帧，直到对端关闭"""
+    decoder = FrameDecoder()
+    while True:
+        with decoder.get_buffer() as view:
+            nbytes = await loop.sock_recv_into(sock, view)
+        if not nbytes:
+            return
+        for frame in decoder.buffer_updated(nbytes):
+            try:
+                on_frame(frame)
+            except Exception as e:
+                # 处理某一帧出错不能让整个总线停下来
+                print(f"Bus frame {frame.route.get('op')} failed: {e!r}")
+
+
+class ShardBus:
+    """
+    worker 端的总线连接，挂在 Server.bus 上。
+    Server 只在本地找不到用户或需要通知其他分片时调用这里的方法。
+    """
+    def __init__(self, server, shard_id, shards, sock):
+        self.server = server
+        self.shard_id = shard_id
+        self.shards = shards
+        self.sock = sock
+        self.link = None
+
+    def owner_of(self, key):
+        """会话所属的分片；用 crc32 而不是 hash()，保证各进程结果一致"""
+        return zlib.crc32(key.encode('utf-8')) % self.shards
+
+    def start(self, loop):
+        self.sock.setblocking(False)
+        self.link = Connection(self.sock, loop, BUS_QUEUE_BYTES, POLICY_DROP_FILE_CHUNK)
+        self.link.name = f"bus-{self.shard_id}"
+        self.link.send(bus_frame({'op': OP_HELLO, 'shard': self.shard_id}))
+        loop.create_task(self._read_loop(loop))
+
+    async def _read_loop(self, loop):
+        try:
+            await read_frames(loop, self.sock, self.on_frame)
+        except (OSError, FrameError) as e:
+            print(f"Shard {self.shard_id} bus error: {e}")
+        print(f"Shard {self.shard_id} lost the bus, exiting")
+        loop.stop()
+
+    def _send(self, meta, inner=b'', bulk=False, lane=LANE_CONTROL):
+        if bulk:
+            meta['bulk'] = True  # hub 转发时也按可丢弃的大块数据入队
+        if lane != LANE_CONTROL:
+            meta['lane'] = lane  # 总线链路上同样按通道优先级发送
+        self.link.send(bus_frame(meta, inner), bulk, lane)
+
+    def presence(self, user, online):
+        self._send({'op': OP_PRESENCE, 'user': user, 'online': online, 'shard': self.shard_id})
+
+    def room(self, room_name, creator, users):
+        self._send({'op': OP_ROOM, 'room': room_name, 'creator': creator},
+                   json.dumps(list(users)).encode('utf-8'))
+
+    def room_leave(self, room_name, user):
+        self._send({'op': OP_ROOM_LEAVE, 'room': room_name, 'user': user})
+
+    def room_delete(self, room_name):
+        self._send({'op': OP_ROOM_DELETE, 'room': room_name})
+
+    # 转发的帧保持收到时的压缩状态和编码，由目标分片按各接收者的协商结果处理
+    def broadcast(self, frame, exclude):
+        self._send({'op': OP_BROADCAST, 'exclude': exclude}, self.forwarded(frame), lane=self.lane(frame))
+
+    def deliver(self, frame, user, bulk=False):
+        self._send({'op': OP_DELIVER, 'user': user}, self.forwarded(frame), bulk, self.lane(frame))
+
+    def room_deliver(self, frame, room_name, exclude, bulk=False):
+        self._send({'op': OP_ROOM_DELIVER, 'room': room_name, 'exclude': exclude}, self.forwarded(frame), bulk,
+                   self.lane(frame))
+
+    @staticmethod
+    def forwarded(frame):
+        return frame.encoded(True, compress=frame.compressed, codec=frame.codec)
+
+    @staticmethod
+    def lane(frame):
+        return lane_of(frame.route.get('type'), frame.lane)
+
+    def history_append(self, owner, key, frame):
+        self._send({'op': OP_HISTORY_APPEND, 'target': owner, 'key': key}, frame.encoded(True))
+
+    def history_read(self, owner, request):
+        self._send({'op': OP_HISTORY_READ, 'target': owner, 'request': request})
+
+    def search(self, request):
+        self._send({'op': OP_SEARCH, 'request': request})
+
+    def search_result(self, origin, search_id, hits):
+        self._send({'op': OP_SEARCH_RESULT, 'target': origin, 'id': search_id},
+                   json.dumps(hits, ensure_ascii=False).encode('utf-8'))
+
+    def mail_store(self, owner, user, frame):
+        self._send({'op': OP_MAIL_STORE, 'target': owner, 'user': user}, frame.encoded(True))
+
+    def mail_flush(self, owner, user):
+        self._send({'op': OP_MAIL_FLUSH, 'target': owner, 'user': user})
+
+    def mail_batch(self, user, messages):
+        self._send({'op': OP_MAIL_BATCH, 'user': user}, b''.join(messages))
+
+    def on_frame(self, bus_msg):
+        route = bus_msg.route
+        op = route['op']
+        server = self.server
+
+        if op == OP_SNAPSHOT:
+            snapshot = json.loads(bytes(bus_msg.body))
+            server.remote_users = {name: shard for name, shard in snapshot['users'].items()
+                                   if shard != self.shard_id}
+            for name in server.remote_users:
+                server.rooms.refresh(name)
+                server.presence.changed(name)
+            for room_name, info in snapshot['rooms'].items():
+                server.add_remote_room(room_name, info['creator'], info['users'])
+
+        elif op == OP_PRESENCE:
+            if route['online']:
+                server.remote_users[route['user']] = route['shard']
+            elif server.remote_users.get(route['user']) == route['shard']:
+                server.remote_users.pop(route['user'])
+            server.rooms.refresh(route['user'])
+            server.presence.changed(route['user'])
+
+        elif op == OP_ROOM:
+            server.add_remote_room(route['room'], route['creator'], json.loads(bytes(bus_msg.body)))
+
+        elif op == OP_ROOM_LEAVE:
+            server.rooms.leave(route['room'], route['user'])
+
+        elif op == OP_ROOM_DELETE:
+            server.rooms.delete(route['room'])
+
+        elif op == OP_HISTORY_APPEND:
+            server.store_history(route['key'], decode_frame(bytes(bus_msg.body)))
+
+        elif op == OP_HISTORY_READ:
+            server.loop.create_task(server.read_history(route['request']))
+
+        elif op == OP_SEARCH:
+            server.loop.create_task(server.answer_search(route['request']))
+
+        elif op == OP_SEARCH_RESULT:
+            server.search_result(route['id'], json.loads(bytes(bus_msg.body)))
+
+        elif op == OP_MAIL_STORE:
+            if server.offline:
+                server.offline.put(route['user'], bytes(bus_msg.body))
+
+        elif op == OP_MAIL_FLUSH:
+            server.flush_offline(route['user'])
+
+        elif op == OP_MAIL_BATCH:
+            messages = [frame.raw for frame in FrameDecoder(0).feed(bus_msg.body)]
+            server.deliver_offline(route['user'], messages)
+
+        else:
+            frame = decode_frame(bytes(bus_msg.body))
+            bulk = frame.route.get('type') == 'file_chunk'
+            if op == OP_BROADCAST:
+                server.broadcast_local(frame, route['exclude'])
+            elif op == OP_DELIVER:
+                server.deliver_local(frame, [route['user']], bulk)
+            elif op == OP_ROOM_DELIVER and route['room'] in server.rooms:
+                server.send_conns(frame, server.rooms.get(route['room']).recipients(route['exclude']), bulk)
+
+
+class BusHub:
+    """
+    supervisor 端的总线中心：维护全局目录，把 worker 发来的总线帧原样转给目标分片
+    """
+    def __init__(self, socks):
+        self.socks = socks
+        self.links: list[Connection] = []
+        self.users: dict[str, int] = {}  # 用户名 -> 分片号
+        self.rooms: dict[str, dict] = {}  # 房间名 -> {'creator', 'users'}
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        readers = []
+        for shard_id, sock in enumerate(self.socks):
+            sock.setblocking(False)
+            link = Connection(sock, loop, BUS_QUEUE_BYTES, POLICY_DROP_FILE_CHUNK)
+            link.name = f"hub-{shard_id}"
+            self.links.append(link)
+            readers.append(read_frames(loop, sock, lambda frame, shard_id=shard_id: self.on_frame(shard_id, frame)))
+        # 任意一个 worker 退出都结束整个服务
+        await asyncio.wait([loop.create_task(r) for r in readers], return_when=asyncio.FIRST_COMPLETED)
+
+    def on_frame(self, origin, bus_msg):
+        route = bus_msg.route
+        op = route['op']
+        bulk = route.get('bulk', False)
+        lane = route.get('lane', LANE_CONTROL)
+
+        if op == OP_HELLO:
+            snapshot = {'users': self.users, 'rooms': self.rooms}
+            self.links[origin].send(bus_frame({'op': OP_SNAPSHOT}, json.dumps(snapshot).encode('utf-8')))
+            return
+
+        if 'target' in route:
+            # 指定了目标分片的消息直接转发
+            targets = [route['target']]
+
+        elif op == OP_PRESENCE:
+            if route['online']:
+                self.users[route['user']] = origin
+            elif self.users.get(route['user']) == origin:
+                self.users.pop(route['user'])
+            targets = self._others(origin)
+
+        elif op == OP_ROOM:
+            self.rooms[route['room']] = {'creator': route['creator'], 'users': json.loads(bytes(bus_msg.body))}
+            targets = self._others(origin)
+
+        elif op == OP_ROOM_LEAVE:
+            room = self.rooms.get(route['room'])
+            if room is not None:
+                room['users'] = [user for user in room['users'] if user != route['user']]
+                if not room['users']:
+                    del self.rooms[route['room']]
+            targets = self._others(origin)
+
+        elif op == OP_ROOM_DELETE:
+            self.rooms.pop(route['room'], None)
+            targets = self._others(origin)
+
+        elif op in (OP_BROADCAST, OP_SEARCH):
+            targets = self._others(origin)
+
+        elif op in (OP_DELIVER, OP_MAIL_BATCH):
+            shard = self.users.get(route['user'])
+            targets = [shard] if shard is not None and shard != origin else []
+
+        elif op == OP_ROOM_DELIVER:
+            # 只发给有在线成员的分片
+            room = self.rooms.get(route['room'])
+            members = room['users'] if room else []
+            targets = {self.users[user] for user in members if user in self.users} - {origin}
+
+        else:
+            print(f"Unknown bus op {op} from shard {origin}")
+            return
+
+        for shard in targets:
+            self.links[shard].send(bus_msg.raw, bulk, lane)
+
+    def _others(self, origin):
+        return [shard for shard in range(len(self.links)) if shard != origin]
+
+
+def listen_socket(ip, port, max_user, reuse_port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((ip, port))
+    sock.listen(max_user)
+    return sock
+
+
+def worker_main(shard_id, workers, ip, port, max_user, bus_sock, listen_sock, server_kwargs, use_uvloop=False,
+                hub_socks=()):
+    from Server import Server
+
+    # fork 时继承了 supervisor 的各个 hub 端，不关掉的话 supervisor 退出后总线读不到 EOF，worker 不会退出
+    for sock in hub_socks:
+        sock.close()
+
+    if listen_sock is None:
+        listen_sock = listen_socket(ip, port, max_user, reuse_port=True)
+    if server_kwargs.get('metrics_port'):
+        # 每个分片单独输出自己的指标
+        server_kwargs = dict(server_kwargs, metrics_port=server_kwargs['metrics_port'] + shard_id)
+    server = Server(ip, port, max_user, sock=listen_sock, shard_id=shard_id, **server_kwargs)
+    server.bus = ShardBus(server, shard_id, workers, bus_sock)
+    print(f"Shard {shard_id} started")
+    try:
+        run(server.run(), use_uvloop)
+    except (KeyboardInterrupt, RuntimeError):
+        pass
+
+
+def run_sharded(ip, port, max_user, workers, use_uvloop=False, **server_kwargs):
+    """启动 supervisor 和 workers 个 worker 进程，阻塞直到任意一个 worker 退出"""
+    reuse_port = hasattr(socket, 'SO_REUSEPORT')
+    # 不支持 SO_REUSEPORT 时共享同一个监听 socket，由各 worker 竞争 accept
+    shared = None if reuse_port else listen_socket(ip, port, max_user, reuse_port=False)
+
+    hub_socks = []
+    processes = []
+    for shard_id in range(workers):
+        hub_end, worker_end = socket.socketpair()
+        hub_socks.append(hub_end)
+        process = multiprocessing.Process(
+            target=worker_main,
+            args=(shard_id, workers, ip, port, max_user, worker_end, shared, server_kwargs, use_uvloop,
+                  list(hub_socks)),
+            daemon=True
+        )
+        process.start()
+        worker_end.close()
+        processes.append(process)
+
+    # SIGTERM 也走下面的 finally，先结束所有 worker 再退出
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        run(BusHub(hub_socks).run(), use_uvloop)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(WORKER_JOIN_TIMEOUT)
+            if process.is_alive():
+                process.kill()
+
+
+def _terminate(signum, frame):
+    raise SystemExit(128 + signum)
@@ -0,0 +1,80 @@
+"""
+分层时间轮。
+
+每层 SLOTS 个槽，第 0 层一个槽是一个 tick，第 l 层一个槽是 SLOTS ** l 个 tick。
+定时器按到期 tick 放进能容纳它的最低一层；时间推进到某一层的槽时把里面的定时器重新分配到更低的层。
+添加、取消都是 O(1)，推进一个 tick 只处理到期和需要下移的定时器，
+所以十万个连接的空闲超时只要一个 asyncio 定时器。
+"""
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+SLOT_MASK = SLOTS - 1
+LEVELS = 4  # 一秒一个 tick 时最长约 194 天
+
+
+class TimerWheel:
+    def __init__(self, tick, now):
+        self.tick = tick
+        self.current = int(now / tick)  # 已经处理完的 tick
+        self.wheels = [[set() for _ in range(SLOTS)] for _ in range(LEVELS)]
+        self.timers = {}  # key -> (到期 tick, 所在的槽)
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    def schedule(self, key, when):
+        """在时间 when 之后到期；key 已有定时器时改期"""
+        self.cancel(key)
+        self._insert(key, max(int(when / self.tick), self.current + 1))
+
+    def cancel(self, key):
+        entry = self.timers.pop(key, None)
+        if entry is not None:
+            entry[1].discard(key)
+
+    def _insert(self, key, expires):
+        delta = expires - self.current
+        level = 0
+        while level < LEVELS - 1 and delta >= 1 << (SLOT_BITS * (level + 1)):
+            level += 1
+        if delta >= 1 << (SLOT_BITS * LEVELS):
+            # 超出范围的按能表示的最远时间到期，调用方到期时自行检查实际期限
+            expires = self.current + (1 << (SLOT_BITS * LEVELS)) - 1
+        slot = self.wheels[level][(max(expires, self.current) >> (SLOT_BITS * level)) & SLOT_MASK]
+        slot.add(key)
+        self.timers[key] = (expires, slot)
+
+    def _cascade(self, level):
+        """把第 level 层当前的槽下移，返回该层的槽号"""
+        index = (self.current >> (SLOT_BITS * level)) & SLOT_MASK
+        slot = self.wheels[level][index]
+        if slot:
+            keys = list(slot)
+            slot.clear()
+            for key in keys:
+                self._insert(key, self.timers[key][0])
+        return index
+
+    def advance(self, now) -> list:
+        """推进到 now，返回到期的 key"""
+        target = int(now / self.tick)
+        expired = []
+        while self.current < target:
+            self.current += 1
+            if not self.current & SLOT_MASK:
+                for level in range(1, LEVELS):
+                    if self._cascade(level):
+                        break
+            slot = self.wheels[0][self.current & SLOT_MASK]
+            if slot:
+                for key in slot:
+                    del self.timers[key]
+                expired.extend(slot)
+                slot.clear()
+            if not self.timers:
+                # 没有定时器时直接跳到目标，长时间空闲后不必逐个 tick 空转
+                self.current = target
+        return expired